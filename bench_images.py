@@ -0,0 +1,116 @@
+import argparse
+import io
+import json
+import os
+
+import fitz
+
+from pdf_pages import estimate_image_tokens, image_options, image_options_tag, pdf_pages_to_images
+
+# Image encodings compared by default. Each entry overrides DEFAULT_IMAGE_OPTIONS.
+SETTINGS = {
+    'png-300dpi': {},
+    'png-gray-crop': {'grayscale': True, 'crop': True},
+    'jpeg85-2048': {'format': 'jpeg', 'quality': 85, 'long_edge': 2048},
+    'jpeg75-gray-crop-1536': {'format': 'jpeg', 'quality': 75, 'grayscale': True, 'crop': True, 'long_edge': 1536},
+    'jpeg60-gray-crop-1024': {'format': 'jpeg', 'quality': 60, 'grayscale': True, 'crop': True, 'long_edge': 1024},
+    'webp75-gray-crop-1536': {'format': 'webp', 'quality': 75, 'grayscale': True, 'crop': True, 'long_edge': 1536},
+    'jpeg75-gray-crop-adaptive': {'format': 'jpeg', 'quality': 75, 'grayscale': True, 'crop': True,
+                                  'long_edge': 1536, 'detail': 'adaptive'},
+}
+
+
+def flatten(value, prefix=''):
+    # {'a': {'b': 1}, 'c': [2]} -> {'a.b': '1', 'c.0': '2'}
+    if isinstance(value, dict):
+        items = {}
+        for key, child in value.items():
+            items.update(flatten(child, f"{prefix}{key}."))
+        return items
+    if isinstance(value, list):
+        items = {}
+        for index, child in enumerate(value):
+            items.update(flatten(child, f"{prefix}{index}."))
+        return items
+    return {prefix.rstrip('.'): str(value).strip().lower()}
+
+
+def field_accuracy(predicted, expected):
+    expected_fields = flatten(expected)
+    if not expected_fields:
+        return 1.0
+    predicted_fields = flatten(predicted)
+    matched = sum(1 for key, value in expected_fields.items() if predicted_fields.get(key) == value)
+    return matched / len(expected_fields)
+
+
+def load_corpus(corpus_folder):
+    # Every invoice.pdf may have an invoice.json next to it holding the expected output
+    corpus = []
+    for filename in sorted(os.listdir(corpus_folder)):
+        if filename.lower().endswith('.pdf'):
+            pdf_path = os.path.join(corpus_folder, filename)
+            truth_path = os.path.splitext(pdf_path)[0] + '.json'
+            truth = None
+            if os.path.exists(truth_path):
+                with open(truth_path) as f:
+                    truth = json.load(f)
+            corpus.append((pdf_path, truth))
+    return corpus
+
+
+def run_setting(corpus, options, dpi, extract_fn=None):
+    report = {'pages': 0, 'bytes': 0, 'image_tokens': 0, 'accuracy': None}
+    scores = []
+    for pdf_path, truth in corpus:
+        with open(pdf_path, 'rb') as f:
+            pdf_bytes = f.read()
+        # Every page is sent as an image here, this measures the vision path only
+        pages = [{'page': number, 'image': image}
+                 for number, image in pdf_pages_to_images(io.BytesIO(pdf_bytes), dpi, None, options)]
+        report['pages'] += len(pages)
+        report['bytes'] += sum(len(page['image']['data']) for page in pages)
+        report['image_tokens'] += sum(estimate_image_tokens(page['image']) for page in pages)
+
+        if extract_fn and truth is not None:
+            output = extract_fn(pages)
+            try:
+                scores.append(field_accuracy(json.loads(output.choices[0].message.content), truth) if output else 0.0)
+            except json.JSONDecodeError:
+                scores.append(0.0)
+    if scores:
+        report['accuracy'] = round(sum(scores) / len(scores), 4)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare page image encodings by size, image tokens and accuracy")
+    parser.add_argument('corpus', help="folder of invoice PDFs with optional ground truth JSON files")
+    parser.add_argument('--settings', nargs='*', default=list(SETTINGS), choices=list(SETTINGS))
+    parser.add_argument('--dpi', type=int, default=300)
+    parser.add_argument('--extract', action='store_true',
+                        help="also call the model through flask_vlm and score against the ground truth")
+    args = parser.parse_args()
+
+    extract_fn = None
+    if args.extract:
+        import flask_vlm
+        extract_fn = flask_vlm.pipeline.call_model
+
+    corpus = load_corpus(args.corpus)
+    print(f"{len(corpus)} PDF(s) in corpus, fitz {fitz.VersionBind}")
+    print(f"{'setting':<28}{'pages':>7}{'KB':>10}{'img tokens':>12}{'accuracy':>10}")
+    for name in args.settings:
+        options = image_options(**SETTINGS[name])
+        try:
+            report = run_setting(corpus, options, args.dpi, extract_fn)
+        except ValueError as e:
+            print(f"{name:<28}skipped: {e}")
+            continue
+        accuracy = '-' if report['accuracy'] is None else f"{report['accuracy']:.2%}"
+        print(f"{name:<28}{report['pages']:>7}{report['bytes'] / 1024:>10.1f}{report['image_tokens']:>12}{accuracy:>10}")
+        print(f"    {image_options_tag(options)}")
+
+
+if __name__ == "__main__":
+    main()
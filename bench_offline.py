@@ -0,0 +1,342 @@
+import argparse
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Everything runs in this process: no MongoDB server and no OpenAI account are needed.
+# These have to be set before the apps are imported.
+os.environ['MONGO_URI'] = 'memory://'
+os.environ.setdefault('OPENAI_API_KEY', 'offline-benchmark')
+
+import fitz
+
+from pre_extract import GSTIN_CHARS
+
+KINDS = ('digital', 'scanned', 'multipage', 'multi_invoice')
+TARGETS = ('multi', 'vlm', 'perf_score', 'integrated')
+VENDOR_BASES = ('27AAPFU0939F1Z', '29AABCT3518Q1Z', '07AAACR5055K1Z', '33AADCS0472N1Z', '24AAGCA6379E1Z')
+ITEM_NAMES = ('Steel rods', 'Copper wire', 'Hex bolts', 'Washers', 'PVC pipe', 'Cable ties', 'Paint 20L',
+              'Welding rods', 'Bearings', 'Gaskets', 'Valves', 'Fuses')
+ITEMS_PER_PAGE = 30
+SCAN_DPI = 120
+# Functions timed as stages: what the apps' shared extraction pipeline calls through
+# module attributes, and what integrated.py's batch mode calls. Batch mode parses PDFs
+# in worker processes, which the timer can not wrap.
+PIPELINE_STAGES = ('read_pdf_pages', 'pre_extract', 'page_layout')
+INTEGRATED_STAGES = ('extract_invoices', 'chat_with_AI', 'convert_txt_to_json')
+APP_MODULES = {'multi': 'flask_multi', 'vlm': 'flask_vlm', 'perf_score': 'flask_perf_score', 'integrated': 'integrated'}
+
+
+def gstin(base):
+    total = 0
+    for index, char in enumerate(base):
+        value = GSTIN_CHARS.index(char) * (2 if index % 2 else 1)
+        total += value // 36 + value % 36
+    return base + GSTIN_CHARS[(36 - total % 36) % 36]
+
+
+def _invoice_page(doc, rng, vendor, number, items, first=True, last=True, total=0.0):
+    page = doc.new_page()
+    if first:
+        page.insert_text((50, 50), f"VENDOR {vendor[2:7]} SUPPLIES PVT LTD", fontsize=12)
+        page.insert_text((50, 70), f"GSTIN: {vendor}")
+        page.insert_text((350, 50), "Invoice No:")
+        page.insert_text((430, 50), number)
+        page.insert_text((350, 70), "Invoice Date:")
+        page.insert_text((430, 70), f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/2024")
+        page.insert_text((50, 110), "Bill To:")
+        page.insert_text((50, 125), f"GSTIN: {gstin('19AAACI1681G1Z')}")
+    y = 170 if first else 60
+    page.insert_text((50, y), "Description")
+    page.insert_text((330, y), "Qty")
+    page.insert_text((400, y), "Amount")
+    for name, qty, amount in items:
+        y += 15
+        page.insert_text((50, y), name)
+        page.insert_text((330, y), str(qty))
+        page.insert_text((400, y), f"{amount:.2f}")
+    if last:
+        page.insert_text((300, y + 30), "Grand Total")
+        page.insert_text((400, y + 30), f"{total:.2f}")
+
+
+def _random_items(rng, count):
+    return [(rng.choice(ITEM_NAMES), rng.randint(1, 20), round(rng.uniform(10, 5000), 2)) for _ in range(count)]
+
+
+def _add_invoice(doc, rng, index, item_count):
+    vendor = gstin(rng.choice(VENDOR_BASES))
+    items = _random_items(rng, item_count)
+    total = sum(amount for _, _, amount in items)
+    chunks = [items[start:start + ITEMS_PER_PAGE] for start in range(0, len(items), ITEMS_PER_PAGE)]
+    for page_index, chunk in enumerate(chunks):
+        _invoice_page(doc, rng, vendor, f"INV-{index:05d}", chunk, page_index == 0, page_index == len(chunks) - 1,
+                      total)
+
+
+def _scanned(doc, rng):
+    # Image-only copy of every page: grey, low resolution and speckled like a scan
+    scan = fitz.open()
+    for page in doc:
+        pix = page.get_pixmap(dpi=SCAN_DPI, colorspace=fitz.csGRAY)
+        for _ in range(pix.width * pix.height // 2000):
+            pix.set_pixel(rng.randrange(pix.width), rng.randrange(pix.height), (rng.randint(0, 120),))
+        scan_page = scan.new_page(width=page.rect.width, height=page.rect.height)
+        scan_page.insert_image(scan_page.rect, pixmap=pix)
+    return scan
+
+
+def synthetic_pdf(kind, index, rng):
+    doc = fitz.open()
+    if kind == 'multipage':
+        _add_invoice(doc, rng, index, rng.randint(ITEMS_PER_PAGE + 5, ITEMS_PER_PAGE * 3))
+    elif kind == 'multi_invoice':
+        for part in range(rng.randint(2, 3)):
+            _add_invoice(doc, rng, index * 10 + part, rng.randint(2, 8))
+    else:
+        _add_invoice(doc, rng, index, rng.randint(2, 12))
+    if kind == 'scanned':
+        doc = _scanned(doc, rng)
+    return doc.tobytes(garbage=3, deflate=True)
+
+
+def generate_corpus(folder, count, kinds=KINDS, seed=0):
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for index in range(count):
+        kind = kinds[index % len(kinds)]
+        path = os.path.join(folder, f"{index:04d}_{kind}.pdf")
+        with open(path, 'wb') as f:
+            f.write(synthetic_pdf(kind, index, rng))
+        paths.append(path)
+    return paths
+
+
+MOCK_INVOICE = {
+    'invoice_number': 'MOCK-0001',
+    'invoice_date': '2024-01-01',
+    'line_items': [{'description': 'Mock item', 'quantity': 1, 'amount': '100.00'}],
+}
+
+
+# Chat completions endpoint that answers after a configurable delay, and rejects a share
+# of requests with 429 and a Retry-After header the way the real API does under load
+class MockOpenAIServer:
+    def __init__(self, latency=0.5, jitter=0.2, rate_429=0.0, retry_after=0.2, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'rate_limited': 0}
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, body, headers=()):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                with server._lock:
+                    server.stats['requests'] += 1
+                    limited = server._rng.random() < server.rate_429
+                    delay = max(0.0, server.latency + server._rng.uniform(-server.jitter, server.jitter))
+                    if limited:
+                        server.stats['rate_limited'] += 1
+                if not self.path.endswith('/chat/completions'):
+                    return self._reply(404, {'error': {'message': f"Unknown path {self.path}"}})
+                if limited:
+                    return self._reply(429, {'error': {'message': 'Rate limit reached', 'type': 'rate_limit'}},
+                                       [('retry-after-ms', str(int(server.retry_after * 1000))),
+                                        ('retry-after', str(max(1, round(server.retry_after))))])
+                time.sleep(delay)
+                prompt_tokens = len(json.dumps(request.get('messages', []))) // 4
+                content = json.dumps(MOCK_INVOICE)
+                self._reply(200, {
+                    'id': 'chatcmpl-mock',
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': request.get('model', 'mock'),
+                    'choices': [{'index': 0, 'finish_reason': 'stop',
+                                 'message': {'role': 'assistant', 'content': content}}],
+                    'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(content) // 4,
+                              'total_tokens': prompt_tokens + len(content) // 4,
+                              'prompt_tokens_details': {'cached_tokens': 0}},
+                })
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name='mock-openai', daemon=True).start()
+        # The OpenAI SDK picks this up for every client created afterwards
+        os.environ['OPENAI_BASE_URL'] = self.base_url
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))]
+
+
+class StageTimer:
+    def __init__(self):
+        self.timings = {}
+        self._instrumented = []
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.timings.setdefault(stage, []).append(seconds)
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return timed
+
+    def instrument(self, target, names):
+        # target is a module or an object whose methods are timed, until restore()
+        for name in names:
+            original = getattr(target, name)
+            self._instrumented.append((target, name, original))
+            setattr(target, name, self.wrap(name, original))
+
+    def restore(self):
+        for target, name, original in reversed(self._instrumented):
+            setattr(target, name, original)
+        self._instrumented = []
+
+    def report(self):
+        return {stage: {'count': len(values),
+                        'p50_ms': round(percentile(values, 0.50) * 1000, 1),
+                        'p95_ms': round(percentile(values, 0.95) * 1000, 1),
+                        'p99_ms': round(percentile(values, 0.99) * 1000, 1)}
+                for stage, values in self.timings.items()}
+
+
+def run_flask_app(target, paths, concurrency):
+    import extraction_pipeline
+
+    module = __import__(APP_MODULES[target])
+    timer = StageTimer()
+    timer.instrument(extraction_pipeline, PIPELINE_STAGES)
+    timer.instrument(module.pipeline, ('call_model',))
+    timer.instrument(module.invoice_writer, ('save', 'flush'))
+
+    def upload(path):
+        with open(path, 'rb') as f:
+            data = {'files': [(io.BytesIO(f.read()), f"{target}_{os.path.basename(path)}")]}
+        start = time.perf_counter()
+        response = module.app.test_client().post('/extract_invoice_json', data=data,
+                                                 content_type='multipart/form-data')
+        timer.add('request', time.perf_counter() - start)
+        return response.status_code == 200 and 'error' not in next(iter(response.get_json()[0].values()))
+
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            succeeded = sum(pool.map(upload, paths))
+    finally:
+        timer.restore()
+    return time.perf_counter() - start, succeeded, timer
+
+
+def run_integrated(paths, concurrency):
+    import integrated
+
+    timer = StageTimer()
+    timer.instrument(integrated, INTEGRATED_STAGES)
+    json_folder = tempfile.mkdtemp(prefix='bench_json_')
+    manifest_path = os.path.join(json_folder, integrated.MANIFEST_FILENAME)
+    start = time.perf_counter()
+    try:
+        # Through the command line entry point, as the batch mode is run for real
+        integrated.cli(['--batch', '--pdf-folder', os.path.dirname(paths[0]), '--json-folder', json_folder,
+                        '--ai-workers', str(concurrency), '--manifest', manifest_path])
+    finally:
+        timer.restore()
+    elapsed = time.perf_counter() - start
+    # One manifest entry per PDF; a split PDF writes a JSON file per invoice
+    succeeded = sum(entry['status'] == 'done' for entry in integrated.load_manifest(manifest_path).values())
+    return elapsed, succeeded, timer
+
+
+def print_report(target, files, elapsed, succeeded, timer):
+    print(f"\n{target}: {succeeded}/{files} file(s) in {elapsed:.2f}s, {files / elapsed:.2f} files/sec")
+    print(f"    {'stage':<24}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, row in timer.report().items():
+        print(f"    {stage:<24}{row['count']:>7}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline throughput and latency benchmark with a mock OpenAI "
+                                                 "server, an in-memory MongoDB and synthetic invoices")
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--kinds', nargs='*', default=list(KINDS), choices=KINDS)
+    parser.add_argument('--targets', nargs='*', default=list(TARGETS), choices=TARGETS)
+    parser.add_argument('--concurrency', type=int, default=4, help="simultaneous uploads to each Flask app")
+    parser.add_argument('--latency', type=float, default=0.5, help="mock model latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--rate-429', type=float, default=0.0, help="share of model calls rejected with 429")
+    parser.add_argument('--retry-after', type=float, default=0.2)
+    parser.add_argument('--corpus', default=None, help="folder for the generated PDFs (default: a temp folder)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', default=None, help="also write the report to this file")
+    args = parser.parse_args()
+
+    corpus = args.corpus or tempfile.mkdtemp(prefix='bench_corpus_')
+    paths = generate_corpus(corpus, args.files, args.kinds, args.seed)
+    print(f"Generated {len(paths)} PDF(s) in {corpus}")
+    server = MockOpenAIServer(args.latency, args.jitter, args.rate_429, args.retry_after, args.seed).start()
+
+    report = {}
+    for target in args.targets:
+        if target == 'integrated':
+            elapsed, succeeded, timer = run_integrated(paths, args.concurrency)
+        else:
+            elapsed, succeeded, timer = run_flask_app(target, paths, args.concurrency)
+        print_report(target, len(paths), elapsed, succeeded, timer)
+        report[target] = {'files': len(paths), 'succeeded': succeeded, 'seconds': round(elapsed, 3),
+                          'files_per_sec': round(len(paths) / elapsed, 3), 'stages': timer.report()}
+    server.stop()
+    print(f"\nMock server: {server.stats['requests']} request(s), {server.stats['rate_limited']} rate limited")
+    report['mock_server'] = server.stats
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
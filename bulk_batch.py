@@ -0,0 +1,241 @@
+import json
+import os
+import shutil
+import time
+import uuid
+
+from openai.types.chat import ChatCompletion
+
+from openai_pool import get_client
+from prompts import token_usage
+
+# Bulk chat completions through an asynchronous batch endpoint. Requests are written to
+# JSON lines shards, each shard is submitted as one batch job, and the jobs are polled
+# until they finish. Every step is checkpointed in the work folder, so an interrupted run
+# picks up where it stopped, and lines that failed are resubmitted on their own.
+BULK_SHARD_REQUESTS = int(os.environ.get('BULK_SHARD_REQUESTS', '1000'))
+BULK_SHARD_BYTES = int(os.environ.get('BULK_SHARD_BYTES', str(100 * 1024 * 1024)))  # the API accepts up to 200 MB
+BULK_POLL_SECONDS = float(os.environ.get('BULK_POLL_SECONDS', '60'))
+BULK_MAX_ATTEMPTS = int(os.environ.get('BULK_MAX_ATTEMPTS', '3'))
+BATCH_ENDPOINT = '/v1/chat/completions'
+TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+STATE_FILENAME = 'bulk_state.json'
+RESULTS_FILENAME = 'bulk_results.jsonl'
+
+
+# A batch backend has submit(shard path) -> batch id, status(batch id) -> {'status',
+# 'completed', 'failed', 'total'} and results(batch id) -> output lines in the format of
+# the OpenAI Batch API, one {'custom_id', 'response': {'status_code', 'body'}, 'error'} each.
+class OpenAIBatchBackend:
+    def __init__(self, api_key):
+        self.client = get_client(api_key)
+
+    def submit(self, shard_path):
+        with open(shard_path, 'rb') as f:
+            input_file = self.client.files.create(file=f, purpose='batch')
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT,
+                                           completion_window='24h')
+        return batch.id
+
+    def status(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        return {'status': batch.status, 'completed': counts.completed if counts else 0,
+                'failed': counts.failed if counts else 0, 'total': counts.total if counts else 0}
+
+    def results(self, batch_id):
+        # Expired and cancelled batches still return the lines that finished
+        batch = self.client.batches.retrieve(batch_id)
+        lines = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                text = self.client.files.content(file_id).text
+                lines.extend(json.loads(line) for line in text.splitlines() if line.strip())
+        return lines
+
+
+# File based stand-in for the batch endpoint. A submitted shard is copied into the folder
+# and answered line by line with respond_fn(request body) -> chat completion dict the
+# first time its status is asked for. Used for tests, and to run small backfills through
+# the regular rate limited client with the same checkpointing.
+class LocalBatchBackend:
+    def __init__(self, folder, respond_fn):
+        self.folder = folder
+        self.respond_fn = respond_fn
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, batch_id, kind):
+        return os.path.join(self.folder, f"{batch_id}.{kind}.jsonl")
+
+    def submit(self, shard_path):
+        batch_id = f"local_{uuid.uuid4().hex}"
+        shutil.copyfile(shard_path, self._path(batch_id, 'input'))
+        return batch_id
+
+    def _run(self, batch_id):
+        with open(self._path(batch_id, 'input')) as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        with open(self._path(batch_id, 'output') + '.tmp', 'w') as out:
+            for request in requests:
+                try:
+                    line = {'custom_id': request['custom_id'], 'error': None,
+                            'response': {'status_code': 200, 'body': self.respond_fn(request['body'])}}
+                except Exception as e:
+                    line = {'custom_id': request['custom_id'], 'response': None,
+                            'error': {'code': type(e).__name__, 'message': str(e)}}
+                out.write(json.dumps(line) + '\n')
+        os.replace(self._path(batch_id, 'output') + '.tmp', self._path(batch_id, 'output'))
+
+    def status(self, batch_id):
+        if not os.path.exists(self._path(batch_id, 'output')):
+            self._run(batch_id)
+        lines = self.results(batch_id)
+        failed = sum(1 for line in lines if line['error'])
+        return {'status': 'completed', 'completed': len(lines) - failed, 'failed': failed, 'total': len(lines)}
+
+    def results(self, batch_id):
+        with open(self._path(batch_id, 'output')) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+def parse_result_line(line):
+    # (content, token usage, error) of one output line
+    response = line.get('response') or {}
+    if line.get('error') or response.get('status_code') != 200:
+        error = line.get('error') or (response.get('body') or {}).get('error') or {}
+        return None, None, error.get('message') or f"status {response.get('status_code')}"
+    completion = ChatCompletion.model_validate(response['body'])
+    return completion.choices[0].message.content, token_usage(completion), None
+
+
+class BulkRun:
+    # validate(content) -> bool marks answers to retry like failed lines, e.g. invalid JSON
+    def __init__(self, work_dir, backend, validate=None, poll_seconds=BULK_POLL_SECONDS):
+        self.work_dir = work_dir
+        self.backend = backend
+        self.validate = validate
+        self.poll_seconds = poll_seconds
+        self.state_path = os.path.join(work_dir, STATE_FILENAME)
+        self.results_path = os.path.join(work_dir, RESULTS_FILENAME)
+        os.makedirs(work_dir, exist_ok=True)
+        self.state = {'request_ids': [], 'meta': {}, 'shards': [], 'errors': {}}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+        # {custom_id: {'content', 'token_usage'}} of every line answered so far
+        self.results = {}
+        if os.path.exists(self.results_path):
+            with open(self.results_path) as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # A line cut short by a crash
+                    self.results[result['custom_id']] = result
+
+    @property
+    def started(self):
+        return bool(self.state['shards'])
+
+    @property
+    def meta(self):
+        return self.state['meta']
+
+    def _save(self):
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(self.state, f)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def write_shards(self, requests, attempt):
+        # requests: [(custom_id, request body)]
+        shard, size = [], 0
+        shards = []
+        for custom_id, body in requests:
+            line = json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': BATCH_ENDPOINT, 'body': body}) + '\n'
+            if shard and (len(shard) >= BULK_SHARD_REQUESTS or size + len(line) > BULK_SHARD_BYTES):
+                shards.append(shard)
+                shard, size = [], 0
+            shard.append(line)
+            size += len(line)
+        if shard:
+            shards.append(shard)
+        for lines in shards:
+            path = os.path.join(self.work_dir, f"shard-{attempt}-{len(self.state['shards']):04d}.jsonl")
+            with open(path, 'w') as f:
+                f.writelines(lines)
+            self.state['shards'].append({'path': path, 'attempt': attempt, 'batch_id': None, 'status': 'written',
+                                         'collected': False})
+        self._save()
+
+    def _shard_requests(self, custom_ids):
+        wanted = set(custom_ids)
+        for shard in self.state['shards']:
+            with open(shard['path']) as f:
+                for line in f:
+                    request = json.loads(line)
+                    if request['custom_id'] in wanted:
+                        wanted.discard(request['custom_id'])
+                        yield request['custom_id'], request['body']
+
+    def _collect(self, shard):
+        with open(self.results_path, 'a') as f:
+            for line in self.backend.results(shard['batch_id']):
+                content, usage, error = parse_result_line(line)
+                if not error and self.validate and not self.validate(content):
+                    error = 'Invalid response content'
+                if error:
+                    self.state['errors'][line['custom_id']] = error
+                    continue
+                result = {'custom_id': line['custom_id'], 'content': content, 'token_usage': usage}
+                self.results[line['custom_id']] = result
+                self.state['errors'].pop(line['custom_id'], None)
+                f.write(json.dumps(result) + '\n')
+        shard['collected'] = True
+        self._save()
+
+    def _wait(self):
+        while True:
+            pending = [shard for shard in self.state['shards'] if not shard['collected']]
+            if not pending:
+                return
+            for shard in pending:
+                if shard['batch_id'] is None:
+                    shard['batch_id'] = self.backend.submit(shard['path'])
+                    shard['status'] = 'submitted'
+                    self._save()
+                    print(f"Submitted {os.path.basename(shard['path'])} as batch {shard['batch_id']}")
+                    continue
+                status = self.backend.status(shard['batch_id'])
+                if status['status'] != shard['status']:
+                    shard['status'] = status['status']
+                    self._save()
+                print(f"{os.path.basename(shard['path'])}: {status['status']}, "
+                      f"{status['completed'] + status['failed']}/{status['total']} request(s) finished")
+                if status['status'] in TERMINAL_STATUSES:
+                    self._collect(shard)
+            if any(not shard['collected'] for shard in self.state['shards']):
+                time.sleep(self.poll_seconds)
+
+    def run(self, requests=None, meta=None):
+        # Returns ({custom_id: result}, {custom_id: error}). requests and meta are only
+        # used by a new run; a resumed run continues with the ones in its checkpoint.
+        if not self.started:
+            self.state['request_ids'] = [custom_id for custom_id, _ in requests]
+            self.state['meta'] = meta or {}
+            self.write_shards(requests, attempt=1)
+        while True:
+            self._wait()
+            missing = [custom_id for custom_id in self.state['request_ids'] if custom_id not in self.results]
+            attempt = max(shard['attempt'] for shard in self.state['shards'])
+            if not missing or attempt >= BULK_MAX_ATTEMPTS:
+                break
+            print(f"Retrying {len(missing)} failed request(s), attempt {attempt + 1}")
+            self.write_shards(list(self._shard_requests(missing)), attempt + 1)
+        errors = {custom_id: self.state['errors'].get(custom_id, 'No result returned')
+                  for custom_id in self.state['request_ids'] if custom_id not in self.results}
+        return self.results, errors
+
+    def finish(self):
+        # Once the results are written out the checkpoint is no longer needed, and the
+        # next run starts fresh
+        shutil.rmtree(self.work_dir, ignore_errors=True)
@@ -0,0 +1,241 @@
+import json
+import os
+import re
+
+from pre_extract import SCHEMA_FIELDS
+from worker_pools import submit_window
+
+# Long documents are extracted in overlapping windows of pages, all at once, and the
+# window outputs are merged here instead of asking the model to merge pages. Each call
+# stays small, so a 40 page invoice takes about as long as a 4 page one.
+CHUNK_MIN_PAGES = int(os.environ.get('CHUNK_MIN_PAGES', '6'))  # longer documents are windowed
+CHUNK_PAGES = int(os.environ.get('CHUNK_PAGES', '4'))
+CHUNK_OVERLAP = int(os.environ.get('CHUNK_OVERLAP', '1'))
+
+ITEM_PATHS = {'multi': 'purchase_details.items', 'integrated': 'items', 'vlm': 'line_items', 'perf_score': 'line_items'}
+ITEM_TOTAL_KEYS = {'multi': 'total_price', 'integrated': 'total_price', 'vlm': 'total_amount',
+                   'perf_score': 'total_amount'}
+# Fields printed at the end of an invoice: the last window that has them wins
+TRAILING_KEYS = ('taxes', 'total_amount_with_gst', 'total_invoice_amount')
+EMPTY_VALUES = ('', 'n/a', 'na', 'none', 'null', '0', '0.0', '0.00')
+TOTAL_TOLERANCE = 0.005  # share of the invoice total the item sum may differ by
+AMOUNT_RE = re.compile(r'(?:Rs\.?|₹)?\s*(-?[\d,]*\.?\d+)')
+MISSING = object()
+
+
+def chunk_tag():
+    return f"chunk-{CHUNK_MIN_PAGES}-{CHUNK_PAGES}-{CHUNK_OVERLAP}"
+
+
+def page_windows(page_count, size=CHUNK_PAGES, overlap=CHUNK_OVERLAP):
+    # [(start, end)] page ranges covering the document, consecutive ones sharing `overlap` pages
+    step = max(1, size - overlap)
+    windows = []
+    start = 0
+    while True:
+        end = min(page_count, start + size)
+        windows.append((start, end))
+        if end >= page_count:
+            return windows
+        start += step
+
+
+def window_hints(hints, window, page_count):
+    note = (f"These are pages {window[0] + 1} to {window[1]} of a {page_count} page invoice; the other pages are "
+            "extracted separately. Extract only what appears on these pages: list every line item shown here, "
+            "and leave header and total fields empty when they are not on these pages.")
+    return f"{hints}\n{note}" if hints else note
+
+
+def run_windows(pages, call_fn, hints=None, page_count=None):
+    # [(window, output)] with output = call_fn(window_pages, hints). Short documents are
+    # a single call on all pages with the hints unchanged. pages may be an iterator that
+    # renders them, given with its page_count: each window is sent as soon as its last
+    # page arrives, and pages no later window needs are let go.
+    if page_count is None:
+        pages = list(pages)
+        page_count = len(pages)
+    if page_count <= CHUNK_MIN_PAGES:
+        pages = list(pages)
+        return [((0, len(pages)), call_fn(pages, hints))]
+    windows = page_windows(page_count)
+    buffered, futures = {}, []
+    for index, page in enumerate(pages):
+        buffered[index] = page
+        while len(futures) < len(windows) and windows[len(futures)][1] == index + 1:
+            window = windows[len(futures)]
+            window_pages = [buffered[number] for number in range(*window)]
+            futures.append(submit_window(lambda item: call_fn(*item),
+                                         (window_pages, window_hints(hints, window, page_count))))
+            keep_from = windows[len(futures)][0] if len(futures) < len(windows) else page_count
+            for number in [number for number in buffered if number < keep_from]:
+                del buffered[number]
+    return list(zip(windows, [future.result() for future in futures]))
+
+
+def _leaf(value):
+    # perf_score wraps every value as {'value': ..., 'conf': ...}
+    if isinstance(value, dict) and 'value' in value:
+        return value['value']
+    return value
+
+
+def _is_empty(value):
+    value = _leaf(value)
+    if isinstance(value, (dict, list)):
+        return not value
+    return value is None or str(value).strip().lower() in EMPTY_VALUES
+
+
+def _has_content(value):
+    # Tax rows keep their fixed category, so it does not count as content
+    if isinstance(value, dict) and 'value' not in value:
+        return any(_has_content(child) for key, child in value.items() if key != 'category')
+    if isinstance(value, list):
+        return any(_has_content(child) for child in value)
+    return not _is_empty(value)
+
+
+def _amount(value):
+    value = _leaf(value)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    match = AMOUNT_RE.fullmatch(str(value).strip())
+    return float(match.group(1).replace(',', '')) if match else None
+
+
+def _signature(item):
+    # Items seen by two windows are the same row when all their values agree after
+    # normalizing number formats, case and punctuation
+    parts = []
+    for key in sorted(item):
+        value = _leaf(item[key])
+        amount = _amount(value)
+        parts.append(f"{key}={amount:.2f}" if amount is not None else
+                     f"{key}={re.sub(r'[^a-z0-9]', '', str(value).lower())}")
+    return '|'.join(parts)
+
+
+def merge_items(item_lists):
+    # Concatenates the windows' items, dropping the longest run at the start of each list
+    # that repeats the end of the items so far, i.e. the rows on the overlapping pages
+    merged, dropped = [], 0
+    for items in item_lists:
+        items = [item for item in items if isinstance(item, dict)]
+        merged_signatures = [_signature(item) for item in merged]
+        signatures = [_signature(item) for item in items]
+        repeat = 0
+        for length in range(min(len(merged), len(items)), 0, -1):
+            if merged_signatures[-length:] == signatures[:length]:
+                repeat = length
+                break
+        merged.extend(items[repeat:])
+        dropped += repeat
+    return merged, dropped
+
+
+def _merge_values(path, values, conflicts):
+    present = [value for value in values if value is not MISSING]
+    if not present:
+        return MISSING
+    trailing = any(key in TRAILING_KEYS for key in path.split('.'))
+
+    if all(isinstance(value, dict) and 'value' not in value for value in present):
+        merged = {}
+        for key in dict.fromkeys(key for value in present for key in value):
+            child = _merge_values(f"{path}.{key}" if path else key,
+                                  [value.get(key, MISSING) if isinstance(value, dict) else MISSING
+                                   for value in values], conflicts)
+            if child is not MISSING:
+                merged[key] = child
+        return merged
+
+    if all(isinstance(value, list) for value in present):
+        filled = [value for value in present if _has_content(value)]
+        if not filled:
+            return present[0]
+        if trailing:
+            return filled[-1]
+        # Other lists, e.g. additional_data, collect every distinct entry
+        merged, seen = [], set()
+        for value in filled:
+            for entry in value:
+                key = json.dumps(entry, sort_keys=True, default=str)
+                if key not in seen:
+                    seen.add(key)
+                    merged.append(entry)
+        return merged
+
+    candidates = [value for value in present if not _is_empty(value)]
+    if not candidates:
+        return present[-1] if trailing else present[0]
+    if len({json.dumps(_leaf(value), default=str) for value in candidates}) > 1:
+        conflicts.append(path)
+    return candidates[-1] if trailing else candidates[0]
+
+
+def _get_path(doc, path):
+    for key in path.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key)
+    return doc
+
+
+def _set_path(doc, path, value):
+    keys = path.split('.')
+    for key in keys[:-1]:
+        if not isinstance(doc.get(key), dict):
+            doc[key] = {}
+        doc = doc[key]
+    doc[keys[-1]] = value
+
+
+def _format_total(schema, total):
+    if schema in ('multi', 'integrated'):
+        return round(total, 2)
+    if schema == 'perf_score':
+        return {'value': f"{total:.2f}", 'conf': 0.5}
+    return f"{total:.2f}"
+
+
+def merge_windows(schema, docs, windows):
+    # One document from the window outputs: header fields from the first window that has
+    # them, totals and taxes from the last, line items concatenated without the overlap
+    if len(docs) == 1:
+        return docs[0]
+    conflicts = []
+    item_path = ITEM_PATHS[schema]
+    item_lists = [_get_path(doc, item_path) for doc in docs]
+    item_lists = [items if isinstance(items, list) else [] for items in item_lists]
+    merged = _merge_values('', docs, conflicts)
+    items, dropped = merge_items(item_lists)
+    _set_path(merged, item_path, items)
+    conflicts = [path for path in conflicts if not path.startswith(item_path)]
+
+    # The item sum is checked against the invoice total, and fills it in when no window found it
+    total_path = SCHEMA_FIELDS[schema]['total_amount']
+    item_amounts = [_amount(item.get(ITEM_TOTAL_KEYS[schema])) for item in items]
+    items_total = round(sum(amount for amount in item_amounts if amount is not None), 2)
+    invoice_total = _amount(_get_path(merged, total_path))
+    if not invoice_total and items_total:
+        _set_path(merged, total_path, _format_total(schema, items_total))
+        invoice_total = None
+    merged['chunking'] = {
+        'windows': [[start + 1, end] for start, end in windows],
+        'duplicate_items_dropped': dropped,
+        'conflicts': conflicts,
+        'items_total': items_total,
+        'invoice_total': invoice_total,
+        'totals_match': (invoice_total is not None
+                         and abs(invoice_total - items_total) <= TOTAL_TOLERANCE * max(invoice_total, 1.0)),
+    }
+    return merged
+
+
+def total_usage(usages):
+    totals = {'input_tokens': 0, 'cached_tokens': 0, 'output_tokens': 0}
+    for usage in usages:
+        for key in totals:
+            totals[key] += usage[key]
+    return totals
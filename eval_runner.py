@@ -0,0 +1,396 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Results are kept in an in-memory MongoDB, never in the real invoice collection.
+# This has to be set before the apps are imported, and the API key read before
+# bench_offline gives it an offline default.
+os.environ['MONGO_URI'] = 'memory://'
+OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
+
+from bench_images import flatten
+from bench_offline import APP_MODULES, MockOpenAIServer, percentile
+from chunking import chunk_tag
+from extraction_cache import content_hash
+from invoice_split import SPLIT_INVOICES
+from pdf_pages import image_options_tag
+from pre_extract import pre_extract_tag
+from prompts import prompt_version
+from refine_fields import refine_tag
+from vendor_templates import ITEM_LIST_PATHS
+
+# Offline evaluation of extractor variants against a labelled corpus. A variant is an app
+# (multi, vlm, perf_score or integrated) with an optional model in place of its default,
+# written target@model, e.g. vlm@gpt-4o or integrated@ft:gpt-3.5-turbo-0125:org::id.
+# Every invoice.pdf needs an invoice.json with the expected output; invoice.<target>.json
+# takes precedence for that target, since the apps do not share a schema. A multi-invoice
+# PDF's ground truth is a list with one entry per invoice.
+#
+# Model outputs are cached per variant in the cache folder, keyed on everything that
+# changes what the model sees, so a rerun only calls the model for new PDFs and for
+# variants whose model, prompt or settings changed.
+EVAL_CACHE_DIR = 'eval_cache'
+DEFAULT_CONCURRENCY = 4
+# USD per million input, cached input and output tokens; override with --prices
+PRICES = {
+    'gpt-3.5-turbo-0125': (0.50, 0.50, 1.50),
+    'gpt-4o-mini': (0.15, 0.075, 0.60),
+    'gpt-4o': (2.50, 1.25, 10.00),
+    'ft:gpt-3.5-turbo': (3.00, 3.00, 6.00),
+    'ft:gpt-4o-mini': (0.30, 0.15, 1.20),
+}
+# Keys the apps add to every invoice that are not extracted fields
+IGNORED_KEYS = ('_id', 'filename', 'token_usage', 'content_hash', 'chunking', 'invoice_part', 'refinement',
+                'page_dedup', 'parent_filename', 'error')
+
+
+def parse_variant(spec):
+    target, _, model = spec.partition('@')
+    if target not in APP_MODULES:
+        raise argparse.ArgumentTypeError(f"Unknown target {target}, expected one of {', '.join(APP_MODULES)}")
+    return target, model or None
+
+
+def load_target(target):
+    return __import__(APP_MODULES[target])
+
+
+def variant_settings(target, model):
+    # Everything that changes what the model is sent, or by which model
+    module = load_target(target)
+    schema = 'integrated' if target == 'integrated' else module.EXTRACTOR_VARIANT
+    settings = {'target': target, 'model': model or module.MODEL, 'prompt_version': prompt_version(schema),
+                'chunks': chunk_tag(), 'split_invoices': SPLIT_INVOICES}
+    if target != 'integrated':
+        settings.update(images=image_options_tag(), pre_extract=pre_extract_tag())
+    if target == 'multi':
+        settings['vision_model'] = module.VISION_MODEL
+    if target == 'perf_score':
+        settings['refine'] = refine_tag()
+    return settings
+
+
+def variant_key(settings):
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def load_labelled_corpus(corpus_folder, targets):
+    # [{'path', 'truth': {target: expected}}], PDFs without any ground truth left out
+    corpus = []
+    for filename in sorted(os.listdir(corpus_folder)):
+        if not filename.lower().endswith('.pdf'):
+            continue
+        path = os.path.join(corpus_folder, filename)
+        stem = os.path.splitext(path)[0]
+        truth = {}
+        for target in targets:
+            for truth_path in (f"{stem}.{target}.json", f"{stem}.json"):
+                if os.path.exists(truth_path):
+                    with open(truth_path) as f:
+                        truth[target] = json.load(f)
+                    break
+        if truth:
+            corpus.append({'path': path, 'truth': truth})
+        else:
+            print(f"No ground truth for {filename}, skipped")
+    return corpus
+
+
+class OutputCache:
+    # One JSON line per PDF: {'pdf_hash', 'outputs', 'seconds'}
+    def __init__(self, cache_dir, name, key):
+        os.makedirs(cache_dir, exist_ok=True)
+        safe_name = re.sub(r'[^A-Za-z0-9_.@-]+', '_', name)
+        self.path = os.path.join(cache_dir, f"{safe_name}-{key}.jsonl")
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # A line cut short by a crash
+                    self.entries[entry['pdf_hash']] = entry
+
+    def get(self, pdf_hash):
+        return self.entries.get(pdf_hash)
+
+    def put(self, entry):
+        self.entries[entry['pdf_hash']] = entry
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry, default=str) + '\n')
+
+
+def run_extractor(target, path, api_key, pipeline=None):
+    # Invoices extracted from one PDF, in page order, each a dict that may hold 'error'.
+    # pipeline is the app's, without stores, so nothing is cached, learned or saved.
+    module = load_target(target)
+    filename = os.path.basename(path)
+    if target != 'integrated':
+        return list(pipeline.process_pdf((filename, path)).values())
+    pdf_text = module.read_text_from_pdf(path)
+    if pdf_text is None:
+        return [{'error': 'Could not read text from PDF'}]
+    outputs = []
+    for _, json_text, usage in module.extract_invoices(api_key, filename, pdf_text):
+        try:
+            outputs.append({**json.loads(json_text), 'token_usage': usage})
+        except (TypeError, json.JSONDecodeError):
+            outputs.append({'error': 'Could not extract JSON', 'token_usage': usage})
+    return outputs
+
+
+def _plain(value):
+    # perf_score wraps every value as {'value': ..., 'conf': ...}
+    if isinstance(value, dict):
+        if 'value' in value and 'conf' in value:
+            return value['value']
+        return {key: _plain(child) for key, child in value.items()}
+    if isinstance(value, list):
+        return [_plain(child) for child in value]
+    return value
+
+
+def _normalize(text):
+    # flatten already lowercases; amounts compare as numbers
+    number = text.replace(',', '').replace('rs.', '').replace('₹', '').strip()
+    try:
+        return f"{float(number):.2f}"
+    except ValueError:
+        return ' '.join(text.split())
+
+
+def _fields(doc):
+    return {key: _normalize(value) for key, value in flatten(doc).items() if value not in ('', 'n/a', 'none')}
+
+
+def split_items(doc):
+    # (header fields, line item rows) of an invoice
+    doc = _plain({key: value for key, value in (doc or {}).items() if key not in IGNORED_KEYS})
+    for path in ITEM_LIST_PATHS:
+        keys = path.split('.')
+        parent = doc
+        for key in keys[:-1]:
+            parent = parent.get(key) if isinstance(parent, dict) else None
+        if isinstance(parent, dict) and isinstance(parent.get(keys[-1]), list):
+            rows = parent.pop(keys[-1])
+            return _fields(doc), [_fields(row) for row in rows if isinstance(row, dict)]
+    return _fields(doc), []
+
+
+def score_invoice(predicted, expected):
+    header, rows = split_items(predicted)
+    expected_header, expected_rows = split_items(expected)
+    score = {'fields': len(expected_header),
+             'fields_matched': sum(1 for key, value in expected_header.items() if header.get(key) == value),
+             'items_expected': len(expected_rows), 'items_predicted': len(rows), 'items_exact': 0,
+             'item_fields': sum(len(row) for row in expected_rows), 'item_fields_matched': 0}
+    # Each expected row is paired with the unused predicted row that agrees on most fields
+    unused = list(range(len(rows)))
+    for expected_row in expected_rows:
+        best, best_matched = None, -1
+        for index in unused:
+            matched = sum(1 for key, value in expected_row.items() if rows[index].get(key) == value)
+            if matched > best_matched:
+                best, best_matched = index, matched
+        if best is None:
+            continue
+        unused.remove(best)
+        score['item_fields_matched'] += best_matched
+        if best_matched == len(expected_row):
+            score['items_exact'] += 1
+    return score
+
+
+def score_document(outputs, expected):
+    # Invoices are paired in order; a missing or failed invoice scores nothing
+    expected = expected if isinstance(expected, list) else [expected]
+    totals = score_invoice({}, {})
+    for index, expected_invoice in enumerate(expected):
+        predicted = outputs[index] if index < len(outputs) and 'error' not in outputs[index] else {}
+        for key, value in score_invoice(predicted, expected_invoice).items():
+            totals[key] += value
+    # Invoices found beyond the expected ones only count against line item precision
+    for extra in outputs[len(expected):]:
+        totals['items_predicted'] += len(split_items(extra)[1])
+    return totals
+
+
+def _price(model, prices):
+    if model in prices:
+        return prices[model]
+    # Fine-tuned models are billed by their base model
+    base = next((name for name in sorted(prices, key=len, reverse=True) if model.startswith(name)), None)
+    return prices.get(base)
+
+
+def summarize(name, model, records, prices, concurrency):
+    scores = {}
+    usage = {'input_tokens': 0, 'cached_tokens': 0, 'output_tokens': 0}
+    for record in records:
+        for key, value in (record.get('score') or {}).items():
+            scores[key] = scores.get(key, 0) + value
+        for output in record['outputs']:
+            for key in usage:
+                usage[key] += (output.get('token_usage') or {}).get(key, 0)
+    seconds = [record['seconds'] for record in records]
+    price = _price(model, prices)
+    cost = None
+    if price:
+        cost = ((usage['input_tokens'] - usage['cached_tokens']) * price[0] + usage['cached_tokens'] * price[1]
+                + usage['output_tokens'] * price[2]) / 1_000_000
+
+    def ratio(numerator, denominator):
+        return round(scores.get(numerator, 0) / scores[denominator], 4) if scores.get(denominator) else None
+
+    return {
+        'variant': name,
+        'model': model,
+        'documents': len(records),
+        'failed': sum(1 for record in records if any('error' in output for output in record['outputs'])),
+        'cached': sum(1 for record in records if record['cached']),
+        'field_accuracy': ratio('fields_matched', 'fields'),
+        'line_item_field_accuracy': ratio('item_fields_matched', 'item_fields'),
+        'line_item_precision': ratio('items_exact', 'items_predicted'),
+        'line_item_recall': ratio('items_exact', 'items_expected'),
+        'latency_seconds': {f"p{int(fraction * 100)}": round(percentile(seconds, fraction), 3) if seconds else None
+                            for fraction in (0.5, 0.9, 0.95, 0.99)},
+        'concurrency': concurrency,
+        'token_usage': usage,
+        'tokens_per_document': round(sum(usage.values()) / len(records), 1) if records else None,
+        'cost_usd': round(cost, 4) if cost is not None else None,
+        'cost_per_document_usd': round(cost / len(records), 5) if cost is not None and records else None,
+    }
+
+
+def evaluate_round(variants, corpus, api_key, cache_dir, concurrency, refresh):
+    # Variants of different apps run side by side. Each app has one MODEL setting, so
+    # evaluate() gives every model of an app its own round.
+    caches, pipelines, pending, records = {}, {}, [], {}
+    for target, model in variants:
+        module = load_target(target)
+        model = model or module.MODEL
+        if target == 'integrated':
+            module.MODEL = model
+            module.API_KEY = api_key
+        name = f"{target}@{model}"
+        if target != 'integrated':
+            # The app's own pipeline would learn templates and page fingerprints from the
+            # corpus and cache its outputs, changing what later variants are measured on
+            pipelines[name] = module.pipeline.without_stores(model, api_key)
+        settings = variant_settings(target, model)
+        caches[name] = OutputCache(cache_dir, name, variant_key(settings))
+        records[name] = []
+        for document in corpus:
+            if target not in document['truth']:
+                continue
+            pdf_hash = content_hash(document['path'])
+            cached = None if refresh else caches[name].get(pdf_hash)
+            if cached:
+                records[name].append({**cached, 'cached': True, 'truth': document['truth'][target]})
+            else:
+                pending.append((name, target, document, pdf_hash))
+
+    def run(task):
+        name, target, document, pdf_hash = task
+        start = time.perf_counter()
+        try:
+            outputs = run_extractor(target, document['path'], api_key, pipelines.get(name))
+        except Exception as e:
+            print(f"Error extracting {document['path']} with {name}: {e}")
+            outputs = [{'error': str(e)}]
+        entry = {'pdf_hash': pdf_hash, 'filename': os.path.basename(document['path']), 'outputs': outputs,
+                 'seconds': time.perf_counter() - start}
+        # Failed extractions are not cached, a rerun tries them again
+        if not any('error' in output for output in outputs):
+            caches[name].put(entry)
+        return name, {**entry, 'cached': False, 'truth': document['truth'][target]}
+
+    if pending:
+        print(f"Extracting {len(pending)} document(s) with {', '.join(records)}")
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for name, record in pool.map(run, pending):
+            records[name].append(record)
+    for name, name_records in records.items():
+        for record in name_records:
+            record['score'] = score_document(record['outputs'], record.pop('truth'))
+    return records
+
+
+def evaluate(variants, corpus, api_key, cache_dir=EVAL_CACHE_DIR, concurrency=DEFAULT_CONCURRENCY, refresh=False,
+             prices=PRICES):
+    rounds = []
+    for target, model in variants:
+        for round_variants in rounds:
+            if all(existing[0] != target for existing in round_variants):
+                round_variants.append((target, model))
+                break
+        else:
+            rounds.append([(target, model)])
+    reports = []
+    for round_variants in rounds:
+        for name, records in evaluate_round(round_variants, corpus, api_key, cache_dir, concurrency, refresh).items():
+            reports.append(summarize(name, name.split('@', 1)[1], records, prices, concurrency))
+    return reports
+
+
+def _percent(value):
+    return '-' if value is None else f"{value:.1%}"
+
+
+def print_reports(reports):
+    print(f"\n{'variant':<36}{'docs':>5}{'fail':>5}{'fields':>8}{'items':>8}{'item P':>8}{'item R':>8}"
+          f"{'p50 s':>8}{'p95 s':>8}{'p99 s':>8}{'tok/doc':>9}{'$/doc':>9}")
+    for report in reports:
+        latency = report['latency_seconds']
+        cost = '-' if report['cost_per_document_usd'] is None else f"{report['cost_per_document_usd']:.4f}"
+        print(f"{report['variant'][:35]:<36}{report['documents']:>5}{report['failed']:>5}"
+              f"{_percent(report['field_accuracy']):>8}{_percent(report['line_item_field_accuracy']):>8}"
+              f"{_percent(report['line_item_precision']):>8}{_percent(report['line_item_recall']):>8}"
+              f"{latency['p50'] or '-':>8}{latency['p95'] or '-':>8}{latency['p99'] or '-':>8}"
+              f"{report['tokens_per_document'] or '-':>9}{cost:>9}")
+    print("\nLatency of cached documents is the one measured when they were extracted.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score extractor variants on a labelled corpus for accuracy, "
+                                                 "latency and token cost")
+    parser.add_argument('corpus', help="folder of invoice PDFs, each with a ground truth JSON file next to it")
+    parser.add_argument('--variants', nargs='+', type=parse_variant, default=[('integrated', None), ('vlm', None)],
+                        metavar='TARGET[@MODEL]', help=f"targets: {', '.join(APP_MODULES)}")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help="documents extracted at once")
+    parser.add_argument('--cache-dir', default=EVAL_CACHE_DIR)
+    parser.add_argument('--refresh', action='store_true', help="ignore cached model outputs and extract again")
+    parser.add_argument('--api-key', default=OPENAI_API_KEY)
+    parser.add_argument('--prices', default=None, help="JSON file of {model: [input, cached input, output]} "
+                                                       "USD per million tokens")
+    parser.add_argument('--mock', action='store_true', help="answer model calls from the offline mock server")
+    parser.add_argument('--json', default=None, help="also write the report to this file")
+    args = parser.parse_args()
+
+    prices = dict(PRICES)
+    if args.prices:
+        with open(args.prices) as f:
+            prices.update({model: tuple(price) for model, price in json.load(f).items()})
+    server = MockOpenAIServer(latency=0.2, jitter=0.1).start() if args.mock else None
+    if not args.api_key and not args.mock:
+        parser.error("--api-key or OPENAI_API_KEY is required unless --mock is given")
+
+    corpus = load_labelled_corpus(args.corpus, {target for target, _ in args.variants})
+    print(f"{len(corpus)} labelled PDF(s) in {args.corpus}")
+    reports = evaluate(args.variants, corpus, args.api_key or 'offline-evaluation', args.cache_dir,
+                       args.concurrency, args.refresh, prices)
+    print_reports(reports)
+    if server:
+        server.stop()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import json
+import os
+
+from flask import Flask, Response, jsonify, request
+from flask_cors import CORS
+
+from extraction_cache import ExtractionCache
+from extraction_pipeline import ExtractionPipeline
+from invoice_routes import create_invoice_routes
+from job_queue import JobQueue
+from metrics import init_metrics, stage
+from mongo_writer import InvoiceWriter, create_client
+from page_dedup import PageIndex
+from pdf_pages import start_image_budget
+from pre_extract import PreExtractStats
+from response_cache import ResponseCache
+from uploads import init_uploads, upload_source
+from vendor_templates import VendorTemplates
+from worker_pools import map_as_completed, map_in_order
+
+
+# The Flask app around the extraction pipeline: its stores, the extraction, job and stats
+# endpoints and the invoice routes. flask_multi, flask_vlm and flask_perf_score only
+# configure it with their variant, model and pipeline options.
+class ExtractionApp:
+    def __init__(self, import_name, variant, model, api_key, **pipeline_options):
+        self.variant = variant
+        self.app = Flask(import_name)
+        CORS(self.app)
+        init_metrics(self.app)
+        init_uploads(self.app)
+
+        self.db = create_client()['invoiceDB']
+        self.collection = self.db['invoices']
+        self.extraction_cache = ExtractionCache(self.db['extraction_cache'])
+        # Invoice reads are cached until the invoice, or for lists any invoice, is written
+        self.response_cache = ResponseCache()
+        self.invoice_writer = InvoiceWriter(self.collection, on_write=self.response_cache.invalidate)
+        self.pre_extract_stats = PreExtractStats()
+        self.vendor_templates = VendorTemplates(self.db['vendor_templates'], self.db['layouts'])
+        self.page_index = PageIndex(self.db['page_fingerprints'])
+        self.pipeline = ExtractionPipeline(variant, model, api_key, extraction_cache=self.extraction_cache,
+                                           invoice_writer=self.invoice_writer,
+                                           vendor_templates=self.vendor_templates, page_index=self.page_index,
+                                           pre_extract_stats=self.pre_extract_stats, **pipeline_options)
+        # Workers are started by run(), or under a WSGI server by job_queue.py
+        self.job_queue = JobQueue(self.db['jobs'], self.pipeline.process_pdf, variant)
+
+        self._add_routes()
+        # Corrected invoices teach the vendor template where each field really is
+        self.app.register_blueprint(create_invoice_routes(
+            self.collection,
+            on_update=lambda filename: self.vendor_templates.learn_from_invoice_later(self.collection, variant,
+                                                                                      filename),
+            response_cache=self.response_cache, invoice_writer=self.invoice_writer))
+
+    def _add_routes(self):
+        app, pipeline, invoice_writer, job_queue = self.app, self.pipeline, self.invoice_writer, self.job_queue
+
+        @app.route('/extract_invoice_json', methods=['POST'])
+        def extract_invoice_json():
+            if 'files' not in request.files:
+                return jsonify({'error': 'No files uploaded'}), 400
+            with stage('upload_read'):
+                files = [(uploaded_file.filename, upload_source(uploaded_file))
+                         for uploaded_file in request.files.getlist('files')]
+            if request.args.get('stream'):
+                # One NDJSON line per file, written as soon as that file is done
+                def generate():
+                    start_image_budget()
+                    for index, result in map_as_completed(pipeline.process_pdf, files):
+                        yield json.dumps({'index': index, 'result': result}, default=str) + '\n'
+                    invoice_writer.flush()
+                return Response(generate(), mimetype='application/x-ndjson')
+
+            # The files of one request share its page image budget
+            start_image_budget()
+            results = map_in_order(pipeline.process_pdf, files)
+            # Writes are batched, but the client expects to list its new invoices right away
+            invoice_writer.flush()
+
+            return jsonify(results)
+
+        @app.route('/submit_invoices', methods=['POST'])
+        def submit_invoices():
+            if 'files' not in request.files:
+                return jsonify({'error': 'No files uploaded'}), 400
+
+            try:
+                job_id = job_queue.submit(request.files.getlist('files'))
+            except Exception as e:
+                print(f"Error submitting job: {e}")
+                return jsonify({'error': 'Failed to submit job'}), 500
+            return jsonify({'job_id': job_id}), 202
+
+        @app.route('/job_status/<job_id>', methods=['GET'])
+        def job_status(job_id):
+            job = job_queue.status(job_id)
+            if job:
+                return jsonify(job)
+            else:
+                return jsonify({'error': 'Job not found'}), 404
+
+        stats = {
+            '/cache_stats': ('cache_stats', self.extraction_cache),
+            '/pre_extract_stats': ('get_pre_extract_stats', self.pre_extract_stats),
+            '/template_stats': ('template_stats', self.vendor_templates),
+            '/response_cache_stats': ('response_cache_stats', self.response_cache),
+            '/page_dedup_stats': ('page_dedup_stats', self.page_index),
+        }
+        for rule, (endpoint, source) in stats.items():
+            app.add_url_rule(rule, endpoint, lambda source=source: jsonify(source.stats()), methods=['GET'])
+
+    def run(self):
+        # Jobs left unfinished by the previous process resume at startup. The debug reloader's
+        # watcher process runs this as well but never serves requests.
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            self.job_queue.start()
+        self.app.run(host='127.0.0.1', port=5000, debug=True)
@@ -0,0 +1,105 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+CACHE_MAX_ENTRIES = 512
+CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+
+
+def content_hash(pdf):
+    # pdf is the PDF's bytes or a file path; spooled uploads were hashed as they arrived
+    if isinstance(pdf, bytes):
+        return hashlib.sha256(pdf).hexdigest()
+    if getattr(pdf, 'sha256', None):
+        return pdf.sha256
+    digest = hashlib.sha256()
+    with open(pdf, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(pdf_hash, variant, model, prompt_version):
+    # The same PDF extracted by a different app, model or prompt is a different result
+    return hashlib.sha256(f"{pdf_hash}|{variant}|{model}|{prompt_version}".encode()).hexdigest()
+
+
+# Two tier cache of extraction results: a bounded in-process LRU in front of a
+# MongoDB collection whose documents are evicted by a TTL index.
+class ExtractionCache:
+    def __init__(self, collection, max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS):
+        self.collection = collection
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'mongo_hits': 0, 'misses': 0, 'stores': 0, 'errors': 0}
+        try:
+            self.collection.create_index('created_at', expireAfterSeconds=ttl_seconds)
+        except Exception as e:
+            print(f"Error creating TTL index for extraction cache: {e}")
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _remember(self, key, value, stored_at):
+        with self._lock:
+            self._entries[key] = (value, stored_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[1] < self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self._stats['memory_hits'] += 1
+                return entry[0]
+            if entry:
+                del self._entries[key]
+
+        try:
+            doc = self.collection.find_one({'_id': key})
+        except Exception as e:
+            print(f"Error reading extraction cache from MongoDB: {e}")
+            self._count('errors')
+            doc = None
+
+        if doc:
+            created_at = doc['created_at'].replace(tzinfo=timezone.utc).timestamp()
+            # The TTL monitor only runs once a minute, so expired documents can still be returned
+            if now - created_at < self.ttl_seconds:
+                self._remember(key, doc['result'], created_at)
+                self._count('mongo_hits')
+                return doc['result']
+
+        self._count('misses')
+        return None
+
+    def put(self, key, value):
+        self._remember(key, value, time.time())
+        try:
+            self.collection.replace_one(
+                {'_id': key},
+                {'result': value, 'created_at': datetime.now(timezone.utc)},
+                upsert=True
+            )
+        except Exception as e:
+            print(f"Error writing extraction cache to MongoDB: {e}")
+            self._count('errors')
+            return
+        self._count('stores')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_entries'] = len(self._entries)
+        hits = stats['memory_hits'] + stats['mongo_hits']
+        lookups = hits + stats['misses']
+        stats['hit_rate'] = round(hits / lookups, 4) if lookups else 0.0
+        return stats
@@ -0,0 +1,199 @@
+import copy
+import json
+
+from chunking import chunk_tag, merge_windows, run_windows, total_usage
+from extraction_cache import cache_key, content_hash
+from invoice_split import part_filename, part_info, part_pdf, split_pdf
+from metrics import stage
+from openai_pool import chat_completion
+from page_dedup import dedup_report, page_bytes
+from pdf_pages import image_options_tag, read_pdf_pages, stream_pdf_pages
+from pre_extract import all_required_resolved, apply_fields, hint_text, pre_extract, pre_extract_tag
+from prompts import build_messages, page_contents, prompt_version, token_usage
+from refine_fields import refine_low_confidence, refine_tag
+from vendor_templates import page_layout
+from worker_pools import map_parts
+
+# Error messages as each app has always reported them
+READ_ERRORS = {'multi': 'Could not read text from PDF'}
+MODEL_ERRORS = {'multi': 'Could not get response from AI'}
+DEFAULT_READ_ERROR = 'Could not convert PDF pages to images'
+DEFAULT_MODEL_ERROR = 'Could not extract data using VLM'
+
+
+# The extraction pipeline shared by the Flask apps: invoice splitting, the extraction
+# cache, boilerplate page skipping, page routing, rule-based pre-extraction, vendor
+# templates, windowed model calls and the write-behind save. The apps differ in their
+# output schema (variant), models, how pages are put into the prompt (content) and
+# request options. Stores left as None are skipped: nothing is cached, learned or saved.
+class ExtractionPipeline:
+    def __init__(self, variant, model, api_key, vision_model=None, content=page_contents, request_options=None,
+                 refine=False, extraction_cache=None, invoice_writer=None, vendor_templates=None, page_index=None,
+                 pre_extract_stats=None):
+        self.variant = variant
+        self.model = model
+        self.api_key = api_key
+        # Used instead of model for windows where some pages are sent as images
+        self.vision_model = vision_model
+        self.content = content
+        self.request_options = request_options or {}
+        # Fields the model was unsure of are read again from high resolution crops
+        self.refine = refine
+        self.extraction_cache = extraction_cache
+        self.invoice_writer = invoice_writer
+        self.vendor_templates = vendor_templates
+        self.page_index = page_index
+        self.pre_extract_stats = pre_extract_stats
+
+    def variant_tag(self):
+        # Anything that changes what the model sees gets its own cache entries
+        tag = f"{self.variant}/{image_options_tag()}/{pre_extract_tag()}/{chunk_tag()}"
+        return f"{tag}/{refine_tag()}" if self.refine else tag
+
+    def cache_key(self, pdf_hash):
+        models = f"{self.model}+{self.vision_model}" if self.vision_model else self.model
+        return cache_key(pdf_hash, self.variant_tag(), models, prompt_version(self.variant))
+
+    def without_stores(self, model=None, api_key=None):
+        # The same extraction, optionally with another model, that reads and writes no
+        # cache, template, page fingerprint or invoice, e.g. for evaluations
+        pipeline = copy.copy(self)
+        pipeline.model = model or self.model
+        pipeline.api_key = api_key or self.api_key
+        pipeline.extraction_cache = pipeline.invoice_writer = pipeline.vendor_templates = None
+        pipeline.page_index = pipeline.pre_extract_stats = None
+        return pipeline
+
+    def _cached(self, key):
+        if not self.extraction_cache:
+            return None
+        with stage('cache_lookup'):
+            return self.extraction_cache.get(key)
+
+    def call_model(self, pages, hints=None):
+        model = self.vision_model if self.vision_model and any('image' in page for page in pages) else self.model
+        try:
+            with stage('prompt_build'):
+                messages = build_messages(self.variant, self.content(pages), hints)
+            return chat_completion(self.api_key, model=model, messages=messages, **self.request_options)
+        except Exception as e:
+            print(f"Error in {self.variant} extraction with {model}: {e}")
+            return None
+
+    def process_pdf(self, item):
+        # {filename: result} for an uploaded PDF, with one entry per invoice when it holds several
+        filename, pdf = item
+        if not filename.lower().endswith('.pdf'):
+            return {filename: {'error': 'Invalid file type. Only PDF files are supported'}}
+        pdf_hash = content_hash(pdf)
+        key = self.cache_key(pdf_hash)
+        cached = self._cached(key)
+        if cached:
+            # A split PDF is cached as the results of all its invoices
+            return cached['invoices'] if set(cached) == {'invoices'} else {filename: cached}
+
+        # A PDF holding several invoices is split, and its invoices are extracted side by side
+        # and stored as separate documents
+        try:
+            with stage('invoice_split'):
+                invoices = split_pdf(pdf)
+        except Exception as e:
+            print(f"Error splitting PDF into invoices: {e}")
+            invoices = [None]
+        if len(invoices) == 1:
+            return self.process_invoice(filename, pdf, pdf_hash, key)
+        parts = [(part_filename(filename, index), part_pdf(pdf, invoice['pages']),
+                  part_info(filename, index, invoices)) for index, invoice in enumerate(invoices)]
+        results = {}
+        for result in map_parts(self._process_part, parts):
+            results.update(result)
+        if self.extraction_cache and not any('error' in result for result in results.values()):
+            self.extraction_cache.put(key, {'invoices': results})
+        return results
+
+    def _process_part(self, item):
+        filename, pdf, part = item
+        pdf_hash = content_hash(pdf)
+        key = self.cache_key(pdf_hash)
+        cached = self._cached(key)
+        if cached:
+            return {filename: cached}
+        return self.process_invoice(filename, pdf, pdf_hash, key, part)
+
+    def process_invoice(self, filename, pdf, pdf_hash, key, part=None):
+        # Pages a vendor attaches to every invoice are recognised before anything is rendered
+        page_match = {'vendor_gstin': None, 'pages': [], 'skip': {}}
+        if self.page_index:
+            with stage('page_dedup'):
+                page_match = self.page_index.match(pdf)
+        routed = read_pdf_pages(pdf, skip_pages=page_match['skip'])
+        if not routed or not routed[1]:
+            return {filename: {'error': READ_ERRORS.get(self.variant, DEFAULT_READ_ERROR)}}
+        pdf, pages = routed
+        # Page sizes as sent, for page_index; rendered pages are added as they stream past
+        sizes = {page['page']: page_bytes(page) for page in pages if 'text' in page}
+
+        pdf_text = "".join(page['text'] for page in pages if 'text' in page)
+        # Strictly formatted fields are read locally; the model only fills in the rest
+        with stage('pre_extract'):
+            local_fields = pre_extract(pdf_text)
+        # Repeat vendors are read from the boxes learned for their layout
+        template_data = layout = None
+        if self.vendor_templates:
+            with stage('template_match'):
+                layout = page_layout(pdf)
+                self.vendor_templates.remember_layout(pdf_hash, layout)
+                template_data = self.vendor_templates.extract(self.variant, layout, local_fields)
+        skip_model = template_data is not None or all_required_resolved(self.variant, local_fields)
+        if self.pre_extract_stats:
+            self.pre_extract_stats.record(local_fields, skip_model)
+        if template_data is not None:
+            json_data = {**template_data, 'token_usage': token_usage(None)}
+        elif skip_model:
+            json_data = {'token_usage': token_usage(None)}
+        else:
+            # Pages without a text layer are rendered only now, each window going to the model
+            # as soon as its pages are ready. Long documents are sent as overlapping page
+            # windows and merged afterwards.
+            def rendered():
+                for page in stream_pdf_pages(pdf, pages):
+                    sizes[page['page']] = page_bytes(page)
+                    yield page
+            try:
+                outputs = run_windows(rendered(), self.call_model, hint_text(self.variant, local_fields),
+                                      page_count=len(pages))
+            except Exception as e:
+                print(f"Error converting PDF pages to images: {e}")
+                return {filename: {'error': READ_ERRORS.get(self.variant, DEFAULT_READ_ERROR)}}
+            if not all(output for _, output in outputs):
+                return {filename: {'error': MODEL_ERRORS.get(self.variant, DEFAULT_MODEL_ERROR)}}
+            try:
+                with stage('json_decode'):
+                    docs = [json.loads(output.choices[0].message.content) for _, output in outputs]
+            except json.JSONDecodeError:
+                return {filename: {'error': 'Error converting response to JSON'}}
+            if not all(isinstance(doc, dict) for doc in docs):
+                return {filename: {'error': 'Error converting response to JSON'}}
+            json_data = merge_windows(self.variant, docs, [window for window, _ in outputs])
+            json_data['token_usage'] = total_usage(token_usage(output) for _, output in outputs)
+
+        apply_fields(json_data, self.variant, local_fields)
+        if not skip_model:
+            if self.refine:
+                refine_low_confidence(self.api_key, self.model, pdf, json_data)
+            if self.vendor_templates:
+                self.vendor_templates.learn(self.variant, layout, json_data)
+        json_data['filename'] = filename  # Ensure filename is included
+        if self.page_index:
+            self.page_index.learn(page_match, sizes, pdf_hash)
+        report = dedup_report(page_match)
+        if report:
+            json_data['page_dedup'] = report
+        if part:
+            json_data.update(part)
+        if not self.invoice_writer:
+            return {filename: json_data}
+        result = {**json_data, '_id': self.invoice_writer.save(json_data, pdf_hash, self.variant)}
+        if self.extraction_cache:
+            self.extraction_cache.put(key, result)
+        return {filename: result}
@@ -1,15 +1,33 @@
 import fitz
-from openai import OpenAI
+import argparse
 import json
 import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from bulk_batch import BulkRun, LocalBatchBackend, OpenAIBatchBackend
+from chunking import CHUNK_MIN_PAGES, merge_windows, page_windows, run_windows, total_usage, window_hints
+from invoice_split import part_filename, part_info, split_text
+from metrics import stage, stage_summary
+from openai_pool import chat_completion
+from prompts import build_messages, token_usage
+from watch_folder import FolderWatcher, WatchState
+from worker_pools import map_parts
+
+API_KEY = "YOUR_API_KEY"
+PDF_FOLDER_PATH = r"C:\Users\RUDRA\Desktop\INVOICE PROCESSING\invoices_in_pdf"
+JSON_FOLDER_PATH = r"C:\Users\RUDRA\Desktop\INVOICE PROCESSING\invoices_in_json"
+MANIFEST_FILENAME = "batch_manifest.jsonl"
+WATCH_STATE_FILENAME = "watch_state.jsonl"
+BULK_WORK_DIRNAME = "bulk_work"
+MODEL = "gpt-3.5-turbo-0125"
 
 def read_text_from_pdf(pdf_path):
     try:
-        text = ""
-        doc = fitz.open(pdf_path)
-        for page in doc:
-            text += page.get_text()
-        doc.close()
+        with stage('text_extract'):
+            doc = fitz.open(pdf_path)
+            # Pages are separated by form feeds so long documents can be split into windows
+            text = "\f".join(page.get_text() for page in doc)
+            doc.close()
         return text
     except Exception as e:
         print(f"Error in reading pdf: {e}")
@@ -31,68 +49,358 @@ def read_text_from_pdfs_in_folder(pdf_folder_path):
         print(f"Error in processing folder: {e}")
         return None
 
-def chat_with_AI(api_key, text):
+def chat_with_AI(api_key, text, hints=None):
     try:
-        client = OpenAI(api_key=api_key)
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo-0125",
-            messages=[
-                  {"role": "user", "content": text},
-                 {"role": "user", "content": "Please extract the following details from the invoice text:"},
-                 {"role": "user", "content": "1. Invoice date (format: YYYY-MM-DD)"},
-                 {"role": "user", "content": "2. Invoice number"},
-                 {"role": "user", "content": "3. Purchase order number"},
-                 {"role": "user", "content": "4. Purchase date (format: YYYY-MM-DD)"},
-                 {"role": "user", "content": "5. Purchaser address"},
-                 {"role": "user", "content": "6. List of items (name, quantity, unit price, total price)"},
-                 {"role": "user", "content": "7. PAN ID"},
-                 {"role": "user", "content": "8. GST number"},
-                 {"role": "user", "content": "9. Total amount including GST"},
-                 {"role": "user", "content": "Output the results as a single JSON object in one line without any backslashes. If an attribute has a value of 0, include it in the output with the value 0."},
-                 {"role": "user", "content": "If the invoice spans multiple pages or there are multiple invoices in one PDF but share the same address and ID, merge them into a single invoice."},
-                 {"role": "user", "content": "For all price and quantity values, ensure they are in number format (not string format). For example, \"quantity\": 2 and \"unit_price\": 100.00."},
-                 {"role": "user", "content": "Replace any special characters or symbols such as '\u20b9' with 'Rs.' throughout the document."},
-                 {"role": "user", "content": "The currency has to be mentioned seperately just before the list of items "},
-                 {"role": "user", "content": "Here is an example of the expected JSON format: {\"invoice_date\": \"2023-05-21\", \"invoice_number\": \"INV123456\", \"purchase_order_number\": \"PO654321\", \"purchase_date\": \"2023-05-20\", \"purchaser_address\": \"123 Street Name, City, State, ZIP\", \"items\": [{\"name\": \"Item1\", \"quantity\": 2, \"unit_price\": 100, \"total_price\": 200}, {\"name\": \"Item2\", \"quantity\": 0, \"unit_price\": 0, \"total_price\": 0}], \"pan_id\": \"ABCDE1234F\", \"gst_number\": \"12ABCDE3456F1Z1\", \"total_amount_with_gst\": 230.50}."},
-                 {"role": "user", "content": "Provide only the JSON output in the specified format."},
-                 {"role": "user", "content": "If any required fields are missing or empty, set their values to 'N/A'."},
-                 {"role": "user", "content": "Sum the 'total price' of all items to verify it matches the 'total amount with GST'."}
-  
-        ]
+        with stage('prompt_build'):
+            messages = build_messages('integrated', text, hints)
+        response = chat_completion(
+            api_key,
+            model=MODEL,
+            messages=messages
         )
-        return response.choices[0]
+        return response
     except Exception as e:
         print(f"Error in generating response from AI: {e}")
         return None
 
+def extract_invoice(api_key, pdf_text):
+    # Returns (JSON text, token usage), with None for the text when a model call failed.
+    # Long documents are sent as overlapping page windows and merged here.
+    pages = [{'page': number, 'text': text} for number, text in enumerate(pdf_text.split("\f"))]
+    outputs = run_windows(pages, lambda window_pages, hints: chat_with_AI(
+        api_key, "".join(page['text'] for page in window_pages), hints))
+    usage = total_usage(token_usage(output) for _, output in outputs)
+    if not all(output for _, output in outputs):
+        return None, usage
+    contents = [output.choices[0].message.content for _, output in outputs]
+    if len(contents) == 1:
+        return contents[0], usage
+    try:
+        with stage('json_decode'):
+            docs = [json.loads(content) for content in contents]
+    except json.JSONDecodeError:
+        # Passed on as is, convert_txt_to_json reports it
+        return next(content for content in contents if not _is_json(content)), usage
+    return json.dumps(merge_windows('integrated', docs, [window for window, _ in outputs])), usage
+
+def extract_invoices(api_key, filename, pdf_text):
+    # [(JSON filename, JSON text, token usage)], one entry per invoice in the PDF. The
+    # invoices of a multi-invoice PDF are extracted side by side and each is written to
+    # its own file, linked to the PDF by parent_filename.
+    page_texts = pdf_text.split("\f")
+    invoices = split_text(page_texts)
+    if len(invoices) == 1:
+        json_text, usage = extract_invoice(api_key, pdf_text)
+        return [(filename.replace('.pdf', '.json'), json_text, usage)]
+
+    def extract_part(index):
+        start, end = invoices[index]['pages']
+        json_text, usage = extract_invoice(api_key, "\f".join(page_texts[start:end]))
+        if json_text and _is_json(json_text):
+            json_text = json.dumps({**json.loads(json_text), **part_info(filename, index, invoices)})
+        return part_filename(filename, index).replace('.pdf', '.json'), json_text, usage
+
+    return map_parts(extract_part, range(len(invoices)))
+
+def _is_json(text):
+    try:
+        json.loads(text)
+        return True
+    except json.JSONDecodeError:
+        return False
+
 def convert_txt_to_json(json_text, json_folder, filename):
     try:
-        json_data = json.loads(json_text)
+        with stage('json_decode'):
+            json_data = json.loads(json_text)
         json_path = os.path.join(json_folder, filename)
         with open(json_path, 'w') as json_file:
             json.dump(json_data, json_file, indent=4)
         print(f"Successfully converted to {json_path}")
+        return True
     except Exception as e:
         print(f"An error occurred: {e}")
+        return False
 
 def main():
     try:
-        api_key = "YOUR_API_KEY"
-        pdf_folder_path =r"C:\Users\RUDRA\Desktop\INVOICE PROCESSING\invoices_in_pdf"
-        json_folder_path =r"C:\Users\RUDRA\Desktop\INVOICE PROCESSING\invoices_in_json"
+        api_key = API_KEY
+        pdf_folder_path = PDF_FOLDER_PATH
+        json_folder_path = JSON_FOLDER_PATH
         
         pdf_texts = read_text_from_pdfs_in_folder(pdf_folder_path)
         
         for filename, pdf_text in pdf_texts.items():
-            output = chat_with_AI(api_key, pdf_text)
-            if output:
-                json_filename = filename.replace('.pdf', '.json')
-                convert_txt_to_json(output.message.content, json_folder_path, json_filename)
-                
-            else:
-                print(f"Could not get response for PDF")
+            for json_filename, json_text, usage in extract_invoices(api_key, filename, pdf_text):
+                if json_text:
+                    convert_txt_to_json(json_text, json_folder_path, json_filename)
+                    
+                else:
+                    print(f"Could not get response for PDF")
+        print_stage_summary()
     except Exception as e:
             print(f"Error occurred: {e}")
 
+def convert_pdf_text(api_key, filename, pdf_text, json_folder_path):
+    # (status, error, token usage); a PDF is done once every invoice in it is written
+    results = extract_invoices(api_key, filename, pdf_text)
+    usage = total_usage(usage for _, _, usage in results)
+    for json_filename, json_text, _ in results:
+        if not json_text:
+            return 'failed', 'Could not get response from AI', usage
+        if not convert_txt_to_json(json_text, json_folder_path, json_filename):
+            return 'failed', 'Error converting response to JSON', usage
+    return 'done', None, usage
+
+def bulk_requests(filename, pdf_text):
+    # [(request body, meta)] for the batch endpoint: one request per page window of each
+    # invoice in the PDF, with what is needed to put the answers back together
+    page_texts = pdf_text.split("\f")
+    invoices = split_text(page_texts)
+    requests = []
+    for index, invoice in enumerate(invoices):
+        start, end = invoice['pages']
+        pages = page_texts[start:end]
+        json_filename = (part_filename(filename, index) if len(invoices) > 1 else filename).replace('.pdf', '.json')
+        windows = page_windows(len(pages)) if len(pages) > CHUNK_MIN_PAGES else [(0, len(pages))]
+        for window in windows:
+            hints = window_hints(None, window, len(pages)) if len(windows) > 1 else None
+            text = "".join(pages[window[0]:window[1]])
+            body = {'model': MODEL, 'messages': build_messages('integrated', text, hints)}
+            requests.append((body, {'filename': filename, 'json_filename': json_filename, 'window': list(window),
+                                    'part': part_info(filename, index, invoices) if len(invoices) > 1 else None}))
+    return requests
+
+def merge_bulk_outputs(entries):
+    # JSON text for one invoice from the [(meta, content)] of its windows
+    entries = sorted(entries, key=lambda entry: entry[0]['window'][0])
+    contents = [content for _, content in entries]
+    part = entries[0][0]['part']
+    if len(contents) == 1 and not part:
+        return contents[0]
+    docs = [json.loads(content) for content in contents]
+    windows = [tuple(meta['window']) for meta, _ in entries]
+    doc = docs[0] if len(docs) == 1 else merge_windows('integrated', docs, windows)
+    return json.dumps({**doc, **part} if part else doc)
+
+def run_bulk(api_key, pdf_folder_path, json_folder_path, parse_workers, backend_name='openai', work_dir=None,
+             manifest_path=None):
+    # Overnight backfills through the batch endpoint: slower to finish, but cheaper and
+    # not bound by the per minute limits. Rerun with the same work folder to resume.
+    work_dir = work_dir or os.path.join(json_folder_path, BULK_WORK_DIRNAME)
+    manifest = BatchManifest(manifest_path or os.path.join(json_folder_path, MANIFEST_FILENAME))
+    if backend_name == 'local':
+        backend = LocalBatchBackend(os.path.join(work_dir, 'local_backend'),
+                                    lambda body: chat_completion(api_key, **body).model_dump())
+    else:
+        backend = OpenAIBatchBackend(api_key)
+    bulk = BulkRun(work_dir, backend, validate=_is_json)
+    counts = {'done': 0, 'failed': 0}
+
+    requests, meta = [], {}
+    if bulk.started:
+        print(f"Resuming bulk run in {work_dir}")
+    else:
+        pending = [filename for filename in sorted(os.listdir(pdf_folder_path))
+                   if filename.lower().endswith('.pdf') and not manifest.is_done(filename)]
+        with ProcessPoolExecutor(max_workers=parse_workers) as parse_pool:
+            pdf_texts = parse_pool.map(read_text_from_pdf, [os.path.join(pdf_folder_path, filename)
+                                                            for filename in pending])
+            for filename, pdf_text in zip(pending, pdf_texts):
+                if not pdf_text:
+                    manifest.record(filename, 'failed', 'Could not read text from PDF')
+                    counts['failed'] += 1
+                    continue
+                for body, info in bulk_requests(filename, pdf_text):
+                    custom_id = f"request-{len(requests)}"
+                    requests.append((custom_id, body))
+                    meta[custom_id] = info
+        if not requests:
+            manifest.close()
+            print("No PDFs to convert")
+            return counts
+        print(f"{len(requests)} request(s) for {len(pending)} PDF(s)")
+
+    results, errors = bulk.run(requests, meta)
+
+    # Back to one JSON file per invoice; a PDF is done once every invoice in it is written
+    pdfs = {}
+    for custom_id, info in bulk.meta.items():
+        pdfs.setdefault(info['filename'], {}).setdefault(info['json_filename'], []).append((custom_id, info))
+    for filename, invoices in pdfs.items():
+        status, error = 'done', None
+        usage = total_usage(results[custom_id]['token_usage'] for entries in invoices.values()
+                            for custom_id, _ in entries if custom_id in results)
+        for json_filename, entries in invoices.items():
+            failed = [errors[custom_id] for custom_id, _ in entries if custom_id in errors]
+            if failed:
+                status, error = 'failed', failed[0]
+                break
+            json_text = merge_bulk_outputs([(info, results[custom_id]['content']) for custom_id, info in entries])
+            if not convert_txt_to_json(json_text, json_folder_path, json_filename):
+                status, error = 'failed', 'Error converting response to JSON'
+                break
+        manifest.record(filename, status, error, usage)
+        counts[status] += 1
+    manifest.close()
+    bulk.finish()
+    print(f"Bulk run finished: {counts['done']} converted, {counts['failed']} failed")
+    return counts
+
+def print_stage_summary():
+    for name, totals in stage_summary().items():
+        print(f"{name}: {totals['count']} call(s), {totals['seconds']}s wall, {totals['cpu_seconds']}s cpu")
+
+# The manifest is an append-only JSON lines file, one line per finished file. The
+# last line for a filename wins, so a rerun can skip "done" files and retry the rest.
+def load_manifest(manifest_path):
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # A line cut short by a crash
+                manifest[entry['filename']] = entry
+    return manifest
+
+
+class BatchManifest:
+    def __init__(self, manifest_path):
+        self.entries = load_manifest(manifest_path)
+        self._file = open(manifest_path, 'a')
+        self._lock = threading.Lock()
+
+    def is_done(self, filename):
+        return self.entries.get(filename, {}).get('status') == 'done'
+
+    def record(self, filename, status, error=None, usage=None):
+        entry = {'filename': filename, 'status': status}
+        if error:
+            entry['error'] = error
+        if usage:
+            entry['token_usage'] = usage
+        with self._lock:
+            self.entries[filename] = entry
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def run_batch(api_key, pdf_folder_path, json_folder_path, parse_workers, ai_workers, manifest_path=None):
+    manifest_path = manifest_path or os.path.join(json_folder_path, MANIFEST_FILENAME)
+    manifest = BatchManifest(manifest_path)
+    pending = [filename for filename in sorted(os.listdir(pdf_folder_path))
+               if filename.lower().endswith('.pdf') and not manifest.is_done(filename)]
+    print(f"{len(pending)} PDF(s) to convert, {len(manifest.entries)} already in manifest")
+
+    # Bounds the number of files between parsing and a written JSON file, so parsed
+    # text never piles up in memory while the model calls are the bottleneck
+    in_flight = threading.BoundedSemaphore(ai_workers * 2)
+    counts = {'done': 0, 'failed': 0}
+    counts_lock = threading.Lock()
+
+    def finish(filename, status, error=None, usage=None):
+        # Always frees the file's slot, or the wait for in-flight files below never ends.
+        # A file the manifest could not record counts as failed; a rerun converts it again.
+        try:
+            try:
+                manifest.record(filename, status, error, usage)
+            except Exception as e:
+                print(f"Error recording {filename} in the manifest: {e}")
+                status = 'failed'
+            with counts_lock:
+                counts[status] += 1
+        finally:
+            in_flight.release()
+
+    def convert(filename, pdf_text):
+        try:
+            result = convert_pdf_text(api_key, filename, pdf_text, json_folder_path)
+        except Exception as e:
+            print(f"Error converting {filename}: {e}")
+            result = ('failed', str(e))
+        finish(filename, *result)
+
+    def parsed(filename, future):
+        try:
+            pdf_text = future.result()
+        except Exception as e:
+            pdf_text = None
+            print(f"Error in reading pdf: {e}")
+        if pdf_text:
+            ai_pool.submit(convert, filename, pdf_text)
+        else:
+            finish(filename, 'failed', 'Could not read text from PDF')
+
+    with ProcessPoolExecutor(max_workers=parse_workers) as parse_pool, \
+            ThreadPoolExecutor(max_workers=ai_workers) as ai_pool:
+        for filename in pending:
+            in_flight.acquire()
+            future = parse_pool.submit(read_text_from_pdf, os.path.join(pdf_folder_path, filename))
+            future.add_done_callback(lambda f, filename=filename: parsed(filename, f))
+        # Wait for every in-flight file before the pools shut down
+        for _ in range(ai_workers * 2):
+            in_flight.acquire()
+
+    manifest.close()
+    print(f"Batch finished: {counts['done']} converted, {counts['failed']} failed")
+    print_stage_summary()
+    return counts
+
+
+def run_watch(api_key, pdf_folder_path, json_folder_path, parse_workers, ai_workers, state_path=None):
+    # Runs until interrupted, converting PDFs as they arrive in the folder. The state
+    # file remembers converted files by path, size, mtime and hash across restarts.
+    state = WatchState(state_path or os.path.join(json_folder_path, WATCH_STATE_FILENAME))
+    with ProcessPoolExecutor(max_workers=parse_workers) as parse_pool:
+        def convert(path):
+            pdf_text = parse_pool.submit(read_text_from_pdf, path).result()
+            if not pdf_text:
+                return 'failed', 'Could not read text from PDF', None
+            return convert_pdf_text(api_key, os.path.basename(path), pdf_text, json_folder_path)
+
+        stats = FolderWatcher(pdf_folder_path, convert, state, ai_workers).run()
+    state.close()
+    print(f"Watch stopped: {stats['processed']} converted, {stats['failed']} failed, "
+          f"{stats['unchanged']} unchanged")
+    print_stage_summary()
+    return stats
+
+
+def cli(argv=None):
+    # The command line entry point; bench_offline.py runs it with its own arguments
+    parser = argparse.ArgumentParser(description="Convert a folder of PDF invoices to JSON files")
+    parser.add_argument('--batch', action='store_true', help="parallel, resumable batch mode")
+    parser.add_argument('--watch', action='store_true', help="keep running and convert PDFs as they arrive")
+    parser.add_argument('--bulk', action='store_true', help="submit through the batch endpoint and wait for it")
+    parser.add_argument('--bulk-backend', choices=('openai', 'local'), default='openai',
+                        help="local answers the batch files with regular calls, for tests and small runs")
+    parser.add_argument('--bulk-dir', default=None,
+                        help=f"bulk mode work folder (default: <json-folder>/{BULK_WORK_DIRNAME})")
+    parser.add_argument('--pdf-folder', default=PDF_FOLDER_PATH)
+    parser.add_argument('--json-folder', default=JSON_FOLDER_PATH)
+    parser.add_argument('--parse-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--ai-workers', type=int, default=8)
+    parser.add_argument('--manifest', default=None,
+                        help=f"manifest path (default: <json-folder>/{MANIFEST_FILENAME})")
+    parser.add_argument('--watch-state', default=None,
+                        help=f"watch mode state path (default: <json-folder>/{WATCH_STATE_FILENAME})")
+    args = parser.parse_args(argv)
+
+    if args.bulk:
+        run_bulk(API_KEY, args.pdf_folder, args.json_folder, args.parse_workers, args.bulk_backend, args.bulk_dir,
+                 args.manifest)
+    elif args.watch:
+        run_watch(API_KEY, args.pdf_folder, args.json_folder, args.parse_workers, args.ai_workers, args.watch_state)
+    elif args.batch:
+        run_batch(API_KEY, args.pdf_folder, args.json_folder, args.parse_workers, args.ai_workers, args.manifest)
+    else:
+        main()
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    cli()
\ No newline at end of file
@@ -5,11 +5,14 @@ interface Output {
   [key: string]: any;
 }
 
+const INVOICE_PAGE_SIZE = 100;
+
 const FileUploader: React.FC = () => {
   const [selectedFiles, setSelectedFiles] = useState<FileList | null>(null);
   const [output, setOutput] = useState<Output[]>([]);
   const [loading, setLoading] = useState<boolean>(false);
   const [invoices, setInvoices] = useState<string[]>([]);
+  const [nextInvoicesCursor, setNextInvoicesCursor] = useState<string | null>(null);
   const [selectedInvoice, setSelectedInvoice] = useState<string>("");
   const [invoiceData, setInvoiceData] = useState<Output | null>(null);
   const [showUploadedFiles, setShowUploadedFiles] = useState<boolean>(false);
@@ -18,10 +21,14 @@ const FileUploader: React.FC = () => {
     fetchInvoices();
   }, []);
 
-  const fetchInvoices = async () => {
+  // The list is paged by the server; `after` continues from the last invoice already loaded
+  const fetchInvoices = async (after: string | null = null) => {
     try {
-      const response = await axios.get<{ invoices: string[] }>("http://127.0.0.1:5000/list_invoices");
-      setInvoices(response.data.invoices);
+      const response = await axios.get<{ invoices: string[], next: string | null }>("http://127.0.0.1:5000/list_invoices", {
+        params: { limit: INVOICE_PAGE_SIZE, ...(after ? { after } : {}) }
+      });
+      setInvoices(prevInvoices => after ? [...prevInvoices, ...response.data.invoices] : response.data.invoices);
+      setNextInvoicesCursor(response.data.next);
     } catch (error) {
       console.error("Error fetching invoices:", error);
     }
@@ -46,14 +53,39 @@ const FileUploader: React.FC = () => {
     try {
       setLoading(true);
       setInvoiceData(null);
+      setOutput([]);
+      setShowUploadedFiles(true);
+      setSelectedInvoice("");
 
-      const response = await axios.post<Output[]>("http://127.0.0.1:5000/extract_invoice_json", formData, {
-        headers: { 'Content-Type': 'multipart/form-data' }
+      // The server streams one NDJSON line per file as soon as it is processed, so
+      // results are rendered while the rest of the batch is still running
+      const response = await fetch("http://127.0.0.1:5000/extract_invoice_json?stream=1", {
+        method: 'POST',
+        body: formData
       });
+      if (!response.ok || !response.body) {
+        throw new Error(`Upload failed with status ${response.status}`);
+      }
 
-      setOutput(response.data);
-      setShowUploadedFiles(true);
-      setSelectedInvoice("");
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split("\n");
+        buffer = lines.pop() ?? "";
+        for (const line of lines) {
+          if (!line.trim()) continue;
+          const { index, result } = JSON.parse(line) as { index: number, result: Output };
+          setOutput(prevOutput => {
+            const newOutput = [...prevOutput];
+            newOutput[index] = result;
+            return newOutput;
+          });
+        }
+      }
     } catch (error) {
       console.error("Error:", error);
       alert("An error occurred while uploading the file.");
@@ -88,6 +120,41 @@ const FileUploader: React.FC = () => {
     }
   }, [fetchInvoices]);
 
+  // Saves every edited upload result with one bulk request
+  const handleSubmitAll = useCallback(async (results: Output[]): Promise<void> => {
+    const invoicesToSave = results.filter(Boolean).flatMap(result =>
+      Object.entries(result)
+        .filter(([, data]) => data && !data.error)
+        .map(([filename, data]) => {
+          const { _id, ...fields } = data;
+          return { ...fields, filename };
+        })
+    );
+    if (invoicesToSave.length === 0) {
+      alert("There are no extracted invoices to save.");
+      return;
+    }
+
+    try {
+      const response = await axios.put("http://127.0.0.1:5000/update_invoices", invoicesToSave, {
+        headers: {
+          'Content-Type': 'application/json'
+        }
+      });
+
+      if (response.data.success) {
+        const notFound: string[] = response.data.not_found || [];
+        alert(notFound.length ? `Invoices updated, not found: ${notFound.join(", ")}` : "Invoices updated successfully!");
+        fetchInvoices();
+      } else {
+        alert(response.data.error || "Failed to update invoices.");
+      }
+    } catch (error) {
+      console.error("Error updating invoices:", error);
+      alert("An error occurred while updating the invoices.");
+    }
+  }, [fetchInvoices]);
+
   const handleInvoiceChange = useCallback((event: ChangeEvent<HTMLSelectElement>): void => {
     const selectedFilename = event.target.value;
 
@@ -111,7 +178,7 @@ const FileUploader: React.FC = () => {
 
   const renderFormFields = (data: Output, onChange: (newValue: any, key: string) => void) => {
     return Object.keys(data).map((key, index) => {
-      if (key === "_id" || key === "filename") return null;
+      if (key === "_id" || key === "filename" || key === "token_usage" || key === "content_hash" || key === "chunking" || key === "invoice_part" || key === "refinement" || key === "page_dedup") return null;
 
       const value = data[key];
 
@@ -229,6 +296,9 @@ const FileUploader: React.FC = () => {
               <option key={index} value={filename}>{filename}</option>
             ))}
           </select>
+          {nextInvoicesCursor && (
+            <button type='button' onClick={() => fetchInvoices(nextInvoicesCursor)} className='a2'>Load more</button>
+          )}
         </div>
 
         <div className='no-list-box'>
@@ -251,7 +321,7 @@ const FileUploader: React.FC = () => {
             </div>
           )}
 
-          {showUploadedFiles && output.map((result, index) => (
+          {showUploadedFiles && output.map((result, index) => result && (
             <div key={index} className='main'>
               
               <form className='form1'>
@@ -273,6 +343,9 @@ const FileUploader: React.FC = () => {
               </form>
             </div>
           ))}
+          {showUploadedFiles && output.some(Boolean) && (
+            <button type='button' onClick={() => handleSubmitAll(output)} className='submit'>Save all</button>
+          )}
         </div>
       </div>
     </div>
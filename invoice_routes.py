@@ -0,0 +1,177 @@
+import json
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from pymongo import ASCENDING
+
+from memory_mongo import update_op
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Only fields some query filters on: every index slows down each invoice upsert.
+# Listing pages by _id needs none, and mongo_writer indexes (content_hash, filename).
+INVOICE_INDEXES = [
+    'filename',
+]
+
+
+def ensure_indexes(collection):
+    for field in INVOICE_INDEXES:
+        try:
+            collection.create_index([(field, ASCENDING)])
+        except Exception as e:
+            print(f"Error creating index on {field}: {e}")
+
+
+def _projection(fields_param, default):
+    # ?fields=filename,invoice_number -> {'filename': 1, 'invoice_number': 1}
+    fields = [field.strip() for field in (fields_param or '').split(',') if field.strip()]
+    return {field: 1 for field in fields} if fields else default
+
+
+def _serialize(doc):
+    doc['_id'] = str(doc['_id'])
+    return doc
+
+
+# The invoice read/update endpoints shared by every extraction app
+# on_update(filename) is called for every invoice changed through the update endpoints.
+# With a response_cache the read endpoints are served from it; the app has to invalidate
+# it for invoices written elsewhere. An invoice_writer is flushed before every update, so
+# an invoice saved moments ago, still in its buffer, is found.
+def create_invoice_routes(collection, on_update=None, response_cache=None, invoice_writer=None):
+    routes = Blueprint('invoices', __name__)
+    ensure_indexes(collection)
+
+    def cached(build, filename=None):
+        return response_cache.serve(build, filename) if response_cache else build()
+
+    def changed(filenames):
+        if response_cache:
+            response_cache.invalidate(filenames)
+
+    def flush_writes():
+        if invoice_writer:
+            invoice_writer.flush()
+
+    @routes.route('/list_invoices', methods=['GET'])
+    def list_invoices():
+        # With `limit` or `after`, pages are ordered by _id; pass the returned `next` back as
+        # `after` for the next one. Without either every invoice is returned, as before.
+        # Without `fields` the invoices are listed by filename, as before.
+        paged = 'limit' in request.args or 'after' in request.args
+        try:
+            limit = min(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+            query = {}
+            if request.args.get('after'):
+                query['_id'] = {'$gt': ObjectId(request.args['after'])}
+        except (ValueError, InvalidId):
+            return jsonify({'error': 'Invalid limit or after parameter'}), 400
+        projection = _projection(request.args.get('fields'), {'filename': 1})
+
+        if request.args.get('format') == 'ndjson':
+            # Streams every matching invoice when no limit is given
+            def generate():
+                try:
+                    cursor = collection.find(query, projection).sort('_id', ASCENDING)
+                    if 'limit' in request.args:
+                        cursor = cursor.limit(limit)
+                    for doc in cursor:
+                        yield json.dumps(_serialize(doc), default=str) + '\n'
+                except Exception as e:
+                    # The status line is already sent, so the failure ends the stream as a record
+                    print(f"Error streaming invoices from MongoDB: {e}")
+                    yield json.dumps({'error': 'Failed to fetch invoices'}) + '\n'
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+        def build():
+            try:
+                cursor = collection.find(query, projection).sort('_id', ASCENDING)
+                docs = list(cursor.limit(limit) if paged else cursor)
+            except Exception as e:
+                print(f"Error fetching invoices from MongoDB: {e}")
+                return jsonify({'error': 'Failed to fetch invoices'}), 500
+
+            next_cursor = str(docs[-1]['_id']) if paged and len(docs) == limit else None
+            if 'fields' in request.args:
+                invoices = [_serialize(doc) for doc in docs]
+            else:
+                invoices = [doc.get('filename') for doc in docs]
+            return jsonify({'invoices': invoices, 'next': next_cursor})
+        return cached(build)
+
+    @routes.route('/get_invoice_json', methods=['GET'])
+    def get_invoice_json():
+        filename = request.args.get('filename')
+        if not filename:
+            return jsonify({'error': 'Filename not provided'}), 400
+
+        projection = _projection(request.args.get('fields'), {})
+        projection['_id'] = 0
+
+        def build():
+            invoice = collection.find_one({'filename': filename}, projection)
+            if invoice:
+                return jsonify(invoice)
+            else:
+                return jsonify({'error': 'Invoice not found'}), 404
+        return cached(build, filename)
+
+    @routes.route('/update_invoice', methods=['PUT'])
+    def update_invoice():
+        data = request.get_json()
+
+        if not data or 'filename' not in data:
+            return jsonify({'error': 'Invalid data. Filename is required.'}), 400
+
+        filename = data.pop('filename', None)
+        if not filename:
+            return jsonify({'error': 'Filename is missing.'}), 400
+
+        try:
+            flush_writes()
+            result = collection.update_one({'filename': filename}, {'$set': data})
+            changed([filename])
+            if result.matched_count > 0:
+                if on_update:
+                    on_update(filename)
+                return jsonify({'success': 'Invoice updated successfully'})
+            else:
+                return jsonify({'error': 'Invoice not found'}), 404
+        except Exception as e:
+            print(f"Error updating invoice in MongoDB: {e}")
+            return jsonify({'error': 'Failed to update invoice'}), 500
+
+    @routes.route('/update_invoices', methods=['PUT'])
+    def update_invoices():
+        # Bulk variant of /update_invoice: a list of invoices, each with its filename
+        data = request.get_json()
+        if not isinstance(data, list) or not all(isinstance(item, dict) and item.get('filename') for item in data):
+            return jsonify({'error': 'Invalid data. A list of invoices with filenames is required.'}), 400
+        if not data:
+            return jsonify({'success': 'No invoices to update', 'matched': 0, 'not_found': []})
+
+        filenames = [item['filename'] for item in data]
+        ops = [update_op(collection, {'filename': item['filename']},
+                         {'$set': {key: value for key, value in item.items() if key != 'filename'}})
+               for item in data]
+        try:
+            flush_writes()
+            result = collection.bulk_write(ops, ordered=False)
+            found = {doc['filename'] for doc in collection.find({'filename': {'$in': filenames}}, {'filename': 1})}
+        except Exception as e:
+            print(f"Error updating invoices in MongoDB: {e}")
+            changed(filenames)
+            return jsonify({'error': 'Failed to update invoices'}), 500
+
+        changed(filenames)
+        not_found = [filename for filename in filenames if filename not in found]
+        if on_update:
+            for filename in found:
+                on_update(filename)
+        return jsonify({'success': 'Invoices updated successfully', 'matched': result.matched_count,
+                        'not_found': not_found})
+
+    return routes
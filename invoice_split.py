@@ -0,0 +1,164 @@
+import os
+import re
+
+import fitz
+
+from pdf_pages import open_pdf
+from pre_extract import AMOUNT_RE, IRN_RE, LOOKAHEAD_LINES, find_gstins
+
+# Finds where each invoice starts in a PDF that holds several of them, so every invoice
+# is extracted and stored on its own. A page starts a new invoice when it says it is
+# page 1, when its invoice number, IRN or seller GSTIN differs from the invoice being
+# read, or when the previous page closed with a grand total and the page repeats the
+# first page's header layout and prints an invoice number or IRN the invoice so far did
+# not have. Pages that give no signal belong to the invoice before them.
+SPLIT_INVOICES = os.environ.get('SPLIT_INVOICES', '1') == '1'
+HEADER_BAND = 0.3  # top share of the page compared for layout resets
+TOTAL_BAND = 0.5  # bottom share of a page's lines a closing total is looked for in
+HEADER_GRID = 20
+MIN_HEADER_SIMILARITY = 0.6
+
+INVOICE_NUMBER_LABELS = re.compile(r'\b(invoice|inv|bill)\s*\.?\s*(no|number|num|#)\b\.?', re.IGNORECASE)
+INVOICE_NUMBER_RE = re.compile(r'^[\s:.#-]*([A-Z0-9][A-Z0-9/_-]*\d[A-Z0-9/_-]*)\b', re.IGNORECASE)
+PAGE_MARKER_RE = re.compile(r'\bpage\s*(\d{1,3})\s*(?:of|/)\s*(\d{1,3})\b', re.IGNORECASE)
+# pre_extract.TOTAL_LABELS without a bare "Total Amount", which is also a line item column header
+GRAND_TOTAL_LABELS = re.compile(r'(grand\s*total|total\s*invoice\s*(value|amount)|invoice\s*total|total\s*amount\s*'
+                                r'(payable|due)|net\s*payable|amount\s*payable|total\s*payable)', re.IGNORECASE)
+
+
+def find_invoice_number(lines):
+    numbers = set()
+    for index, line in enumerate(lines):
+        match = INVOICE_NUMBER_LABELS.search(line)
+        if not match:
+            continue
+        # The number follows the label on its line or starts one of the next lines
+        for candidate in [line[match.end():]] + lines[index + 1:index + 1 + LOOKAHEAD_LINES]:
+            found = INVOICE_NUMBER_RE.search(candidate)
+            if found:
+                numbers.add(found.group(1).upper())
+                break
+    return numbers.pop() if len(numbers) == 1 else None
+
+
+def has_closing_total(lines):
+    # A grand total label followed by an amount, in the bottom part of the page
+    for index in range(int(len(lines) * (1 - TOTAL_BAND)), len(lines)):
+        match = GRAND_TOTAL_LABELS.search(lines[index])
+        if not match:
+            continue
+        for candidate in [lines[index][match.end():]] + lines[index + 1:index + 1 + LOOKAHEAD_LINES]:
+            if any('.' in value or ',' in value for value in AMOUNT_RE.findall(candidate)):
+                return True
+    return False
+
+
+def header_anchors(words, width, height):
+    # Words of the page's top band, quantized to a grid, as in vendor_templates.layout_anchors
+    anchors = set()
+    for x0, y0, x1, y1, text, *_ in words:
+        if y0 / height < HEADER_BAND and any(char.isalpha() for char in text):
+            anchors.add(f"{text.lower()}@{int(x0 / width * HEADER_GRID)},{int(y0 / height * HEADER_GRID)}")
+    return anchors
+
+
+def page_signals(text, anchors=None):
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    irns = {irn.lower() for irn in IRN_RE.findall(text)}
+    marker = PAGE_MARKER_RE.search(text)
+    return {
+        'invoice_number': find_invoice_number(lines),
+        'irn': irns.pop() if len(irns) == 1 else None,
+        'vendor_gstin': find_gstins(lines).get('vendor_gstin'),
+        'page_marker': (int(marker.group(1)), int(marker.group(2))) if marker else None,
+        'has_total': has_closing_total(lines),
+        'header': anchors or set(),
+    }
+
+
+def _similarity(a, b):
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+def _boundary(invoice, previous, signals):
+    # Why the page starts a new invoice, or None when it continues the current one
+    if signals['page_marker']:
+        return 'page_marker' if signals['page_marker'][0] == 1 else None
+    for key in ('irn', 'invoice_number'):
+        if signals[key] and invoice[key]:
+            return key if signals[key] != invoice[key] else None
+    if signals['vendor_gstin'] and invoice['vendor_gstin'] and signals['vendor_gstin'] != invoice['vendor_gstin']:
+        return 'vendor_gstin'
+    # A repeated letterhead alone is also what every page of a long invoice looks like.
+    # Reaching here with an invoice number or IRN means the invoice so far had none.
+    if (previous['has_total'] and (signals['invoice_number'] or signals['irn'])
+            and _similarity(signals['header'], invoice['header']) >= MIN_HEADER_SIMILARITY):
+        return 'layout_reset'
+    return None
+
+
+def find_invoices(pages):
+    # pages: page_signals of every page. Returns [{'pages': (start, end), 'boundary'}]
+    # with end exclusive; a PDF holding one invoice gives a single entry.
+    invoices = []
+    invoice = previous = None
+    for number, signals in enumerate(pages):
+        reason = _boundary(invoice, previous, signals) if invoice else 'start'
+        if reason:
+            invoices.append({'pages': (number, number + 1), 'boundary': reason})
+            invoice = dict(signals)
+        else:
+            invoices[-1]['pages'] = (invoices[-1]['pages'][0], number + 1)
+            # Identifiers first printed on a later page still belong to this invoice
+            for key in ('invoice_number', 'irn', 'vendor_gstin'):
+                invoice[key] = invoice[key] or signals[key]
+        previous = signals
+    return invoices
+
+
+def split_pdf(pdf):
+    # find_invoices for a PDF, from the text layer and header layout of each page
+    doc = open_pdf(pdf)
+    try:
+        if len(doc) < 2 or not SPLIT_INVOICES:
+            return [{'pages': (0, len(doc)), 'boundary': 'start'}]
+        pages = [page_signals(page.get_text(), header_anchors(page.get_text('words'), page.rect.width,
+                                                              page.rect.height))
+                 for page in doc]
+    finally:
+        doc.close()
+    return find_invoices(pages)
+
+
+def split_text(page_texts):
+    # find_invoices for text only pipelines, without layout resets
+    if len(page_texts) < 2 or not SPLIT_INVOICES:
+        return [{'pages': (0, len(page_texts)), 'boundary': 'start'}]
+    return find_invoices([page_signals(text) for text in page_texts])
+
+
+def part_pdf(pdf, pages):
+    doc = open_pdf(pdf)
+    part = fitz.open()
+    try:
+        part.insert_pdf(doc, from_page=pages[0], to_page=pages[1] - 1)
+        # Without a new file ID the bytes, and so the content hash and cache key, are the same every time
+        return part.tobytes(garbage=3, deflate=True, no_new_id=True)
+    finally:
+        part.close()
+        doc.close()
+
+
+def part_filename(filename, index):
+    stem, extension = os.path.splitext(filename)
+    return f"{stem}_invoice{index + 1}{extension}"
+
+
+def part_info(filename, index, invoices):
+    # Stored with each invoice of a split PDF, linking it to the uploaded file
+    start, end = invoices[index]['pages']
+    return {
+        'parent_filename': filename,
+        'invoice_part': {'index': index + 1, 'count': len(invoices), 'pages': [start + 1, end],
+                         'boundary': invoices[index]['boundary']},
+    }
@@ -0,0 +1,184 @@
+import argparse
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, ReturnDocument
+
+from pdf_pages import start_image_budget
+from uploads import save_upload
+
+JOB_UPLOAD_DIR = os.environ.get('JOB_UPLOAD_DIR', 'job_uploads')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+JOB_POLL_SECONDS = 2
+# A running job whose worker has not renewed its lease for this long is requeued
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', '60'))
+
+
+# Background job queue backed by a MongoDB collection. Uploads are written to disk,
+# the job document tracks per-file results, and workers claim queued jobs atomically
+# so work survives a restart of the server.
+# A claimed job is leased to its worker: worker_id is recorded and updated_at is renewed
+# by a heartbeat. Only jobs whose lease expired are taken back, so several processes can
+# serve the same queue, and a worker that lost its lease stops writing to the job.
+# Workers are started explicitly, by the app's entry point or by running this module
+# next to a WSGI server, never by importing an app.
+class JobQueue:
+    def __init__(self, collection, process_fn, variant, upload_dir=JOB_UPLOAD_DIR, workers=JOB_WORKERS):
+        self.collection = collection
+        self.process_fn = process_fn
+        self.variant = variant
+        self.upload_dir = upload_dir
+        self.workers = workers
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._wakeup = threading.Event()
+        self._started = False
+        self._lock = threading.Lock()
+        self._leases = {}  # worker_id -> job _id, for the heartbeat
+        try:
+            self.collection.create_index([('variant', ASCENDING), ('status', ASCENDING), ('created_at', ASCENDING)])
+        except Exception as e:
+            print(f"Error creating index for job queue: {e}")
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self._requeue_expired()
+        threading.Thread(target=self._heartbeat, name='job-heartbeat', daemon=True).start()
+        for i in range(self.workers):
+            threading.Thread(target=self._work, args=(f'{self.worker_id}-{i}',), name=f'job-worker-{i}',
+                             daemon=True).start()
+
+    def _requeue_expired(self):
+        # A job whose lease ran out belongs to a worker that died or hung
+        expired = datetime.now(timezone.utc) - timedelta(seconds=JOB_LEASE_SECONDS)
+        try:
+            self.collection.update_many({'variant': self.variant, 'status': 'running', 'updated_at': {'$lt': expired}},
+                                        {'$set': {'status': 'queued', 'worker_id': None}})
+        except Exception as e:
+            print(f"Error requeueing expired jobs: {e}")
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(JOB_LEASE_SECONDS / 3)
+            with self._lock:
+                leases = list(self._leases.items())
+            for worker_id, job_id in leases:
+                try:
+                    self.collection.update_one({'_id': job_id, 'worker_id': worker_id},
+                                               {'$set': {'updated_at': datetime.now(timezone.utc)}})
+                except Exception as e:
+                    print(f"Error renewing lease of job {job_id}: {e}")
+
+    def submit(self, uploaded_files):
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.upload_dir, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        files = []
+        for index, uploaded_file in enumerate(uploaded_files):
+            path = os.path.join(job_dir, f'{index}.pdf')
+            save_upload(uploaded_file, path)
+            files.append({'filename': uploaded_file.filename, 'path': path})
+
+        now = datetime.now(timezone.utc)
+        self.collection.insert_one({
+            '_id': job_id,
+            'variant': self.variant,
+            'status': 'queued',
+            'files': files,
+            'results': [None] * len(files),
+            'completed': 0,
+            'created_at': now,
+            'updated_at': now,
+        })
+        self._wakeup.set()
+        return job_id
+
+    def status(self, job_id):
+        job = self.collection.find_one({'_id': job_id, 'variant': self.variant}, {'files': 0})
+        if not job:
+            return None
+        return {
+            'job_id': job['_id'],
+            'status': job['status'],
+            'total': len(job['results']),
+            'completed': job['completed'],
+            'results': [result for result in job['results'] if result is not None],
+        }
+
+    def _claim(self, worker_id):
+        return self.collection.find_one_and_update(
+            {'variant': self.variant, 'status': 'queued'},
+            {'$set': {'status': 'running', 'worker_id': worker_id, 'updated_at': datetime.now(timezone.utc)}},
+            sort=[('created_at', ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def _update(self, job, worker_id, fields):
+        # False once the lease was lost and the job requeued for another worker
+        fields['updated_at'] = datetime.now(timezone.utc)
+        result = self.collection.update_one({'_id': job['_id'], 'worker_id': worker_id}, {'$set': fields})
+        return result.matched_count > 0
+
+    def _work(self, worker_id):
+        while True:
+            try:
+                job = self._claim(worker_id)
+            except Exception as e:
+                print(f"Error claiming job from MongoDB: {e}")
+                job = None
+            if not job:
+                self._requeue_expired()
+                self._wakeup.wait(JOB_POLL_SECONDS)
+                self._wakeup.clear()
+                continue
+            with self._lock:
+                self._leases[worker_id] = job['_id']
+            try:
+                self._run(job, worker_id)
+            except Exception as e:
+                print(f"Error processing job {job['_id']}: {e}")
+                try:
+                    self._update(job, worker_id, {'status': 'failed', 'error': str(e)})
+                except Exception as e:
+                    print(f"Error marking job {job['_id']} failed: {e}")
+            finally:
+                with self._lock:
+                    self._leases.pop(worker_id, None)
+
+    def _run(self, job, worker_id):
+        # A job's files share one page image budget, like those of one request
+        start_image_budget()
+        completed = job['completed']
+        for index, file_info in enumerate(job['files']):
+            # Files finished before a restart keep their stored result
+            if job['results'][index] is not None:
+                continue
+            # The pipeline opens the stored file by path instead of reading it into memory
+            result = self.process_fn((file_info['filename'], file_info['path']))
+            completed += 1
+            if not self._update(job, worker_id, {f'results.{index}': result, 'completed': completed}):
+                print(f"Lost the lease of job {job['_id']}, leaving it to another worker")
+                return
+
+        if self._update(job, worker_id, {'status': 'done', 'worker_id': None}):
+            shutil.rmtree(os.path.join(self.upload_dir, job['_id']), ignore_errors=True)
+
+    def serve_forever(self):
+        self.start()
+        threading.Event().wait()
+
+
+if __name__ == '__main__':
+    # Job workers for an app served by a WSGI server, which only submits and reports jobs:
+    #   python job_queue.py flask_vlm
+    parser = argparse.ArgumentParser(description="Run the job workers of an extraction app")
+    parser.add_argument('app', choices=['flask_multi', 'flask_vlm', 'flask_perf_score'])
+    args = parser.parse_args()
+    __import__(args.app).job_queue.serve_forever()
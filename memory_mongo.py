@@ -0,0 +1,262 @@
+import copy
+import threading
+import types
+
+import pymongo
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+# In-process stand-in for MongoClient, selected with MONGO_URI=memory:// (see
+# mongo_writer.create_client). It covers only the queries and updates this project
+# issues, so the apps and benchmarks can run without a MongoDB server. Nothing is
+# persisted and indexes are accepted but not enforced.
+MISSING = object()
+
+
+def _get(doc, path):
+    for key in path.split('.'):
+        if isinstance(doc, dict) and key in doc:
+            doc = doc[key]
+        elif isinstance(doc, list) and key.isdigit() and int(key) < len(doc):
+            doc = doc[int(key)]
+        else:
+            return MISSING
+    return doc
+
+
+def _set(doc, path, value):
+    keys = path.split('.')
+    for key in keys[:-1]:
+        doc = doc[int(key)] if isinstance(doc, list) else doc.setdefault(key, {})
+    if isinstance(doc, list):
+        doc[int(keys[-1])] = value
+    else:
+        doc[keys[-1]] = value
+
+
+def _matches_condition(value, condition):
+    if isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition):
+        for operator, operand in condition.items():
+            if operator == '$exists':
+                if (value is not MISSING) != bool(operand):
+                    return False
+            elif operator == '$in':
+                if value is MISSING or value not in operand:
+                    return False
+            elif operator == '$gt':
+                if value is MISSING or value is None or not value > operand:
+                    return False
+            elif operator == '$lt':
+                if value is MISSING or value is None or not value < operand:
+                    return False
+            elif operator == '$ne':
+                if value == operand:
+                    return False
+            else:
+                raise NotImplementedError(f"memory_mongo does not support {operator}")
+        return True
+    return value is not MISSING and value == condition
+
+
+def matches(doc, query):
+    return all(_matches_condition(_get(doc, path), condition) for path, condition in (query or {}).items())
+
+
+def project(doc, projection):
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    include = {path for path, flag in projection.items() if flag and path != '_id'}
+    if include:
+        projected = {}
+        for path in include:
+            value = _get(doc, path)
+            if value is not MISSING:
+                _set(projected, path, value)
+        if projection.get('_id', 1) and '_id' in doc:
+            projected['_id'] = doc['_id']
+        return projected
+    for path, flag in projection.items():
+        if not flag:
+            keys = path.split('.')
+            parent = _get(doc, '.'.join(keys[:-1])) if len(keys) > 1 else doc
+            if isinstance(parent, dict):
+                parent.pop(keys[-1], None)
+    return doc
+
+
+def _sort_key(doc, path):
+    value = _get(doc, path)
+    # Missing and None sort first, as in MongoDB
+    return (0, 0) if value is MISSING or value is None else (1, value)
+
+
+class MemoryCursor:
+    def __init__(self, docs, projection):
+        self._docs = docs
+        self._projection = projection
+        self._limit = 0
+
+    def sort(self, key_or_list, direction=1):
+        keys = key_or_list if isinstance(key_or_list, list) else [(key_or_list, direction)]
+        for path, direction in reversed(keys):
+            self._docs.sort(key=lambda doc: _sort_key(doc, path), reverse=direction < 0)
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def __iter__(self):
+        docs = self._docs[:self._limit] if self._limit else self._docs
+        return (project(doc, self._projection) for doc in docs)
+
+
+class MemoryCollection:
+    def __init__(self, name):
+        self.name = name
+        self._docs = []
+        self._lock = threading.RLock()
+
+    def create_index(self, keys, **kwargs):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        return '_'.join(f"{key}_{direction}" for key, direction in keys)
+
+    def _find(self, query):
+        return [doc for doc in self._docs if matches(doc, query)]
+
+    def find(self, query=None, projection=None):
+        with self._lock:
+            return MemoryCursor(self._find(query), projection)
+
+    def find_one(self, query=None, projection=None):
+        with self._lock:
+            for doc in self._docs:
+                if matches(doc, query):
+                    return project(doc, projection)
+        return None
+
+    def insert_one(self, doc):
+        doc = copy.deepcopy(doc)
+        doc.setdefault('_id', ObjectId())
+        with self._lock:
+            if any(existing['_id'] == doc['_id'] for existing in self._docs):
+                raise ValueError(f"Duplicate _id {doc['_id']}")
+            self._docs.append(doc)
+        return types.SimpleNamespace(inserted_id=doc['_id'])
+
+    def _apply(self, doc, update, inserting):
+        for operator, fields in update.items():
+            if operator == '$set' or (operator == '$setOnInsert' and inserting):
+                for path, value in fields.items():
+                    _set(doc, path, copy.deepcopy(value))
+            elif operator != '$setOnInsert':
+                raise NotImplementedError(f"memory_mongo does not support {operator}")
+
+    def _upsert(self, query, update):
+        doc = {path: value for path, value in query.items() if not isinstance(value, dict)}
+        self._apply(doc, update, inserting=True)
+        doc.setdefault('_id', ObjectId())
+        self._docs.append(doc)
+        return doc
+
+    def update_one(self, query, update, upsert=False):
+        with self._lock:
+            for doc in self._docs:
+                if matches(doc, query):
+                    before = copy.deepcopy(doc)
+                    self._apply(doc, update, inserting=False)
+                    return types.SimpleNamespace(matched_count=1, modified_count=int(doc != before), upserted_id=None)
+            upserted_id = self._upsert(query, update)['_id'] if upsert else None
+        return types.SimpleNamespace(matched_count=0, modified_count=0, upserted_id=upserted_id)
+
+    def update_many(self, query, update):
+        with self._lock:
+            docs = self._find(query)
+            for doc in docs:
+                self._apply(doc, update, inserting=False)
+        return types.SimpleNamespace(matched_count=len(docs), modified_count=len(docs), upserted_id=None)
+
+    def replace_one(self, query, replacement, upsert=False):
+        with self._lock:
+            for index, doc in enumerate(self._docs):
+                if matches(doc, query):
+                    self._docs[index] = {**copy.deepcopy(replacement), '_id': doc['_id']}
+                    return types.SimpleNamespace(matched_count=1, modified_count=1, upserted_id=None)
+            upserted_id = None
+            if upsert:
+                doc = {**{path: value for path, value in query.items() if not isinstance(value, dict)},
+                       **copy.deepcopy(replacement)}
+                doc.setdefault('_id', ObjectId())
+                self._docs.append(doc)
+                upserted_id = doc['_id']
+        return types.SimpleNamespace(matched_count=0, modified_count=0, upserted_id=upserted_id)
+
+    def find_one_and_update(self, query, update, sort=None, return_document=ReturnDocument.BEFORE):
+        with self._lock:
+            cursor = MemoryCursor(self._find(query), None)
+            if sort:
+                cursor.sort(sort)
+            if not cursor._docs:
+                return None
+            doc = cursor._docs[0]
+            before = copy.deepcopy(doc)
+            self._apply(doc, update, inserting=False)
+            return copy.deepcopy(doc) if return_document == ReturnDocument.AFTER else before
+
+    def delete_many(self, query):
+        with self._lock:
+            kept = [doc for doc in self._docs if not matches(doc, query)]
+            deleted = len(self._docs) - len(kept)
+            self._docs = kept
+        return types.SimpleNamespace(deleted_count=deleted)
+
+    def bulk_write(self, requests, ordered=True):
+        # Only UpdateOne is issued in bulk by this project, built with update_op
+        matched = modified = 0
+        upserted_ids = {}
+        for index, request in enumerate(requests):
+            result = self.update_one(request.filter, request.update, upsert=request.upsert)
+            matched += result.matched_count
+            modified += result.modified_count
+            if result.upserted_id is not None:
+                upserted_ids[index] = result.upserted_id
+        return types.SimpleNamespace(matched_count=matched, modified_count=modified, upserted_count=len(upserted_ids),
+                                     upserted_ids=upserted_ids)
+
+
+class UpdateOne:
+    # pymongo's UpdateOne keeps its arguments private, so bulk writes to a MemoryCollection
+    # are given this instead
+    def __init__(self, filter, update, upsert=False):
+        self.filter = filter
+        self.update = update
+        self.upsert = upsert
+
+
+def update_op(collection, filter, update, upsert=False):
+    # UpdateOne for a bulk_write on collection, a MongoDB or an in-memory one
+    op = UpdateOne if isinstance(collection, MemoryCollection) else pymongo.UpdateOne
+    return op(filter, update, upsert=upsert)
+
+
+class MemoryDatabase:
+    def __init__(self, name):
+        self.name = name
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            return self._collections.setdefault(name, MemoryCollection(name))
+
+
+class MemoryClient:
+    def __init__(self, *args, **kwargs):
+        self._databases = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            return self._databases.setdefault(name, MemoryDatabase(name))
@@ -0,0 +1,235 @@
+import contextvars
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Prometheus style metrics kept in process memory, plus one structured timing log line
+# per HTTP request. Every stage records wall time and the CPU time of the thread that ran
+# it, so a slow request shows whether it waited on the model, MongoDB or fitz.
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Timing log lines go to stderr unless TIMING_LOG names a file
+TIMING_LOG = os.environ.get('TIMING_LOG')
+
+timing_log = logging.getLogger('invoice.timing')
+timing_log.setLevel(logging.INFO)
+timing_log.propagate = False
+timing_log.addHandler(logging.FileHandler(TIMING_LOG) if TIMING_LOG else logging.StreamHandler())
+
+
+def _label_text(labelnames, key):
+    if not labelnames:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labelnames, key)) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _label_text(self.labelnames, key), value) for key, value in self._values.items()]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}  # labels -> [per bucket counts (last one is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            entry = self._values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    def totals(self):
+        # {labels: (count, sum)}
+        with self._lock:
+            return {key: (sum(counts), total) for key, (counts, total) in self._values.items()}
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else repr(float(bound))
+                    samples.append((f"{self.name}_bucket", _label_text(self.labelnames + ('le',), key + (le,)),
+                                    cumulative))
+                samples.append((f"{self.name}_sum", _label_text(self.labelnames, key), total))
+                samples.append((f"{self.name}_count", _label_text(self.labelnames, key), cumulative))
+        return samples
+
+
+STAGE_SECONDS = Histogram('invoice_stage_seconds', "Wall time per pipeline stage", ('stage',))
+STAGE_CPU_SECONDS = Counter('invoice_stage_cpu_seconds_total', "CPU time of the thread running each stage",
+                            ('stage',))
+MODEL_CALLS = Counter('invoice_model_calls_total', "Chat completion calls", ('model', 'outcome'))
+MODEL_RETRIES = Counter('invoice_model_retries_total', "Chat completion attempts that were retried", ('model',))
+MODEL_TOKENS = Counter('invoice_model_tokens_total', "Tokens billed per model", ('model', 'kind'))
+HTTP_REQUESTS = Counter('invoice_http_requests_total', "HTTP requests served", ('endpoint', 'status'))
+HTTP_SECONDS = Histogram('invoice_http_request_seconds', "Wall time per HTTP request", ('endpoint',))
+PAGES_ROUTED = Counter('invoice_pages_total', "PDF pages read, by how they were sent to the model", ('route',))
+METRICS = [STAGE_SECONDS, STAGE_CPU_SECONDS, MODEL_CALLS, MODEL_RETRIES, MODEL_TOKENS, HTTP_REQUESTS, HTTP_SECONDS,
+           PAGES_ROUTED]
+
+_current_trace = contextvars.ContextVar('request_trace', default=None)
+
+
+# Stage totals of one HTTP request. It is found through a context variable, which the
+# worker pools copy into their threads, so stages run for the request anywhere are added.
+class RequestTrace:
+    def __init__(self, endpoint, method):
+        self.endpoint = endpoint
+        self.method = method
+        self.stages = {}
+        self.model = {'calls': 0, 'retries': 0, 'errors': 0}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage, seconds, cpu_seconds):
+        with self._lock:
+            entry = self.stages.setdefault(stage, {'count': 0, 'seconds': 0.0, 'cpu_seconds': 0.0})
+            entry['count'] += 1
+            entry['seconds'] += seconds
+            entry['cpu_seconds'] += cpu_seconds
+
+    def add_model_call(self, usage, retries, ok):
+        with self._lock:
+            self.model['calls'] += 1
+            self.model['retries'] += retries
+            self.model['errors'] += int(not ok)
+            for kind, tokens in usage.items():
+                self.model[kind] = self.model.get(kind, 0) + tokens
+
+    def finish(self, status):
+        seconds = time.perf_counter() - self._start
+        HTTP_REQUESTS.inc(endpoint=self.endpoint, status=status)
+        HTTP_SECONDS.observe(seconds, endpoint=self.endpoint)
+        with self._lock:
+            record = {
+                'endpoint': self.endpoint,
+                'method': self.method,
+                'status': status,
+                'seconds': round(seconds, 4),
+                'stages': {stage: {key: round(value, 4) for key, value in entry.items()}
+                           for stage, entry in self.stages.items()},
+                'model': dict(self.model),
+            }
+        timing_log.info(json.dumps(record))
+
+
+def observe_stage(stage, seconds, cpu_seconds=0.0):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    STAGE_CPU_SECONDS.inc(cpu_seconds, stage=stage)
+    trace = _current_trace.get()
+    if trace:
+        trace.add_stage(stage, seconds, cpu_seconds)
+
+
+@contextmanager
+def stage(name):
+    start, cpu_start = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start, time.thread_time() - cpu_start)
+
+
+def record_model_call(model, usage, retries=0, ok=True):
+    MODEL_CALLS.inc(model=model, outcome='ok' if ok else 'error')
+    if retries:
+        MODEL_RETRIES.inc(retries, model=model)
+    for kind, tokens in usage.items():
+        MODEL_TOKENS.inc(tokens, model=model, kind=kind)
+    trace = _current_trace.get()
+    if trace:
+        trace.add_model_call(usage, retries, ok)
+
+
+def record_pages(text, image, skipped=0):
+    for route, count in (('text', text), ('image', image), ('skipped', skipped)):
+        if count:
+            PAGES_ROUTED.inc(count, route=route)
+
+
+def stage_summary():
+    # {stage: {'count', 'seconds', 'cpu_seconds'}} over the life of the process
+    cpu = {labels: value for _, labels, value in STAGE_CPU_SECONDS.samples()}
+    return {key[0]: {'count': count, 'seconds': round(total, 3),
+                     'cpu_seconds': round(cpu.get(_label_text(('stage',), key), 0.0), 3)}
+            for key, (count, total) in STAGE_SECONDS.totals().items()}
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{name}{labels} {value}" for name, labels, value in metric.samples())
+    # ru_maxrss is in kilobytes on Linux
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    lines.append("# HELP process_cpu_seconds_total User and system CPU time of the process")
+    lines.append("# TYPE process_cpu_seconds_total counter")
+    lines.append(f"process_cpu_seconds_total {usage.ru_utime + usage.ru_stime}")
+    lines.append("# HELP process_max_resident_memory_bytes Peak resident memory of the process")
+    lines.append("# TYPE process_max_resident_memory_bytes gauge")
+    lines.append(f"process_max_resident_memory_bytes {usage.ru_maxrss * 1024}")
+    lines.append("# HELP process_threads Live threads in the process")
+    lines.append("# TYPE process_threads gauge")
+    lines.append(f"process_threads {threading.active_count()}")
+    return '\n'.join(lines) + '\n'
+
+
+def _with_trace(trace, chunks):
+    # A streamed body may be produced outside the context the view ran in
+    _current_trace.set(trace)
+    yield from chunks
+
+
+def init_metrics(app):
+    # Adds /metrics and a timing log line for every other request of a Flask app
+    from flask import Response, request
+
+    @app.before_request
+    def start_trace():
+        traced = request.endpoint != 'prometheus_metrics'
+        _current_trace.set(RequestTrace(request.endpoint or 'unknown', request.method) if traced else None)
+
+    @app.after_request
+    def finish_trace(response):
+        trace = _current_trace.get()
+        if trace:
+            if response.is_streamed:
+                response.response = _with_trace(trace, response.response)
+            # Streamed responses are only finished once the last chunk is sent
+            response.call_on_close(lambda: trace.finish(response.status_code))
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def prometheus_metrics():
+        return Response(render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,180 @@
+import atexit
+import os
+import threading
+from collections import OrderedDict
+
+from bson import ObjectId
+from pymongo import ASCENDING, MongoClient
+from pymongo.errors import BulkWriteError
+
+from memory_mongo import MemoryClient, update_op
+from metrics import stage
+
+# memory:// selects the in-process stand-in from memory_mongo, for offline runs
+MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
+# Connection pool sized for the extraction worker threads plus the read endpoints
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '50'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '2'))
+
+WRITE_BATCH_SIZE = int(os.environ.get('WRITE_BATCH_SIZE', '100'))
+WRITE_FLUSH_SECONDS = float(os.environ.get('WRITE_FLUSH_SECONDS', '1.0'))
+# Writes kept for retry while MongoDB is unreachable; the oldest are dropped past this
+MAX_BUFFERED_WRITES = int(os.environ.get('MAX_BUFFERED_WRITES', '10000'))
+# _ids of recently saved invoices kept by (content_hash, filename)
+KNOWN_IDS = 10000
+DUPLICATE_KEY_ERROR = 11000
+
+
+def create_client(uri=MONGO_URI):
+    if uri.startswith('memory://'):
+        return MemoryClient()
+    return MongoClient(
+        uri,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=60000,
+        waitQueueTimeoutMS=10000,
+        serverSelectionTimeoutMS=10000,
+        retryWrites=True,
+    )
+
+
+# Write-behind buffer for extracted invoices. Documents are upserted on (content_hash,
+# filename), so saving the same extraction twice never creates a duplicate, and are
+# flushed as one unordered bulk write when the buffer fills or the flush interval passes.
+# A batch that fails because MongoDB is unavailable stays buffered and is retried.
+# on_write(filenames) is called after every batch that reached MongoDB. The apps share
+# the collection, so each invoice records the variant (output schema) that extracted it.
+# save() returns the _id the invoice is inserted under, set with $setOnInsert, or the one
+# remembered for an invoice saved before. save() itself never queries MongoDB: the _id of
+# an invoice that already existed is learned when its batch is flushed, so only saves
+# after that return it. Two processes inserting the same invoice at once both pick a new
+# _id, and the loser's duplicate key error is retried as an update of the winner's
+# document. Any other write error is permanent; that write is logged and dropped.
+class InvoiceWriter:
+    def __init__(self, collection, batch_size=WRITE_BATCH_SIZE, flush_seconds=WRITE_FLUSH_SECONDS, on_write=None):
+        self.collection = collection
+        self.on_write = on_write
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._ops = []
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stats = {'saved': 0, 'flushes': 0, 'written': 0, 'retried': 0, 'dropped': 0}
+        try:
+            self.collection.create_index([('content_hash', ASCENDING), ('filename', ASCENDING)], unique=True,
+                                         partialFilterExpression={'content_hash': {'$exists': True}})
+        except Exception as e:
+            print(f"Error creating content hash index: {e}")
+        threading.Thread(target=self._flush_periodically, name='invoice-writer', daemon=True).start()
+        atexit.register(self.flush)
+
+    def save(self, doc, content_hash, variant=None):
+        doc = dict(doc)
+        new_id = doc.pop('_id', None) or ObjectId()
+        doc['content_hash'] = content_hash
+        if variant:
+            doc['variant'] = variant
+        key = (content_hash, doc['filename'])
+        with self._lock:
+            # A save of the same invoice that got in first wins, its write may still be buffered
+            doc_id = self._remember(key, self._ids.get(key) or new_id)
+            op = update_op(self.collection, {'content_hash': content_hash, 'filename': doc['filename']},
+                           {'$set': doc, '$setOnInsert': {'_id': doc_id}}, upsert=True)
+            self._ops.append((key, op))
+            self._stats['saved'] += 1
+            full = len(self._ops) >= self.batch_size
+        if full:
+            self._wakeup.set()
+        return str(doc_id)
+
+    def _remember(self, key, doc_id):
+        # Called with the lock held
+        self._ids[key] = doc_id
+        self._ids.move_to_end(key)
+        while len(self._ids) > KNOWN_IDS:
+            self._ids.popitem(last=False)
+        return doc_id
+
+    def _learn_stored_ids(self, entries):
+        # One query for the invoices of a batch that already existed, whose _id was not ours
+        if not entries:
+            return
+        keys = {key for key, _ in entries}
+        try:
+            stored = self.collection.find({'content_hash': {'$in': list({key[0] for key in keys})}},
+                                          {'content_hash': 1, 'filename': 1})
+            stored_ids = {(doc['content_hash'], doc['filename']): doc['_id'] for doc in stored}
+        except Exception as e:
+            print(f"Error looking up stored invoices: {e}")
+            return
+        with self._lock:
+            for key in keys & stored_ids.keys():
+                self._remember(key, stored_ids[key])
+
+    def _requeue(self, entries):
+        with self._lock:
+            self._ops = entries + self._ops
+            self._stats['retried'] += len(entries)
+            overflow = len(self._ops) - MAX_BUFFERED_WRITES
+            if overflow > 0:
+                del self._ops[:overflow]
+                self._stats['dropped'] += overflow
+                print(f"Dropped {overflow} buffered invoice write(s), MongoDB has been unavailable too long")
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                entries, self._ops = self._ops, []
+            if not entries:
+                return
+            ops = [op for _, op in entries]
+            try:
+                with stage('mongo_write'):
+                    result = self.collection.bulk_write(ops, ordered=False)
+                written = result.upserted_count + result.modified_count
+                inserted = set(result.upserted_ids)
+                failed = set()
+            except BulkWriteError as e:
+                # Unordered: everything except the reported operations was applied. A
+                # duplicate key means another process inserted the invoice first; the
+                # retried upsert updates that document, whose _id is then looked up.
+                errors = e.details['writeErrors']
+                retry = [error for error in errors if error['code'] == DUPLICATE_KEY_ERROR]
+                for error in errors:
+                    if error['code'] != DUPLICATE_KEY_ERROR:
+                        print(f"Error writing invoice {entries[error['index']][0][1]} to MongoDB, "
+                              f"dropping it: {error.get('errmsg')}")
+                with self._lock:
+                    self._stats['dropped'] += len(errors) - len(retry)
+                    for error in retry:
+                        self._ids.pop(entries[error['index']][0], None)
+                if retry:
+                    print(f"Retrying {len(retry)} invoice write(s) that lost an insert race")
+                    self._requeue([entries[error['index']] for error in retry])
+                written = len(ops) - len(errors)
+                inserted = {upserted['index'] for upserted in e.details.get('upserted', [])}
+                failed = {error['index'] for error in errors}
+            except Exception as e:
+                print(f"Error writing invoices to MongoDB, retrying {len(ops)} write(s): {e}")
+                self._requeue(entries)
+                return
+            self._learn_stored_ids([entry for index, entry in enumerate(entries)
+                                    if index not in inserted and index not in failed])
+            with self._lock:
+                self._stats['flushes'] += 1
+                self._stats['written'] += written
+            if self.on_write:
+                self.on_write({key[1] for key, _ in entries})
+
+    def _flush_periodically(self):
+        while True:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, buffered=len(self._ops))
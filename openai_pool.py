@@ -0,0 +1,168 @@
+import os
+import random
+import threading
+import time
+
+from openai import APIConnectionError, APITimeoutError, InternalServerError, OpenAI, RateLimitError
+
+from metrics import observe_stage, record_model_call, stage
+from prompts import token_usage
+
+# Account limits per model. Every chat completion in the process is scheduled against
+# them, so concurrent requests queue here instead of being rejected by the API.
+OPENAI_RPM = int(os.environ.get('OPENAI_RPM', '500'))
+OPENAI_TPM = int(os.environ.get('OPENAI_TPM', '200000'))
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', '6'))
+OPENAI_TIMEOUT_SECONDS = float(os.environ.get('OPENAI_TIMEOUT_SECONDS', '120'))
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+# Token estimates used before the real usage is known. max_tokens counts against the
+# TPM limit in full, so it is used as the output estimate when given.
+CHARS_PER_TOKEN = 4
+IMAGE_TOKEN_ESTIMATE = {'low': 85, 'high': 765, 'auto': 765}
+DEFAULT_OUTPUT_TOKENS = 1000
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+_clients = {}
+_limiters = {}
+_lock = threading.Lock()
+
+
+def get_client(api_key):
+    # One client per key for the whole process, so its pooled HTTP connections are kept
+    # alive and reused. Retries are done by chat_completion, not by the SDK.
+    with _lock:
+        if api_key not in _clients:
+            _clients[api_key] = OpenAI(api_key=api_key, max_retries=0, timeout=OPENAI_TIMEOUT_SECONDS)
+        return _clients[api_key]
+
+
+def estimate_tokens(messages, max_tokens=None):
+    tokens = max_tokens or DEFAULT_OUTPUT_TOKENS
+    for message in messages:
+        content = message['content']
+        if isinstance(content, str):
+            tokens += len(content) // CHARS_PER_TOKEN
+            continue
+        for part in content:
+            if part['type'] == 'text':
+                tokens += len(part['text']) // CHARS_PER_TOKEN
+            else:
+                tokens += IMAGE_TOKEN_ESTIMATE[part['image_url'].get('detail', 'auto')]
+    return tokens
+
+
+# Token bucket that hands out reservations: a caller takes what it needs at once, even
+# into debt, and sleeps until the debt is paid back. Callers are served in arrival order
+# and a large request can not be starved by a stream of small ones.
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        # Returns the seconds to wait before the reservation may be used
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+        return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount, now):
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    def __init__(self, rpm=OPENAI_RPM, tpm=OPENAI_TPM):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self.requests.reserve(1, now), self.tokens.reserve(tokens, now), self.paused_until - now)
+        if wait > 0:
+            time.sleep(wait)
+
+    def settle(self, estimated, used):
+        # Gives back what the estimate over-reserved, or takes the shortfall
+        with self._lock:
+            self.tokens.refund(estimated - used, time.monotonic())
+
+    def pause(self, seconds):
+        # A 429 means the account is over its limit right now; hold back every caller
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def get_limiter(model):
+    with _lock:
+        if model not in _limiters:
+            _limiters[model] = RateLimiter()
+        return _limiters[model]
+
+
+def _retry_after(error):
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    for header, divisor in (('retry-after-ms', 1000), ('retry-after', 1)):
+        try:
+            return float(response.headers[header]) / divisor
+        except (KeyError, ValueError):
+            continue
+    return None
+
+
+def backoff_seconds(attempt, retry_after=None):
+    # Full jitter, but never earlier than the server asked for
+    delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+    return max(delay, retry_after + random.uniform(0, BACKOFF_BASE_SECONDS)) if retry_after else delay
+
+
+def chat_completion(api_key, model, messages, **kwargs):
+    # Scheduled, retried chat completion. Raises the last error once the retries are
+    # used up, or straight away for errors a retry can not fix.
+    client = get_client(api_key)
+    limiter = get_limiter(model)
+    estimated = estimate_tokens(messages, kwargs.get('max_tokens'))
+    attempt = 0
+    while True:
+        with stage('rate_limit_wait'):
+            limiter.acquire(estimated)
+        start = time.perf_counter()
+        try:
+            response = client.chat.completions.create(model=model, messages=messages, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            observe_stage('model_call', time.perf_counter() - start)
+            # A failed attempt used no tokens; the retry reserves them again
+            limiter.settle(estimated, 0)
+            retry_after = _retry_after(e)
+            if isinstance(e, RateLimitError):
+                limiter.pause(retry_after or BACKOFF_BASE_SECONDS)
+            if attempt >= OPENAI_MAX_RETRIES:
+                record_model_call(model, token_usage(None), attempt, ok=False)
+                raise
+            delay = backoff_seconds(attempt, retry_after)
+            print(f"Retrying {model} call in {delay:.1f}s after {type(e).__name__}")
+            attempt += 1
+            time.sleep(delay)
+            continue
+        except Exception:
+            observe_stage('model_call', time.perf_counter() - start)
+            limiter.settle(estimated, 0)
+            record_model_call(model, token_usage(None), attempt, ok=False)
+            raise
+        observe_stage('model_call', time.perf_counter() - start)
+        usage = token_usage(response)
+        if usage['input_tokens']:
+            limiter.settle(estimated, usage['input_tokens'] + usage['output_tokens'])
+        record_model_call(model, usage, attempt)
+        return response
@@ -0,0 +1,201 @@
+import hashlib
+import os
+import threading
+from datetime import datetime, timezone
+
+import fitz
+
+from invoice_split import PAGE_MARKER_RE
+from pdf_pages import open_pdf
+from pre_extract import find_gstins
+from worker_pools import run_parse
+
+# Terms and conditions, bank detail and blank pages that vendors append to every invoice.
+# Every page is fingerprinted before anything is rendered for the model: a difference
+# hash of a tiny grayscale render plus a hash of its normalized text layer, or of its
+# embedded images when it has no text. Pages whose
+# fingerprint was already seen in BOILERPLATE_MIN_DOCUMENTS different PDFs of the same
+# vendor (identified by its GSTIN), and blank pages, are left out of the request. The
+# first page always goes to the model.
+PAGE_DEDUP = os.environ.get('PAGE_DEDUP', '1') == '1'
+BOILERPLATE_MIN_DOCUMENTS = int(os.environ.get('BOILERPLATE_MIN_DOCUMENTS', '3'))
+FINGERPRINT_TTL_SECONDS = 90 * 24 * 60 * 60  # fingerprints not seen for this long are dropped
+HASH_SIZE = 16  # 16x16 difference hash, 256 bits
+THUMBNAIL_WIDTH = 96  # pixels
+# Hamming distance still treated as the same page. The text or image hash has to match
+# exactly as well: scans of one layout with different figures hash close together.
+MAX_HASH_DISTANCE = 12
+# Gray levels a cell has to be brighter than its neighbour by, so flat white areas do
+# not flip bits with rendering noise
+DHASH_MARGIN = 2
+BLANK_THRESHOLD = 245
+
+
+def difference_hash(pix):
+    # One bit per pair of horizontally adjacent cells of a (HASH_SIZE + 1) x HASH_SIZE
+    # grid over a single channel pixmap: set when the left cell is brighter
+    width, height, samples = pix.width, pix.height, pix.samples
+    columns = HASH_SIZE + 1
+    sums = [0] * (columns * HASH_SIZE)
+    counts = [0] * (columns * HASH_SIZE)
+    column_of = [x * columns // width for x in range(width)]
+    for y in range(height):
+        row = y * HASH_SIZE // height * columns
+        line = samples[y * width:(y + 1) * width]
+        for x, value in enumerate(line):
+            sums[row + column_of[x]] += value
+            counts[row + column_of[x]] += 1
+    means = [total / count if count else 0 for total, count in zip(sums, counts)]
+    bits = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            cell = row * columns + column
+            bits = bits << 1 | (means[cell] > means[cell + 1] + DHASH_MARGIN)
+    return f"{bits:0{HASH_SIZE * HASH_SIZE // 4}x}"
+
+
+def hash_distance(a, b):
+    return (int(a, 16) ^ int(b, 16)).bit_count()
+
+
+def page_hash(doc, page, text):
+    # Page numbers differ between invoices of different lengths; nothing else is ignored.
+    # A page without text is identified by the raw streams of its images instead.
+    digest = hashlib.sha256()
+    if text.strip():
+        text = PAGE_MARKER_RE.sub(' ', text.lower())
+        digest.update(' '.join(text.split()).encode())
+    else:
+        for xref, *_ in page.get_images(full=True):
+            digest.update(doc.xref_stream_raw(xref) or b'')
+    return digest.hexdigest()
+
+
+def fingerprint_pages(pdf):
+    # Runs in a parse worker
+    doc = open_pdf(pdf)
+    try:
+        pages = []
+        first_text = ''
+        for page in doc:
+            text = page.get_text()
+            if page.number == 0:
+                first_text = text
+            zoom = THUMBNAIL_WIDTH / page.rect.width
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+            pages.append({'page': page.number, 'dhash': difference_hash(pix), 'page_hash': page_hash(doc, page, text),
+                          'blank': not text.strip() and min(pix.samples) >= BLANK_THRESHOLD})
+    finally:
+        doc.close()
+    return {'vendor_gstin': find_gstins(first_text.splitlines()).get('vendor_gstin'), 'pages': pages, 'skip': {}}
+
+
+def same_page(fingerprint, entry):
+    return (fingerprint['page_hash'] == entry['page_hash']
+            and hash_distance(fingerprint['dhash'], entry['dhash']) <= MAX_HASH_DISTANCE)
+
+
+def page_bytes(page):
+    # What a page adds to the request: its text, or its base64 encoded image
+    if 'image' in page:
+        return len(page['image']['data'])
+    return len(page['text'].encode())
+
+
+# Per vendor index of page fingerprints in a MongoDB collection, one document per distinct
+# page with the content hashes of the PDFs it was seen in (up to BOILERPLATE_MIN_DOCUMENTS)
+# and the bytes it took up in the request the last time it was sent.
+class PageIndex:
+    def __init__(self, collection):
+        self.collection = collection
+        self._lock = threading.Lock()
+        self._stats = {'documents': 0, 'pages': 0, 'boilerplate_skipped': 0, 'blank_skipped': 0,
+                       'bytes_skipped': 0}
+        try:
+            self.collection.create_index([('vendor_gstin', 1), ('page_hash', 1)])
+            self.collection.create_index('updated_at', expireAfterSeconds=FINGERPRINT_TTL_SECONDS)
+        except Exception as e:
+            print(f"Error creating page fingerprint indexes: {e}")
+
+    def _entries(self, match):
+        if not match['vendor_gstin']:
+            return []
+        page_hashes = sorted({page['page_hash'] for page in match['pages']})
+        return list(self.collection.find({'vendor_gstin': match['vendor_gstin'], 'page_hash': {'$in': page_hashes}}))
+
+    def match(self, pdf):
+        # The PDF's fingerprints, with match['skip'] = {page number: (reason, bytes)} for
+        # the pages to leave out
+        empty = {'vendor_gstin': None, 'pages': [], 'skip': {}}
+        if not PAGE_DEDUP:
+            return empty
+        try:
+            match = run_parse(fingerprint_pages, pdf)
+            entries = self._entries(match)
+        except Exception as e:
+            print(f"Error fingerprinting pages: {e}")
+            return empty
+
+        now = datetime.now(timezone.utc)
+        for fingerprint in match['pages'][1:]:
+            if fingerprint['blank']:
+                match['skip'][fingerprint['page']] = ('blank', 0)
+                continue
+            for entry in entries:
+                if len(entry['documents']) >= BOILERPLATE_MIN_DOCUMENTS and same_page(fingerprint, entry):
+                    match['skip'][fingerprint['page']] = ('boilerplate', entry.get('bytes', 0))
+                    try:
+                        self.collection.update_one({'_id': entry['_id']}, {'$set': {'updated_at': now}})
+                    except Exception as e:
+                        print(f"Error refreshing page fingerprint: {e}")
+                    break
+
+        with self._lock:
+            self._stats['documents'] += 1
+            self._stats['pages'] += len(match['pages'])
+            for reason, size in match['skip'].values():
+                self._stats[f'{reason}_skipped'] += 1
+                self._stats['bytes_skipped'] += size
+        return match
+
+    def learn(self, match, sizes, content_hash):
+        # Records the pages that were read, with sizes = {page number: page_bytes}, so pages
+        # repeated across a vendor's invoices are recognised next time. The first page holds
+        # the invoice itself and is not kept.
+        if not match['vendor_gstin'] or not sizes:
+            return
+        try:
+            entries = self._entries(match)
+            for fingerprint in match['pages'][1:]:
+                if fingerprint['page'] in match['skip'] or fingerprint['page'] not in sizes:
+                    continue
+                entry = next((entry for entry in entries if same_page(fingerprint, entry)), None)
+                if entry is None:
+                    entry = {'vendor_gstin': match['vendor_gstin'], 'page_hash': fingerprint['page_hash'],
+                             'dhash': fingerprint['dhash'], 'documents': []}
+                    entries.append(entry)
+                if content_hash not in entry['documents'] and len(entry['documents']) < BOILERPLATE_MIN_DOCUMENTS:
+                    entry['documents'].append(content_hash)
+                entry['bytes'] = sizes[fingerprint['page']]
+                entry['updated_at'] = datetime.now(timezone.utc)
+                if '_id' in entry:
+                    self.collection.replace_one({'_id': entry['_id']}, entry)
+                else:
+                    entry['_id'] = self.collection.insert_one(entry).inserted_id
+        except Exception as e:
+            print(f"Error saving page fingerprints: {e}")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+def dedup_report(match):
+    # Per request summary stored with the extraction, or None when nothing was left out
+    if not match['skip']:
+        return None
+    return {
+        'pages_skipped': len(match['skip']),
+        'bytes_skipped': sum(size for _, size in match['skip'].values()),
+        'pages': [{'page': number + 1, 'reason': reason} for number, (reason, _) in sorted(match['skip'].items())],
+    }
@@ -0,0 +1,339 @@
+import base64
+import contextvars
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unicodedata
+
+import fitz
+
+from metrics import observe_stage, record_pages, stage
+from worker_pools import imap_parse, run_parse
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Page images one request renders at the requested dpi, shared by all its files. Past it
+# pages are rendered at lower resolutions, down to MIN_RENDER_DPI, instead of failing.
+IMAGE_BUDGET_BYTES = int(os.environ.get('IMAGE_BUDGET_BYTES', str(64 * 1024 * 1024)))
+MIN_RENDER_DPI = int(os.environ.get('MIN_RENDER_DPI', '100'))
+DPI_STEP = 2 / 3
+
+# A page is sent as text only when its text layer passes all three checks, otherwise it
+# is rasterized and sent as an image.
+MIN_TEXT_CHARS = 50
+MAX_GARBAGE_RATIO = 0.1
+# Scans with an OCR layer are covered by one big image. Their text is only trusted when
+# it also covers a reasonable share of the page.
+SCAN_IMAGE_COVERAGE = 0.5
+MIN_GLYPH_COVERAGE = 0.02
+
+
+# How page images are encoded for the model. The defaults reproduce the original lossless
+# colour PNGs; bench_images.py compares the alternatives on a sample corpus.
+#   format: png, jpeg or webp (webp needs Pillow)
+#   long_edge: pixels on the longer side of the rendered region, 0 renders at the request dpi
+#   detail: low, high or auto as understood by the API, or adaptive to choose per page
+DEFAULT_IMAGE_OPTIONS = {
+    'grayscale': os.environ.get('IMAGE_GRAYSCALE', '0') == '1',
+    'crop': os.environ.get('IMAGE_CROP', '0') == '1',
+    'long_edge': int(os.environ.get('IMAGE_LONG_EDGE', '0')),
+    'format': os.environ.get('IMAGE_FORMAT', 'png'),
+    'quality': int(os.environ.get('IMAGE_QUALITY', '80')),
+    'detail': os.environ.get('IMAGE_DETAIL', 'auto'),
+}
+IMAGE_MIME_TYPES = {'png': 'image/png', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+CROP_MARGIN = 12  # points kept around the detected content
+# With adaptive detail, pages whose cropped content has less ink than this go as low detail
+ADAPTIVE_LOW_DETAIL_INK = 0.01
+
+
+def image_options(**overrides):
+    options = dict(DEFAULT_IMAGE_OPTIONS)
+    options.update(overrides)
+    if options['format'] not in IMAGE_MIME_TYPES:
+        raise ValueError(f"Unsupported image format: {options['format']}")
+    return options
+
+
+def image_options_tag(options=None):
+    # Short stable description of the options, for cache keys and benchmark reports
+    options = options or DEFAULT_IMAGE_OPTIONS
+    return ','.join(f"{key}={options[key]}" for key in sorted(options))
+
+
+# Image bytes left to one request. It is found through a context variable, which the
+# worker pools copy into their threads, so every file and window of the request shares it.
+class ImageBudget:
+    def __init__(self, limit=IMAGE_BUDGET_BYTES):
+        self.remaining = limit
+        self._lock = threading.Lock()
+
+    def take(self, size):
+        # Whether an image of this size still fits; it is counted only when it does
+        with self._lock:
+            if size > self.remaining:
+                return False
+            self.remaining -= size
+            return True
+
+
+_image_budget = contextvars.ContextVar('image_budget', default=None)
+
+
+def start_image_budget(limit=IMAGE_BUDGET_BYTES):
+    # Called at the start of a request. Without it every file gets a budget of its own.
+    _image_budget.set(ImageBudget(limit))
+
+
+def _area(bbox):
+    rect = fitz.Rect(bbox)
+    return abs(rect) if not rect.is_empty else 0.0
+
+
+def _is_garbage(char):
+    if char in '\n\t ':
+        return False
+    # Unmapped glyphs come out as U+FFFD, private use code points or control characters
+    return char == '�' or unicodedata.category(char) in ('Co', 'Cc', 'Cn')
+
+
+def score_page(page):
+    page_area = _area(page.rect) or 1.0
+    text_area = 0.0
+    image_area = 0.0
+    chars = []
+    for block in page.get_text('dict')['blocks']:
+        if block['type'] == 1:
+            image_area += _area(block['bbox'])
+            continue
+        for line in block['lines']:
+            for span in line['spans']:
+                if span['text'].strip():
+                    text_area += _area(span['bbox'])
+                    chars.append(span['text'])
+
+    text = ''.join(chars)
+    visible = [char for char in text if not char.isspace()]
+    garbage = sum(1 for char in visible if _is_garbage(char))
+    return {
+        'char_count': len(visible),
+        'glyph_coverage': round(min(text_area / page_area, 1.0), 4),
+        'image_coverage': round(min(image_area / page_area, 1.0), 4),
+        'garbage_ratio': round(garbage / len(visible), 4) if visible else 1.0,
+    }
+
+
+def has_usable_text(score):
+    if score['char_count'] < MIN_TEXT_CHARS or score['garbage_ratio'] > MAX_GARBAGE_RATIO:
+        return False
+    if score['image_coverage'] >= SCAN_IMAGE_COVERAGE and score['glyph_coverage'] < MIN_GLYPH_COVERAGE:
+        return False
+    return True
+
+
+def open_pdf(pdf):
+    # pdf is a file path, opened without reading it into memory, or the PDF's bytes
+    if isinstance(pdf, str):
+        return fitz.open(pdf, filetype="pdf")
+    return fitz.open(stream=pdf, filetype="pdf")
+
+
+def route_pages(pdf):
+    # Returns one entry per page: the page text when the text layer is usable, or
+    # None when the page has to be rasterized.
+    routes = []
+    doc = open_pdf(pdf)
+    try:
+        for page in doc:
+            score = score_page(page)
+            text = page.get_text() if has_usable_text(score) else None
+            routes.append({'page': page.number, 'text': text, 'score': score})
+    finally:
+        doc.close()
+    return routes
+
+
+def _ink_bounds(pix, threshold=245):
+    # Bounding box (x0, y0, x1, y1) in pixels of everything darker than the threshold
+    # in a single channel pixmap, plus the share of dark pixels. None for a blank page.
+    width, height, samples = pix.width, pix.height, pix.samples
+    rows = [y for y in range(height) if min(samples[y * width:(y + 1) * width]) < threshold]
+    if not rows:
+        return None, 0.0
+    cols = [x for x in range(width) if min(samples[x::width]) < threshold]
+    dark = sum(1 for value in samples if value < threshold)
+    return (cols[0], rows[0], cols[-1] + 1, rows[-1] + 1), dark / (width * height)
+
+
+def _content_clip(page):
+    # Whitespace and margins are found on a cheap low resolution grayscale render
+    scale = 36 / 72
+    preview = page.get_pixmap(matrix=fitz.Matrix(scale, scale), colorspace=fitz.csGRAY, alpha=False)
+    bounds, ink = _ink_bounds(preview)
+    if bounds is None:
+        return page.rect, ink
+    clip = fitz.Rect(*(value / scale for value in bounds)) + (-CROP_MARGIN, -CROP_MARGIN, CROP_MARGIN, CROP_MARGIN)
+    return clip & page.rect, ink
+
+
+def _encode_pixmap(pix, options):
+    if options['format'] == 'png':
+        return pix.tobytes("png")
+    if options['format'] == 'jpeg':
+        return pix.tobytes("jpeg", jpg_quality=options['quality'])
+    if Image is None:
+        raise ValueError("WebP output needs Pillow installed")
+    mode = 'L' if pix.n == 1 else 'RGB'
+    buffer = io.BytesIO()
+    Image.frombytes(mode, (pix.width, pix.height), pix.samples).save(buffer, 'WEBP', quality=options['quality'])
+    return buffer.getvalue()
+
+
+def _render_page(pdf_path, page_number, dpi, options):
+    # Runs in a render worker. Only the base64 text crosses back to the request, the
+    # pixmap and encoded bytes are freed as soon as the page is done.
+    start, cpu_start = time.perf_counter(), time.thread_time()
+    doc = fitz.open(pdf_path)
+    try:
+        page = doc.load_page(page_number)
+        clip, ink = page.rect, None
+        if options['crop'] or options['detail'] == 'adaptive':
+            clip, ink = _content_clip(page)
+            if not options['crop']:
+                clip = page.rect
+
+        zoom = dpi / 72
+        if options['long_edge']:
+            # Never upscale past the requested dpi
+            zoom = min(zoom, options['long_edge'] / max(clip.width, clip.height))
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, alpha=False,
+                              colorspace=fitz.csGRAY if options['grayscale'] else fitz.csRGB)
+
+        detail = options['detail']
+        if detail == 'adaptive':
+            detail = 'low' if ink < ADAPTIVE_LOW_DETAIL_INK else 'high'
+        rendered, cpu_rendered = time.perf_counter(), time.thread_time()
+        data = base64.b64encode(_encode_pixmap(pix, options)).decode()
+        return {
+            'data': data,
+            'dpi': dpi,
+            'mime': IMAGE_MIME_TYPES[options['format']],
+            'detail': detail,
+            'width': pix.width,
+            'height': pix.height,
+            # [wall, cpu] seconds, reported by the caller since this may run in another process
+            'timings': {'render': [rendered - start, cpu_rendered - cpu_start],
+                        'base64_encode': [time.perf_counter() - rendered, time.thread_time() - cpu_rendered]},
+        }
+    finally:
+        doc.close()
+
+
+def estimate_image_tokens(image):
+    # OpenAI's published image pricing: a flat 85 tokens at low detail, otherwise the
+    # image is fitted into 2048x2048, its short side scaled to 768 and billed per 512px tile
+    if image['detail'] == 'low':
+        return 85
+    width, height = image['width'], image['height']
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = -(-int(width) // 512) * -(-int(height) // 512)
+    return 85 + 170 * tiles
+
+
+def image_content(image):
+    # Chat completions content part for a rendered page
+    image_url = {"url": f"data:{image['mime']};base64,{image['data']}"}
+    if image['detail'] != 'auto':
+        image_url["detail"] = image['detail']
+    return {"type": "image_url", "image_url": image_url}
+
+
+def pdf_pages_to_images(pdf_stream, dpi=300, page_numbers=None, options=None):
+    # Yields (page number, image) one page at a time, in page order, where image holds
+    # the base64 data, mime type and detail level. Render workers open the PDF from a
+    # file instead of receiving a copy of it; a stream is copied to a temporary file
+    # first, a path is used as is. Once the request's image budget runs out, pages are
+    # rendered at lower resolutions.
+    options = options or image_options()
+    budget = _image_budget.get() or ImageBudget()
+    if isinstance(pdf_stream, str):
+        pdf_path, temporary = pdf_stream, False
+    else:
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as pdf_file:
+            shutil.copyfileobj(pdf_stream, pdf_file)
+            pdf_path, temporary = pdf_file.name, True
+    try:
+        doc = fitz.open(pdf_path)
+        page_count = len(doc)
+        doc.close()
+        numbers = [number for number in range(page_count) if page_numbers is None or number in page_numbers]
+
+        # Render jobs are queued lazily, so pages queued after a fallback start at its dpi
+        render_dpi = [dpi]
+        images = imap_parse(_render_page, ((pdf_path, number, render_dpi[0], options) for number in numbers))
+        for number, image in zip(numbers, images):
+            image_dpi = image.pop('dpi')
+            while not budget.take(len(image['data'])) and image_dpi > MIN_RENDER_DPI:
+                image_dpi = max(MIN_RENDER_DPI, int(image_dpi * DPI_STEP))
+                render_dpi[0] = min(render_dpi[0], image_dpi)
+                image = run_parse(_render_page, pdf_path, number, image_dpi, options)
+                image.pop('dpi')
+            for stage_name, (seconds, cpu_seconds) in image.pop('timings').items():
+                observe_stage(stage_name, seconds, cpu_seconds)
+            yield number, image
+    finally:
+        if temporary:
+            os.remove(pdf_path)
+
+
+def read_pdf_pages(pdf_stream, skip_pages=None):
+    # (pdf, pages) with the pages in document order, each {'page', 'text'} or, when the
+    # page has no usable text layer, {'page'} to be rendered by stream_pdf_pages. Nothing
+    # is rendered yet. Takes a stream, the PDF's bytes or a file path; a path is read from
+    # disk by the parse and render workers, so the PDF is never held in this process's
+    # memory. The returned pdf is the path or bytes to render from. Pages in skip_pages
+    # are left out. None when the PDF cannot be read.
+    skip_pages = skip_pages or ()
+    try:
+        pdf = pdf_stream if isinstance(pdf_stream, (str, bytes)) else pdf_stream.read()
+        with stage('text_extract'):
+            routes = run_parse(route_pages, pdf)
+    except Exception as e:
+        print(f"Error reading PDF pages: {e}")
+        return None
+
+    pages = []
+    for route in routes:
+        if route['page'] in skip_pages:
+            continue
+        if route['text'] is None:
+            pages.append({'page': route['page']})
+        else:
+            pages.append({'page': route['page'], 'text': route['text']})
+    image_count = sum(1 for page in pages if 'text' not in page)
+    record_pages(len(pages) - image_count, image_count, len(skip_pages))
+    return pdf, pages
+
+
+def stream_pdf_pages(pdf, pages, dpi=300, options=None):
+    # Yields the pages of read_pdf_pages in order, rendering the image pages as they are
+    # reached, each {'page', 'image'} with the image as yielded by pdf_pages_to_images.
+    # A page is let go by this generator as soon as it is yielded.
+    image_pages = {page['page'] for page in pages if 'text' not in page}
+    source = pdf if isinstance(pdf, str) else io.BytesIO(pdf)
+    images = pdf_pages_to_images(source, dpi, image_pages, options) if image_pages else iter(())
+    for page in pages:
+        if 'text' in page:
+            yield page
+            continue
+        number, image = next(images)
+        yield {'page': number, 'image': image}
@@ -0,0 +1,238 @@
+import json
+import os
+import re
+import threading
+from datetime import datetime
+
+# Rule based extraction of the strictly formatted invoice fields from the PDF text layer.
+# A field is only reported when the rules are unambiguous; everything else is left to
+# the model, which gets the confident values as hints.
+PRE_EXTRACT_VERSION = '1'
+
+GSTIN_CHARS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+GSTIN_RE = re.compile(r'\b(\d{2}[A-Z]{5}\d{4}[A-Z][1-9A-Z]Z[0-9A-Z])\b')
+PAN_RE = re.compile(r'\b([A-Z]{3}[ABCFGHJLPT][A-Z]\d{4}[A-Z])\b')
+IRN_RE = re.compile(r'\b([0-9a-f]{64})\b', re.IGNORECASE)
+AMOUNT_RE = re.compile(r'(\d{1,3}(?:,\d{2,3})+(?:\.\d{1,2})?|\d+\.\d{1,2}|\d+)')
+
+BUYER_LABELS = ('bill to', 'billed to', 'buyer', 'customer', 'consignee', 'ship to', 'recipient', 'sold to')
+DATE_LABELS = re.compile(r'(invoice\s*date|inv\.?\s*date|bill\s*date|date\s*of\s*invoice|dated)\b', re.IGNORECASE)
+TOTAL_LABELS = re.compile(r'(grand\s*total|total\s*invoice\s*(value|amount)|invoice\s*total|total\s*amount\s*'
+                          r'(payable|due)?|net\s*payable|amount\s*payable|total\s*payable)', re.IGNORECASE)
+DATE_FORMATS = ('%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y', '%Y-%m-%d', '%d/%m/%y', '%d-%m-%y', '%d-%b-%Y', '%d %b %Y',
+                '%d-%b-%y', '%d %B %Y', '%d %b, %Y', '%d %B, %Y', '%b %d, %Y', '%B %d, %Y')
+DATE_RE = re.compile(r'(\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}|\d{4}-\d{2}-\d{2}|\d{1,2}[ -][A-Za-z]{3,9},?[ -]\d{2,4}'
+                     r'|[A-Za-z]{3,9} \d{1,2}, \d{4})')
+LOOKAHEAD_LINES = 2  # a label's value may be on the next line(s) of the text layer
+
+# Where each locally extracted field lives in each output schema
+SCHEMA_FIELDS = {
+    'multi': {
+        'vendor_gstin': 'Details.tax_details.gst_number',
+        'vendor_pan': 'Details.tax_details.pan_id',
+        'invoice_date': 'Details.invoice_details.invoices_date',
+        'total_amount': 'purchase_details.total_amount_with_gst',
+    },
+    'integrated': {
+        'vendor_gstin': 'gst_number',
+        'vendor_pan': 'pan_id',
+        'invoice_date': 'invoice_date',
+        'total_amount': 'total_amount_with_gst',
+    },
+    'vlm': {
+        'irn': 'IRN_number',
+        'vendor_gstin': 'vendor_gst_number',
+        'vendor_pan': 'vendor_pan',
+        'billing_gstin': 'billing_gst_number',
+        'billing_pan': 'billing_pan',
+        'invoice_date': 'invoice_date',
+        'total_amount': 'total_invoice_amount',
+    },
+    'perf_score': {
+        'irn': 'IRN',
+        'vendor_gstin': 'vendor_gst',
+        'vendor_pan': 'vendor_pan',
+        'billing_gstin': 'billing_gst',
+        'billing_pan': 'billing_pan',
+        'invoice_date': 'invoice_date',
+        'total_amount': 'total_invoice_amount',
+    },
+}
+# The model call is skipped when all of these resolve locally, and the invoice is stored
+# with only the fields the rules found. Only fields of SCHEMA_FIELDS count; an empty
+# PRE_EXTRACT_REQUIRED always calls the model.
+REQUIRED_FIELDS = [field.strip() for field in
+                   os.environ.get('PRE_EXTRACT_REQUIRED', 'vendor_gstin,invoice_date,total_amount').split(',')
+                   if field.strip()]
+
+
+def pre_extract_tag():
+    # Which invoices skip the model depends on the required fields as well as the rules
+    return f"pre-extract-{PRE_EXTRACT_VERSION}-{'+'.join(REQUIRED_FIELDS) or 'model'}"
+
+
+def gstin_checksum_valid(gstin):
+    total = 0
+    for index, char in enumerate(gstin[:14]):
+        value = GSTIN_CHARS.index(char) * (2 if index % 2 else 1)
+        total += value // 36 + value % 36
+    return gstin[14] == GSTIN_CHARS[(36 - total % 36) % 36]
+
+
+def _near_buyer_label(lines, index):
+    context = ' '.join(lines[max(0, index - 3):index + 1]).lower()
+    return any(label in context for label in BUYER_LABELS)
+
+
+def find_gstins(lines):
+    vendor, billing = [], []
+    for index, line in enumerate(lines):
+        for gstin in GSTIN_RE.findall(line.upper()):
+            if not gstin_checksum_valid(gstin):
+                continue
+            (billing if _near_buyer_label(lines, index) else vendor).append(gstin)
+    fields = {}
+    # The seller's GSTIN is the first one outside a buyer block; it is only trusted when
+    # no other unlabelled GSTIN disagrees with it
+    if vendor and len(set(vendor)) == 1:
+        fields['vendor_gstin'] = vendor[0]
+        fields['vendor_pan'] = vendor[0][2:12]
+    if billing and len(set(billing) - set(vendor)) == 1:
+        fields['billing_gstin'] = next(gstin for gstin in billing if gstin not in vendor)
+        fields['billing_pan'] = fields['billing_gstin'][2:12]
+    return fields
+
+
+def parse_date(value):
+    value = value.strip().rstrip('.,')
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return None
+
+
+def _labelled_values(lines, label_re, value_re):
+    values = []
+    for index, line in enumerate(lines):
+        match = label_re.search(line)
+        if not match:
+            continue
+        # The value is to the right of the label, or on one of the following lines
+        candidates = [line[match.end():]] + lines[index + 1:index + 1 + LOOKAHEAD_LINES]
+        for candidate in candidates:
+            found = value_re.search(candidate)
+            if found:
+                values.append(found.group(1))
+                break
+    return values
+
+
+def find_invoice_date(lines):
+    dates = {parse_date(value) for value in _labelled_values(lines, DATE_LABELS, DATE_RE)}
+    dates.discard(None)
+    return dates.pop() if len(dates) == 1 else None
+
+
+def find_total(lines):
+    amounts = {float(value.replace(',', '')) for value in _labelled_values(lines, TOTAL_LABELS, AMOUNT_RE)}
+    amounts.discard(0.0)
+    # Sub totals are labelled like totals too; only the largest one can be the invoice total,
+    # and it is trusted when no amount anywhere in the text is larger
+    if not amounts:
+        return None
+    total = max(amounts)
+    everything = [float(value.replace(',', '')) for line in lines for value in AMOUNT_RE.findall(line)
+                  if '.' in value or ',' in value]
+    return total if not everything or total >= max(everything) else None
+
+
+def find_irn(text):
+    irns = {irn.lower() for irn in IRN_RE.findall(text)}
+    return irns.pop() if len(irns) == 1 else None
+
+
+def pre_extract(text):
+    # Returns {field: value} for the fields resolved with confidence
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    fields = find_gstins(lines)
+    irn = find_irn(text)
+    if irn:
+        fields['irn'] = irn
+    invoice_date = find_invoice_date(lines)
+    if invoice_date:
+        fields['invoice_date'] = invoice_date
+    total = find_total(lines)
+    if total is not None:
+        fields['total_amount'] = total
+    return fields
+
+
+def _schema_value(schema, field, value):
+    if field == 'total_amount' and schema in ('vlm', 'perf_score'):
+        value = f"{value:.2f}"
+    if schema == 'perf_score':
+        return {'value': value, 'conf': 1.0}
+    return value
+
+
+def set_path(doc, path, value):
+    keys = path.split('.')
+    for key in keys[:-1]:
+        if not isinstance(doc.get(key), dict):
+            doc[key] = {}
+        doc = doc[key]
+    doc[keys[-1]] = value
+
+
+def apply_fields(doc, schema, fields):
+    # Local values win over whatever the model returned for the same field
+    for field, value in fields.items():
+        if field in SCHEMA_FIELDS[schema]:
+            set_path(doc, SCHEMA_FIELDS[schema][field], _schema_value(schema, field, value))
+    return doc
+
+
+def schema_hints(schema, fields):
+    return {SCHEMA_FIELDS[schema][field]: _schema_value(schema, field, value)
+            for field, value in fields.items() if field in SCHEMA_FIELDS[schema]}
+
+
+def hint_text(schema, fields):
+    hints = schema_hints(schema, fields)
+    if not hints:
+        return None
+    return ("These fields were already read from the document's text layer and are correct: "
+            f"{json.dumps(hints)}. Copy them as given and extract only the remaining fields.")
+
+
+def all_required_resolved(schema, fields):
+    required = [field for field in REQUIRED_FIELDS if field in SCHEMA_FIELDS[schema]]
+    return bool(required) and all(field in fields for field in required)
+
+
+# Per field hit rates: how often each field was resolved locally out of all documents seen
+class PreExtractStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.documents = 0
+        self.model_calls_skipped = 0
+        self.hits = {field: 0 for field in ('irn', 'vendor_gstin', 'vendor_pan', 'billing_gstin', 'billing_pan',
+                                            'invoice_date', 'total_amount')}
+
+    def record(self, fields, skipped):
+        with self._lock:
+            self.documents += 1
+            self.model_calls_skipped += int(skipped)
+            for field in fields:
+                self.hits[field] += 1
+
+    def stats(self):
+        with self._lock:
+            documents = self.documents or 1
+            return {
+                'documents': self.documents,
+                'model_calls_skipped': self.model_calls_skipped,
+                'hit_rates': {field: round(hits / documents, 4) for field, hits in self.hits.items()},
+            }
@@ -0,0 +1,161 @@
+from pdf_pages import image_content
+
+# One versioned system prompt per output schema. The instructions never change between
+# invoices and always come first, so the provider can cache that prefix; the invoice
+# itself is the last message. Bump a version whenever its prompt text changes, cached
+# extraction results are keyed on it.
+
+_VLM_RULES = """STRICT FORMATTING RULES:
+1. ALL values must be strings (including numbers, amounts, quantities)
+2. Dates MUST be in YYYY-MM-DD format
+3. Empty fields should use empty string ("") not null or N/A
+4. Currency amounts should be strings without symbols (e.g. '2500.00' not '₹2,500')
+5. Maintain the exact JSON structure with all fields present
+6. For missing dates, use empty string ("") not 0000-00-00
+7. For tax amounts/rates, use string formatted numbers ('18.00' not 18)
+8. {confidence_rule}
+9. For tax categories, keep the hardcoded values (IGST/CGST/SGST)
+10. Provide ONLY the raw JSON output with no additional text, explanations, or formatting outside the JSON structure."""
+
+PROMPTS = {
+    'multi': {
+        'version': '3',
+        'system': """You extract details from invoice text and reply with a single JSON object only, ensuring no backslashes are present.
+
+Extract the following details from the invoice:
+1. Invoice date (format: YYYY-MM-DD)
+2. Invoice number
+3. Purchase order number
+4. Purchase date (format: YYYY-MM-DD)
+5. Purchaser address
+6. PAN ID
+7. GST number
+8. List of items
+9. Total amount including GST
+
+Output structure:
+{"Details": {"invoice_details": {"invoice_number": "string", "invoices_date": "YYYY-MM-DD", "purchase_order_number": "string", "purchases_date": "YYYY-MM-DD"}, "tax_details": {"pan_id": "string", "gst_number": "string"}, "purchaser_address": "string"}, "purchase_details": {"items": [], "total_amount_with_gst": number}}
+
+Rules:
+- Ensure all attributes are included even if they have a value of 0.
+- If the invoice spans multiple pages or there are multiple invoices in one PDF but share the same address and ID, merge them into a single invoice.
+- For all price and quantity values, ensure they are in number format (not string format). For example, 'quantity': 2 and 'unit_price': 100.00.
+- Replace any special characters or symbols such as '₹' with 'Rs.' throughout the document.
+- If any required fields are missing or empty, set their values to 'N/A'.
+- Sum the 'total_price' of all items to verify it matches the 'total_amount_with_gst'.
+
+Example: {"Details": {"invoice_details": {"invoice_number": "INV123456", "invoices_date": "2023-05-21", "purchase_order_number": "PO654321", "purchases_date": "2023-05-20"}, "tax_details": {"pan_id": "ABCDE1234F", "gst_number": "12ABCDE3456F1Z1"}, "purchaser_address": "123 Street Name, City, State, ZIP"}, "purchase_details": {"items": [{"name": "Item1", "quantity": 2, "unit_price": 100, "total_price": 200}, {"name": "Item2", "quantity": 0, "unit_price": 0, "total_price": 0}], "total_amount_with_gst": 230.50}}""",
+    },
+    'integrated': {
+        'version': '2',
+        'system': """You extract details from invoice text and reply with a single JSON object in one line without any backslashes.
+
+Extract the following details from the invoice:
+1. Invoice date (format: YYYY-MM-DD)
+2. Invoice number
+3. Purchase order number
+4. Purchase date (format: YYYY-MM-DD)
+5. Purchaser address
+6. List of items (name, quantity, unit price, total price)
+7. PAN ID
+8. GST number
+9. Total amount including GST
+
+Rules:
+- If an attribute has a value of 0, include it in the output with the value 0.
+- If the invoice spans multiple pages or there are multiple invoices in one PDF but share the same address and ID, merge them into a single invoice.
+- For all price and quantity values, ensure they are in number format (not string format). For example, "quantity": 2 and "unit_price": 100.00.
+- Replace any special characters or symbols such as '₹' with 'Rs.' throughout the document.
+- The currency has to be mentioned separately just before the list of items.
+- If any required fields are missing or empty, set their values to 'N/A'.
+- Sum the 'total price' of all items to verify it matches the 'total amount with GST'.
+
+Example: {"invoice_date": "2023-05-21", "invoice_number": "INV123456", "purchase_order_number": "PO654321", "purchase_date": "2023-05-20", "purchaser_address": "123 Street Name, City, State, ZIP", "items": [{"name": "Item1", "quantity": 2, "unit_price": 100, "total_price": 200}, {"name": "Item2", "quantity": 0, "unit_price": 0, "total_price": 0}], "pan_id": "ABCDE1234F", "gst_number": "12ABCDE3456F1Z1", "total_amount_with_gst": 230.50}""",
+    },
+    'vlm': {
+        'version': '3',
+        'system': """You are an assistant that ONLY replies with valid JSON matching the specified schema, with no extra text or explanations.
+
+Extract invoice data from the pages provided by the user, given as page images or as the page's text layer. Format it as specified with all values as strings and dates in YYYY-MM-DD format. Omit confidence scores from final output but use them internally for validation.
+
+Schema:
+{"IRN_number": "string", "invoice_number": "string", "invoice_date": "YYYY-MM-DD", "invoice_header": "string", "po_number": "string", "po_date": "YYYY-MM-DD", "vendor_name": "string", "vendor_address": "string", "vendor_gst_number": "string", "vendor_pan": "string", "bill_to_name": "string", "billing_address": "string", "billing_gst_number": "string", "billing_pan": "string", "ship_to_address": "string", "total_invoice_amount": "string", "line_items": [{"item_description": "string", "hsn_sac_code": "string", "unit_of_measurement": "string", "quantity": "string", "base_amount": "string", "total_amount": "string"}], "taxes": [{"category": "IGST", "rate": "string", "amount": "string"}, {"category": "CGST", "rate": "string", "amount": "string"}, {"category": "SGST", "rate": "string", "amount": "string"}], "additional_data": []}
+
+""" + _VLM_RULES.replace('{confidence_rule}', "Use confidence scores internally to validate data quality, but OMIT them from final output"),
+    },
+    'perf_score': {
+        'version': '3',
+        'system': """You are an assistant that ONLY replies with valid JSON matching the specified schema, with no extra text or explanations.
+
+Extract invoice data from the pages provided by the user, given as page images or as the page's text layer. Format it as specified with all values as strings and dates in YYYY-MM-DD format.
+
+Schema:
+{"IRN": {"value": "string", "conf": 0.0}, "invoice_number": {"value": "string", "conf": 0.0}, "invoice_date": {"value": "YYYY-MM-DD", "conf": 0.0}, "invoice_header": {"value": "string", "conf": 0.0}, "po_number": {"value": "string", "conf": 0.0}, "po_date": {"value": "YYYY-MM-DD", "conf": 0.0}, "vendor_name": {"value": "string", "conf": 0.0}, "vendor_address": {"value": "string", "conf": 0.0}, "vendor_gst": {"value": "string", "conf": 0.0}, "vendor_pan": {"value": "string", "conf": 0.0}, "bill_to_name": {"value": "string", "conf": 0.0}, "billing_address": {"value": "string", "conf": 0.0}, "billing_gst": {"value": "string", "conf": 0.0}, "billing_pan": {"value": "string", "conf": 0.0}, "ship_to_address": {"value": "string", "conf": 0.0}, "total_invoice_amount": {"value": "string", "conf": 0.0}, "line_items": [{"item_description": {"value": "string", "conf": 0.0}, "hsn_sac_code": {"value": "string", "conf": 0.0}, "unit_of_measurement": {"value": "string", "conf": 0.0}, "quantity": {"value": "string", "conf": 0.0}, "base_amount": {"value": "string", "conf": 0.0}, "total_amount": {"value": "string", "conf": 0.0}}], "taxes": [{"category": {"value": "IGST", "conf": 1.0}, "rate": {"value": "string", "conf": 0.0}, "amount": {"value": "string", "conf": 0.0}}, {"category": {"value": "CGST", "conf": 1.0}, "rate": {"value": "string", "conf": 0.0}, "amount": {"value": "string", "conf": 0.0}}, {"category": {"value": "SGST", "conf": 1.0}, "rate": {"value": "string", "conf": 0.0}, "amount": {"value": "string", "conf": 0.0}}], "additional_data": []}
+
+""" + _VLM_RULES.replace('{confidence_rule}', "Use confidence scores. They are not binary values and are scaled between 0 and 1") + """
+11. Some of the text may be handwritten and there is a good chance that you may confuse some letters with numbers. Make sure you are precise. Also these handwritten texts may be present in middle of typed out text so ensure that you read and understand everything before providing me with an output
+12. In [{key1:val1,key2:val2}], key is the heading while the value is the value for that heading. There is no restriction for the number of key values. But make sure that only important aspects are taken in the key value section wrt the invoice
+13. The values shown in the above format have conf: 0.0. These are the default confidence scores which you update once you have generated the json output""",
+    },
+    # Second pass of flask_perf_score over fields the first pass was unsure of
+    'perf_score_refine': {
+        'version': '1',
+        'system': """You are an assistant that ONLY replies with valid JSON, with no extra text or explanations.
+
+The user lists invoice fields whose values were read with low confidence, each with its current value and the numbered image regions that show it. The regions are high resolution crops of the invoice pages. Read each field again from its regions.
+
+Reply with {"fields": {"<field path>": {"value": "string", "conf": 0.0}}} containing every listed field path exactly as given.
+
+""" + _VLM_RULES.replace('{confidence_rule}', "conf is your confidence in the value, scaled between 0 and 1. Give an empty value with conf 0.0 when the field is not visible in its regions"),
+    },
+}
+
+
+def prompt_version(schema):
+    return PROMPTS[schema]['version']
+
+
+def build_messages(schema, invoice_content, hints=None):
+    # Per invoice hints go after the invoice so the cached prefix is unchanged
+    if hints and isinstance(invoice_content, str):
+        invoice_content = f"{invoice_content}\n\n{hints}"
+    elif hints:
+        invoice_content = invoice_content + [{"type": "text", "text": hints}]
+    return [
+        {"role": "system", "content": PROMPTS[schema]['system']},
+        {"role": "user", "content": invoice_content},
+    ]
+
+
+def text_and_images(pages):
+    # User message content of flask_multi: the text layers joined, followed by the images
+    # of the pages that have none
+    text = "".join(page['text'] for page in pages if 'text' in page)
+    images = [page['image'] for page in pages if 'image' in page]
+    if not images:
+        return text
+    return [{"type": "text", "text": text}] + [image_content(image) for image in images]
+
+
+def page_contents(pages):
+    # User message content for routed pages: text layers as text parts, the rest as images
+    contents = []
+    for page in pages:
+        if 'image' in page:
+            contents.append(image_content(page['image']))
+        else:
+            contents.append({"type": "text", "text": f"Page {page['page'] + 1}:\n{page['text']}"})
+    return contents
+
+
+def token_usage(response):
+    # Input tokens include the cached ones; cached tokens are billed at a discount
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return {'input_tokens': 0, 'cached_tokens': 0, 'output_tokens': 0}
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return {
+        'input_tokens': usage.prompt_tokens,
+        'cached_tokens': (getattr(details, 'cached_tokens', None) or 0) if details else 0,
+        'output_tokens': usage.completion_tokens,
+    }
@@ -0,0 +1,237 @@
+import base64
+import json
+import os
+
+import fitz
+
+from metrics import stage
+from openai_pool import chat_completion
+from pdf_pages import estimate_image_tokens, image_content, open_pdf
+from prompts import build_messages, prompt_version, token_usage
+from vendor_templates import locate_value, value_kind
+
+# Second pass for flask_perf_score: fields whose conf is below the threshold are read
+# again from high resolution crops of just the page regions that hold them, found from
+# the text layer, in one small model call. Fields that can not be located on any page
+# keep their first pass value.
+REFINE_CONF_THRESHOLD = float(os.environ.get('REFINE_CONF_THRESHOLD', '0.7'))
+REFINE_DPI = int(os.environ.get('REFINE_DPI', '300'))
+REFINE_LONG_EDGE = int(os.environ.get('REFINE_LONG_EDGE', '1024'))  # pixels, keeps each crop to a few tiles
+REFINE_MAX_FIELDS = int(os.environ.get('REFINE_MAX_FIELDS', '20'))
+REFINE_MAX_REGIONS = int(os.environ.get('REFINE_MAX_REGIONS', '8'))
+REFINE_SCHEMA = 'perf_score_refine'
+
+# Points added around a located value: to the left for its label, and a line above and below
+CONTEXT_LEFT = 160
+CONTEXT_RIGHT = 40
+CONTEXT_Y = 14
+# A label found instead of its value: the value is to its right or on the lines below
+LABEL_VALUE_WIDTH = 240
+LABEL_VALUE_LINES = 30
+ITEM_LISTS = ('line_items', 'taxes')
+ITEM_ANCHORS = ('item_description', 'total_amount', 'base_amount', 'amount')
+# Labels searched for when a header field's value is empty or not on any page
+FIELD_LABELS = {
+    'IRN': ('IRN',),
+    'invoice_number': ('Invoice No', 'Invoice Number', 'Invoice #', 'Bill No'),
+    'invoice_date': ('Invoice Date', 'Bill Date', 'Dated'),
+    'invoice_header': ('Tax Invoice', 'Invoice'),
+    'po_number': ('PO No', 'P.O. No', 'PO Number', 'Order No'),
+    'po_date': ('PO Date', 'P.O. Date', 'Order Date'),
+    'vendor_gst': ('GSTIN',),
+    'vendor_pan': ('PAN',),
+    'billing_gst': ('GSTIN',),
+    'billing_pan': ('PAN',),
+    'bill_to_name': ('Bill To', 'Billed To', 'Buyer'),
+    'billing_address': ('Bill To', 'Billed To', 'Buyer'),
+    'ship_to_address': ('Ship To', 'Consignee'),
+    'total_invoice_amount': ('Grand Total', 'Invoice Total', 'Total Amount', 'Net Payable', 'Amount Payable'),
+}
+
+
+def refine_tag():
+    return f"refine-{REFINE_CONF_THRESHOLD}-{REFINE_DPI}-{REFINE_LONG_EDGE}-{prompt_version(REFINE_SCHEMA)}"
+
+
+def _conf(entry):
+    try:
+        return float(entry.get('conf', 0.0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _is_field(entry):
+    return isinstance(entry, dict) and 'value' in entry
+
+
+def low_confidence_fields(doc, threshold=REFINE_CONF_THRESHOLD):
+    # [(path, entry)] of the fields below the threshold, least confident first
+    fields = [(key, entry) for key, entry in doc.items() if _is_field(entry) and _conf(entry) < threshold]
+    for list_key in ITEM_LISTS:
+        for index, item in enumerate(doc.get(list_key) or []):
+            if not isinstance(item, dict):
+                continue
+            fields.extend((f"{list_key}.{index}.{key}", entry) for key, entry in item.items()
+                          if key != 'category' and _is_field(entry) and _conf(entry) < threshold)
+    fields.sort(key=lambda field: _conf(field[1]))
+    return fields[:REFINE_MAX_FIELDS]
+
+
+def _get_path(doc, path):
+    for key in path.split('.'):
+        doc = doc[int(key)] if isinstance(doc, list) else doc[key]
+    return doc
+
+
+def _page_words(page):
+    width, height = page.rect.width, page.rect.height
+    return [[x0 / width, y0 / height, x1 / width, y1 / height, text]
+            for x0, y0, x1, y1, text, *_ in page.get_text('words')]
+
+
+def _find_value(pages, value):
+    # (page number, rect in points) of the first page holding the value
+    value = str(value).strip()
+    if not value:
+        return None
+    kind = value_kind(value)
+    for number, (page, words) in enumerate(pages):
+        box = locate_value(words, value, kind)
+        if box:
+            width, height = page.rect.width, page.rect.height
+            return number, fitz.Rect(box[0] * width, box[1] * height, box[2] * width, box[3] * height)
+    return None
+
+
+def _find_label(pages, labels):
+    for number, (page, _) in enumerate(pages):
+        for label in labels:
+            rects = page.search_for(label)
+            if rects:
+                return number, rects[0]
+    return None
+
+
+def locate_field(pages, doc, path):
+    # (page number, region) to crop for a field, or None when it is not on any page
+    keys = path.split('.')
+    if len(keys) == 3:
+        # A line item or tax row is shown whole, found from its most distinctive value
+        item = doc[keys[0]][int(keys[1])]
+        for anchor in ITEM_ANCHORS + (keys[2],):
+            found = _find_value(pages, item[anchor]['value']) if _is_field(item.get(anchor)) else None
+            if found:
+                number, rect = found
+                page = pages[number][0]
+                return number, fitz.Rect(0, rect.y0 - CONTEXT_Y, page.rect.width, rect.y1 + CONTEXT_Y)
+        return None
+
+    found = _find_value(pages, _get_path(doc, path)['value'])
+    if found:
+        number, rect = found
+        return number, rect + (-CONTEXT_LEFT, -CONTEXT_Y, CONTEXT_RIGHT, CONTEXT_Y)
+    found = _find_label(pages, FIELD_LABELS.get(path, ()))
+    if found:
+        number, rect = found
+        return number, fitz.Rect(rect.x0 - CONTEXT_Y, rect.y0 - CONTEXT_Y, rect.x1 + LABEL_VALUE_WIDTH,
+                                 rect.y1 + LABEL_VALUE_LINES)
+    return None
+
+
+def merge_regions(located):
+    # {path: (page, rect)} -> [(page, rect, [paths])], overlapping regions of a page joined
+    regions = []
+    for path, (number, rect) in located.items():
+        for region in regions:
+            if region[0] == number and region[1].intersects(rect):
+                region[1] |= rect
+                region[2].append(path)
+                break
+        else:
+            regions.append([number, fitz.Rect(rect), [path]])
+    return regions
+
+
+def render_region(page, rect):
+    clip = rect & page.rect
+    zoom = REFINE_DPI / 72
+    if REFINE_LONG_EDGE:
+        zoom = min(zoom, REFINE_LONG_EDGE / max(clip.width, clip.height))
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, alpha=False)
+    return {'data': base64.b64encode(pix.tobytes("png")).decode(), 'mime': 'image/png', 'detail': 'high',
+            'width': pix.width, 'height': pix.height}
+
+
+def _request_content(fields, regions, images):
+    region_numbers = {}
+    for index, (_, _, paths) in enumerate(regions):
+        for path in paths:
+            region_numbers.setdefault(path, []).append(index + 1)
+    listing = '\n'.join(f"- {path}: currently {json.dumps(entry['value'])} (conf {_conf(entry)}), "
+                        f"region {', '.join(map(str, region_numbers[path]))}"
+                        for path, entry in fields if path in region_numbers)
+    content = [{"type": "text", "text": f"Fields to read again:\n{listing}"}]
+    for index, ((number, _, _), image) in enumerate(zip(regions, images)):
+        content.append({"type": "text", "text": f"Region {index + 1} (page {number + 1}):"})
+        content.append(image_content(image))
+    return content
+
+
+def refine_low_confidence(api_key, model, pdf_source, doc, threshold=REFINE_CONF_THRESHOLD):
+    # Updates doc in place. Every field sent for refinement records conf_original and
+    # conf_refined; its value is replaced when the second read is at least as confident.
+    fields = low_confidence_fields(doc, threshold)
+    if not fields:
+        return doc
+    pdf = open_pdf(pdf_source)
+    try:
+        with stage('refine_locate'):
+            pages = [(page, _page_words(page)) for page in pdf]
+            located = {}
+            for path, _ in fields:
+                found = locate_field(pages, doc, path)
+                if found:
+                    located[path] = found
+            regions = merge_regions(located)[:REFINE_MAX_REGIONS]
+        with stage('refine_render'):
+            images = [render_region(pages[number][0], rect) for number, rect, _ in regions]
+    finally:
+        pdf.close()
+
+    sent = [path for _, _, paths in regions for path in paths]
+    doc['refinement'] = {
+        'threshold': threshold,
+        'fields': sent,
+        'not_located': [path for path, _ in fields if path not in sent],
+        'regions': len(regions),
+        'image_tokens': sum(estimate_image_tokens(image) for image in images),
+    }
+    if not regions:
+        return doc
+
+    try:
+        with stage('prompt_build'):
+            messages = build_messages(REFINE_SCHEMA, _request_content(fields, regions, images))
+        response = chat_completion(api_key, model=model, messages=messages, temperature=0, max_tokens=1000)
+        with stage('json_decode'):
+            refined = json.loads(response.choices[0].message.content).get('fields', {})
+    except Exception as e:
+        print(f"Error refining low confidence fields: {e}")
+        return doc
+
+    usage = token_usage(response)
+    doc['refinement']['token_usage'] = usage
+    if isinstance(doc.get('token_usage'), dict):
+        doc['token_usage'] = {key: doc['token_usage'].get(key, 0) + usage[key] for key in usage}
+    for path in sent:
+        entry = _get_path(doc, path)
+        entry['conf_original'] = _conf(entry)
+        new = refined.get(path)
+        if not _is_field(new):
+            entry['conf_refined'] = None
+            continue
+        entry['conf_refined'] = _conf(new)
+        if str(new['value']).strip() and entry['conf_refined'] >= entry['conf_original']:
+            entry['value'] = new['value']
+            entry['conf'] = entry['conf_refined']
+    return doc
@@ -0,0 +1,148 @@
+import gzip
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# In-process cache of the JSON bodies served by the invoice read endpoints. Entries are
+# dropped when an invoice is inserted or updated through this process; the TTL bounds how
+# long another server process's writes can go unseen. Every response carries an ETag so
+# clients revalidate with a 304 instead of downloading the body again, and large bodies
+# are sent brotli (when installed) or gzip compressed, each encoding compressed once.
+RESPONSE_CACHE_ENTRIES = int(os.environ.get('RESPONSE_CACHE_ENTRIES', '1024'))
+RESPONSE_CACHE_BYTES = int(os.environ.get('RESPONSE_CACHE_BYTES', str(64 * 1024 * 1024)))
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', '60'))
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '1024'))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # brotli's fast end; 11 is several times slower for a few percent
+
+
+def _compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _encoding(size):
+    if size < COMPRESS_MIN_BYTES:
+        return None
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+class ResponseCache:
+    def __init__(self, max_entries=RESPONSE_CACHE_ENTRIES, max_bytes=RESPONSE_CACHE_BYTES,
+                 ttl_seconds=RESPONSE_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'invalidations': 0, 'not_modified': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry['size'] + sum(len(data) for data in entry['encoded'].values())
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.time() - entry['stored_at'] >= self.ttl_seconds:
+                self._drop(key)
+                entry = None
+            if entry:
+                self._entries.move_to_end(key)
+            self._stats['hits' if entry else 'misses'] += 1
+            return entry
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def put(self, key, body, filename=None, generation=None):
+        # filename ties a single invoice's response to that invoice; responses without one,
+        # like invoice lists, are dropped on every write. A body read before a write that
+        # landed meanwhile (generation changed) is served but not kept.
+        entry = {'key': key, 'body': body, 'etag': hashlib.sha256(body).hexdigest()[:32], 'filename': filename,
+                 'encoded': {}, 'size': len(body), 'stored_at': time.time()}
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return entry
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = entry
+            self._bytes += entry['size']
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._drop(next(iter(self._entries)))
+            self._stats['stores'] += 1
+        return entry
+
+    def invalidate(self, filenames=None):
+        # None drops everything
+        filenames = None if filenames is None else set(filenames)
+        with self._lock:
+            self._generation += 1
+            for key, entry in list(self._entries.items()):
+                if filenames is None or entry['filename'] is None or entry['filename'] in filenames:
+                    self._drop(key)
+            self._stats['invalidations'] += 1
+
+    def _encoded(self, entry, encoding):
+        data = entry['encoded'].get(encoding)
+        if data is None:
+            data = _compress(entry['body'], encoding)
+            with self._lock:
+                if encoding not in entry['encoded']:
+                    entry['encoded'][encoding] = data
+                    if self._entries.get(entry['key']) is entry:
+                        self._bytes += len(data)
+        return data
+
+    def respond(self, entry):
+        # The cached body as a conditional response for the current request
+        encoding = _encoding(entry['size'])
+        response = Response(self._encoded(entry, encoding) if encoding else entry['body'], mimetype='application/json')
+        response.vary.add('Accept-Encoding')
+        # Revalidated on every use, so an edited invoice is never served from a browser cache
+        response.cache_control.no_cache = True
+        if encoding:
+            response.content_encoding = encoding
+        response.set_etag(f"{entry['etag']}-{encoding}" if encoding else entry['etag'])
+        response.make_conditional(request)
+        if response.status_code == 304:
+            self._count('not_modified')
+        return response
+
+    def serve(self, build, filename=None):
+        # build() makes the response on a miss; only 200 responses are cached
+        key = (request.path, tuple(sorted(request.args.items(multi=True))))
+        entry = self.get(key)
+        if entry is None:
+            generation = self.generation()
+            response = build()
+            if not isinstance(response, Response) or response.status_code != 200:
+                return response
+            entry = self.put(key, response.get_data(), filename, generation)
+        return self.respond(entry)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), bytes=self._bytes)
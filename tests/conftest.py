@@ -0,0 +1,37 @@
+import os
+import sys
+
+# The modules live at the repository root and the tests never need a MongoDB server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('MONGO_URI', 'memory://')
+os.environ.setdefault('OPENAI_API_KEY', 'test-key')
+
+import pytest
+
+from memory_mongo import MemoryClient
+
+
+@pytest.fixture
+def db():
+    return MemoryClient()['invoiceDB']
+
+
+@pytest.fixture
+def make_pdf():
+    # make_pdf(path_or_None, ['page one text', ...]) -> the PDF's bytes, also written to path
+    import fitz
+
+    def make(path, page_texts):
+        doc = fitz.open()
+        for text in page_texts:
+            page = doc.new_page()
+            if text:
+                page.insert_textbox(fitz.Rect(50, 50, 550, 800), text, fontsize=10)
+        data = doc.tobytes()
+        doc.close()
+        if path:
+            with open(path, 'wb') as f:
+                f.write(data)
+        return data
+
+    return make
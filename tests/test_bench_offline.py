@@ -0,0 +1,67 @@
+import json
+import urllib.error
+import urllib.request
+
+import fitz
+import pytest
+
+from bench_offline import KINDS, MOCK_INVOICE, MockOpenAIServer, generate_corpus, gstin
+from pre_extract import gstin_checksum_valid
+from pdf_pages import route_pages
+
+
+@pytest.fixture
+def mock_server(monkeypatch):
+    # start() points the OpenAI SDK at the server through the environment
+    monkeypatch.delenv('OPENAI_BASE_URL', raising=False)
+    servers = []
+
+    def start(**kwargs):
+        servers.append(MockOpenAIServer(latency=0, jitter=0, **kwargs).start())
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def post(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode(), headers={'Content-Type': 'application/json'})
+    return urllib.request.urlopen(request)
+
+
+def test_gstin_appends_a_valid_check_character():
+    assert gstin('27AAPFU0939F1Z') == '27AAPFU0939F1ZV'
+    assert gstin_checksum_valid(gstin('29AABCT3518Q1Z'))
+
+
+def test_corpus_is_deterministic_and_covers_every_kind(tmp_path):
+    paths = generate_corpus(str(tmp_path / 'a'), 4, seed=1)
+    again = generate_corpus(str(tmp_path / 'b'), 4, seed=1)
+    assert [path.endswith(f'_{kind}.pdf') for path, kind in zip(paths, KINDS)] == [True] * 4
+    for path, other in zip(paths, again):
+        with fitz.open(path) as doc, fitz.open(other) as other_doc:
+            assert [page.get_text() for page in doc] == [page.get_text() for page in other_doc]
+
+    routes = {kind: route_pages(path) for kind, path in zip(KINDS, paths)}
+    assert all(route['text'] for route in routes['digital'])
+    assert all(route['text'] is None for route in routes['scanned'])
+    assert len(routes['multipage']) > 1
+
+
+def test_mock_server_answers_chat_completions(mock_server):
+    server = mock_server()
+    response = json.load(post(f'{server.base_url}/chat/completions',
+                              {'model': 'gpt-4o', 'messages': [{'role': 'user', 'content': 'invoice'}]}))
+    assert json.loads(response['choices'][0]['message']['content']) == MOCK_INVOICE
+    assert response['usage']['prompt_tokens'] > 0
+    assert server.stats == {'requests': 1, 'rate_limited': 0}
+
+
+def test_mock_server_rate_limits_with_retry_after(mock_server):
+    server = mock_server(rate_429=1.0, retry_after=0.25)
+    with pytest.raises(urllib.error.HTTPError) as error:
+        post(f'{server.base_url}/chat/completions', {'model': 'gpt-4o', 'messages': []})
+    assert error.value.code == 429
+    assert error.value.headers['retry-after-ms'] == '250'
+    assert server.stats['rate_limited'] == 1
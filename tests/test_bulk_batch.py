@@ -0,0 +1,116 @@
+import json
+
+import pytest
+
+import bulk_batch
+import integrated
+from bulk_batch import BulkRun, LocalBatchBackend, parse_result_line
+
+
+def completion(content):
+    return {'id': 'chatcmpl-1', 'object': 'chat.completion', 'created': 0, 'model': 'gpt-3.5-turbo',
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15}}
+
+
+def body(number):
+    return {'model': 'gpt-3.5-turbo', 'messages': [{'role': 'user', 'content': str(number)}]}
+
+
+def test_parse_result_line():
+    content, usage, error = parse_result_line({'custom_id': 'a', 'error': None,
+                                               'response': {'status_code': 200, 'body': completion('{}')}})
+    assert (content, error) == ('{}', None)
+    assert usage == {'input_tokens': 10, 'cached_tokens': 0, 'output_tokens': 5}
+    assert parse_result_line({'custom_id': 'a', 'response': None,
+                              'error': {'message': 'server error'}}) == (None, None, 'server error')
+    assert parse_result_line({'custom_id': 'a', 'error': None,
+                              'response': {'status_code': 429, 'body': {}}})[2] == 'status 429'
+
+
+@pytest.fixture
+def answers():
+    # Answers a request with its number, failing each number listed in `fail` once
+    state = {'calls': [], 'fail': set()}
+
+    def respond(request_body):
+        number = request_body['messages'][0]['content']
+        state['calls'].append(number)
+        if number in state['fail']:
+            state['fail'].discard(number)
+            raise RuntimeError('server error')
+        return completion(json.dumps({'number': number}))
+
+    state['respond'] = respond
+    return state
+
+
+def test_requests_are_sharded_and_failed_lines_resubmitted(tmp_path, answers, monkeypatch):
+    monkeypatch.setattr(bulk_batch, 'BULK_SHARD_REQUESTS', 2)
+    answers['fail'] = {'1'}
+    run = BulkRun(str(tmp_path / 'work'), LocalBatchBackend(str(tmp_path / 'backend'), answers['respond']),
+                  validate=lambda content: 'number' in content, poll_seconds=0)
+    results, errors = run.run([(f'request-{number}', body(number)) for number in range(5)])
+
+    assert errors == {}
+    assert sorted(results) == [f'request-{number}' for number in range(5)]
+    assert json.loads(results['request-1']['content']) == {'number': '1'}
+    assert [shard['attempt'] for shard in run.state['shards']] == [1, 1, 1, 2]
+    assert answers['calls'].count('1') == 2
+
+
+def test_attempts_are_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(bulk_batch, 'BULK_MAX_ATTEMPTS', 2)
+
+    def respond(request_body):
+        raise RuntimeError('server error')
+
+    run = BulkRun(str(tmp_path / 'work'), LocalBatchBackend(str(tmp_path / 'backend'), respond), poll_seconds=0)
+    results, errors = run.run([('request-0', body(0))])
+    assert results == {} and errors == {'request-0': 'server error'}
+    assert len(run.state['shards']) == 2
+
+
+def test_interrupted_run_resumes_from_its_checkpoint(tmp_path, answers):
+    work_dir = str(tmp_path / 'work')
+    backend = LocalBatchBackend(str(tmp_path / 'backend'), answers['respond'])
+    run = BulkRun(work_dir, backend, poll_seconds=0)
+    run.state['request_ids'] = ['request-0', 'request-1']
+    run.state['meta'] = {'request-0': {'filename': 'a.pdf'}}
+    run.write_shards([('request-0', body(0)), ('request-1', body(1))], attempt=1)
+
+    resumed = BulkRun(work_dir, backend, poll_seconds=0)
+    assert resumed.started and resumed.meta == {'request-0': {'filename': 'a.pdf'}}
+    results, errors = resumed.run()
+    assert sorted(results) == ['request-0', 'request-1'] and errors == {}
+    # Collected answers are not asked for again
+    assert sorted(BulkRun(work_dir, backend, poll_seconds=0).run()[0]) == ['request-0', 'request-1']
+    assert answers['calls'] == ['0', '1']
+
+    resumed.finish()
+    assert not BulkRun(work_dir, backend).started
+
+
+def test_long_and_multi_invoice_pdfs_become_several_requests():
+    long_invoice = '\f'.join(['Invoice No: INV-1\nSteel rods 1,000.00'] + ['Bolts 50.00'] * 9)
+    requests = integrated.bulk_requests('long.pdf', long_invoice)
+    assert [info['window'] for _, info in requests] == [[0, 4], [3, 7], [6, 10]]
+    assert {info['json_filename'] for _, info in requests} == {'long.json'}
+
+    two_invoices = 'Invoice No: INV-1\nGrand Total 100.00\fInvoice No: INV-2\nGrand Total 200.00'
+    requests = integrated.bulk_requests('two.pdf', two_invoices)
+    assert [info['json_filename'] for _, info in requests] == ['two_invoice1.json', 'two_invoice2.json']
+    assert requests[1][1]['part']['invoice_part']['index'] == 2
+
+
+def test_window_answers_are_merged_back_into_one_invoice():
+    meta = {'window': [0, 4], 'part': None}
+    assert integrated.merge_bulk_outputs([(meta, '{"invoice_number": "INV-1"}')]) == '{"invoice_number": "INV-1"}'
+    merged = json.loads(integrated.merge_bulk_outputs([
+        ({'window': [3, 7], 'part': None}, json.dumps({'invoice_number': '', 'items': [
+            {'name': 'Bolts', 'total_price': 50}, {'name': 'Nuts', 'total_price': 20}]})),
+        (meta, json.dumps({'invoice_number': 'INV-1', 'items': [
+            {'name': 'Rods', 'total_price': 1000}, {'name': 'Bolts', 'total_price': 50}]})),
+    ]))
+    assert merged['invoice_number'] == 'INV-1'
+    assert [item['name'] for item in merged['items']] == ['Rods', 'Bolts', 'Nuts']
@@ -0,0 +1,84 @@
+from chunking import merge_items, merge_windows, page_windows, window_hints
+
+
+def test_page_windows_overlap_and_cover_the_document():
+    assert page_windows(10, size=4, overlap=1) == [(0, 4), (3, 7), (6, 10)]
+    assert page_windows(4, size=4, overlap=1) == [(0, 4)]
+    assert page_windows(5, size=2, overlap=0) == [(0, 2), (2, 4), (4, 5)]
+
+
+def test_window_hints_keep_the_invoice_hints():
+    hints = window_hints('vendor hints', (3, 7), 10)
+    assert hints.startswith('vendor hints\n')
+    assert 'pages 4 to 7 of a 10 page invoice' in hints
+
+
+def item(description, amount):
+    return {'item_description': description, 'total_amount': amount}
+
+
+def test_merge_items_drops_rows_repeated_on_overlapping_pages():
+    first = [item('Steel rods', '1,000.00'), item('Bolts', '50.00')]
+    # The overlap page is read again, with number formats and case differing
+    second = [item('BOLTS', '50'), item('Washers', '30.00')]
+    merged, dropped = merge_items([first, second])
+    assert [row['item_description'] for row in merged] == ['Steel rods', 'Bolts', 'Washers']
+    assert dropped == 1
+
+
+def test_merge_items_keeps_genuinely_repeated_rows():
+    # The same item twice on one page is not an overlap
+    merged, dropped = merge_items([[item('Bolts', '50.00')], [item('Washers', '30.00'), item('Bolts', '50.00')]])
+    assert len(merged) == 3 and dropped == 0
+
+
+def vlm_window(header, items, total='', taxes=None):
+    doc = {'invoice_number': header, 'vendor_name': header and 'Acme', 'line_items': items,
+           'total_invoice_amount': total}
+    doc['taxes'] = taxes or [{'category': 'IGST', 'rate': '', 'amount': ''}]
+    return doc
+
+
+def test_merge_windows_takes_headers_first_and_totals_last():
+    docs = [
+        vlm_window('INV-1', [item('Steel rods', '1000.00'), item('Bolts', '50.00')]),
+        vlm_window('', [item('Bolts', '50.00'), item('Washers', '130.00')], total='1180.00',
+                   taxes=[{'category': 'IGST', 'rate': '18', 'amount': '180.00'}]),
+    ]
+    merged = merge_windows('vlm', docs, [(0, 4), (3, 7)])
+    assert merged['invoice_number'] == 'INV-1' and merged['vendor_name'] == 'Acme'
+    assert merged['total_invoice_amount'] == '1180.00'
+    assert merged['taxes'] == [{'category': 'IGST', 'rate': '18', 'amount': '180.00'}]
+    assert len(merged['line_items']) == 3
+    assert merged['chunking'] == {'windows': [[1, 4], [4, 7]], 'duplicate_items_dropped': 1, 'conflicts': [],
+                                  'items_total': 1180.0, 'invoice_total': 1180.0, 'totals_match': True}
+
+
+def test_merge_windows_reports_conflicts_and_mismatched_totals():
+    docs = [vlm_window('INV-1', [item('Steel rods', '1000.00')]),
+            vlm_window('INV-2', [item('Washers', '30.00')], total='5000.00')]
+    chunking = merge_windows('vlm', docs, [(0, 4), (3, 7)])['chunking']
+    assert chunking['conflicts'] == ['invoice_number']
+    assert chunking['totals_match'] is False
+
+
+def test_missing_total_is_filled_from_the_items():
+    docs = [{'purchase_details': {'items': [{'name': 'Rods', 'total_price': 100}]}},
+            {'purchase_details': {'items': [{'name': 'Bolts', 'total_price': 20.5}]}}]
+    merged = merge_windows('multi', docs, [(0, 4), (3, 7)])
+    assert merged['purchase_details']['total_amount_with_gst'] == 120.5
+    assert merged['chunking']['totals_match'] is False
+
+
+def test_perf_score_values_keep_their_confidence():
+    docs = [{'invoice_number': {'value': 'INV-1', 'conf': 0.9}, 'line_items': []},
+            {'invoice_number': {'value': '', 'conf': 0.1}, 'line_items': [],
+             'total_invoice_amount': {'value': '10.00', 'conf': 0.8}}]
+    merged = merge_windows('perf_score', docs, [(0, 4), (3, 7)])
+    assert merged['invoice_number'] == {'value': 'INV-1', 'conf': 0.9}
+    assert merged['total_invoice_amount'] == {'value': '10.00', 'conf': 0.8}
+
+
+def test_single_window_is_returned_unchanged():
+    doc = vlm_window('INV-1', [])
+    assert merge_windows('vlm', [doc], [(0, 3)]) is doc
@@ -0,0 +1,124 @@
+import argparse
+import json
+
+import pytest
+
+import eval_runner
+import integrated
+from eval_runner import OutputCache, load_labelled_corpus, parse_variant, score_document, summarize
+
+EXPECTED = {'invoice_number': 'INV-1', 'total': '1,180.00',
+            'line_items': [{'description': 'Widget', 'amount': '1000'}, {'description': 'Bolt', 'amount': '180'}]}
+
+
+def test_parse_variant():
+    assert parse_variant('vlm') == ('vlm', None)
+    assert parse_variant('integrated@ft:gpt-3.5-turbo-0125:org::id') == ('integrated', 'ft:gpt-3.5-turbo-0125:org::id')
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_variant('unknown@gpt-4o')
+
+
+def test_variant_key_follows_the_model():
+    settings = eval_runner.variant_settings('integrated', None)
+    assert settings['model'] == integrated.MODEL
+    assert eval_runner.variant_key(settings) == eval_runner.variant_key(dict(settings))
+    assert eval_runner.variant_key(settings) != eval_runner.variant_key(eval_runner.variant_settings('integrated', 'gpt-4o'))
+
+
+def test_exact_output_scores_everything():
+    predicted = {**EXPECTED, 'total': '1180', 'filename': 'a.pdf', 'token_usage': {'input_tokens': 10},
+                 'line_items': list(reversed(EXPECTED['line_items']))}
+    score = score_document([predicted], EXPECTED)
+    assert score['fields'] == score['fields_matched'] == 2
+    assert score['items_expected'] == score['items_predicted'] == score['items_exact'] == 2
+    assert score['item_fields'] == score['item_fields_matched'] == 4
+
+
+def test_partial_and_failed_outputs():
+    predicted = {'invoice_number': 'INV-9', 'total': '1180', 'line_items': [{'description': 'Widget', 'amount': '999'}]}
+    score = score_document([predicted], EXPECTED)
+    assert score['fields_matched'] == 1
+    assert score['items_exact'] == 0 and score['item_fields_matched'] == 1
+
+    failed = score_document([{'error': 'Could not extract JSON', **EXPECTED}], EXPECTED)
+    assert failed['fields_matched'] == 0 and failed['items_predicted'] == 0
+
+
+def test_perf_score_values_are_unwrapped():
+    predicted = {'invoice_number': {'value': 'INV-1', 'conf': 0.9}, 'total': {'value': '1180.00', 'conf': 0.8}}
+    assert score_document([predicted], {'invoice_number': 'INV-1', 'total': '1180'})['fields_matched'] == 2
+
+
+def test_extra_invoices_only_cost_precision():
+    extra = {'invoice_number': 'INV-2', 'line_items': [{'description': 'Nut'}]}
+    score = score_document([EXPECTED, extra], [EXPECTED])
+    assert score['fields_matched'] == score['fields'] == 2
+    assert score['items_predicted'] == 3 and score['items_exact'] == 2
+
+
+def test_summarize_prices_fine_tuned_models_by_their_base():
+    records = [{'outputs': [{'token_usage': {'input_tokens': 1_000_000, 'cached_tokens': 0, 'output_tokens': 0}}],
+                'seconds': 1.0, 'cached': False, 'score': score_document([EXPECTED], EXPECTED)},
+               {'outputs': [{'error': 'timeout'}], 'seconds': 3.0, 'cached': True,
+                'score': score_document([{'error': 'timeout'}], EXPECTED)}]
+    report = summarize('integrated@ft:gpt-4o-mini:org::id', 'ft:gpt-4o-mini:org::id', records, eval_runner.PRICES, 2)
+    assert report['documents'] == 2 and report['failed'] == 1 and report['cached'] == 1
+    assert report['field_accuracy'] == 0.5
+    assert report['line_item_recall'] == 0.5 and report['line_item_precision'] == 1.0
+    assert report['cost_usd'] == 0.3 and report['cost_per_document_usd'] == 0.15
+
+
+def test_target_specific_ground_truth_wins(tmp_path, capsys):
+    for name in ('a.pdf', 'b.pdf', 'unlabelled.pdf'):
+        (tmp_path / name).write_bytes(b'%PDF')
+    (tmp_path / 'a.json').write_text(json.dumps({'invoice_number': 'shared'}))
+    (tmp_path / 'a.vlm.json').write_text(json.dumps({'invoice_number': 'vlm'}))
+    (tmp_path / 'b.integrated.json').write_text(json.dumps([{'invoice_number': 'first'}]))
+
+    corpus = load_labelled_corpus(str(tmp_path), ['vlm', 'integrated'])
+    assert [document['truth'] for document in corpus] == [
+        {'vlm': {'invoice_number': 'vlm'}, 'integrated': {'invoice_number': 'shared'}},
+        {'integrated': [{'invoice_number': 'first'}]}]
+    assert 'No ground truth for unlabelled.pdf' in capsys.readouterr().out
+
+
+def test_output_cache_survives_a_cut_short_line(tmp_path):
+    cache = OutputCache(str(tmp_path), 'integrated@ft:model:org::id', 'key')
+    cache.put({'pdf_hash': 'a', 'outputs': []})
+    with open(cache.path, 'a') as f:
+        f.write('{"pdf_hash": "b", "outp')
+    assert OutputCache(str(tmp_path), 'integrated@ft:model:org::id', 'key').get('a') == {'pdf_hash': 'a', 'outputs': []}
+
+
+def test_reruns_only_extract_new_and_failed_documents(tmp_path, monkeypatch):
+    monkeypatch.setattr(integrated, 'MODEL', integrated.MODEL)
+    monkeypatch.setattr(integrated, 'API_KEY', integrated.API_KEY)
+    corpus = []
+    for name in ('good', 'bad'):
+        path = tmp_path / f"{name}.pdf"
+        path.write_bytes(b'%PDF ' + name.encode())
+        corpus.append({'path': str(path), 'truth': {'integrated': EXPECTED}})
+    calls = []
+
+    def fake_extractor(target, path, api_key, pipeline=None):
+        calls.append(path)
+        if path.endswith('bad.pdf'):
+            return [{'error': 'Could not extract JSON'}]
+        return [dict(EXPECTED)]
+
+    monkeypatch.setattr(eval_runner, 'run_extractor', fake_extractor)
+    cache_dir = str(tmp_path / 'cache')
+
+    first, = eval_runner.evaluate([('integrated', 'gpt-4o-mini')], corpus, 'key', cache_dir, concurrency=2)
+    assert len(calls) == 2
+    assert first['variant'] == 'integrated@gpt-4o-mini'
+    assert first['failed'] == 1 and first['cached'] == 0
+    assert first['field_accuracy'] == 0.5
+
+    second, = eval_runner.evaluate([('integrated', 'gpt-4o-mini')], corpus, 'key', cache_dir, concurrency=2)
+    assert len(calls) == 3 and calls[-1].endswith('bad.pdf')
+    assert second['cached'] == 1 and second['field_accuracy'] == 0.5
+
+    # Another model is another cache
+    eval_runner.evaluate([('integrated', 'gpt-4o')], corpus, 'key', cache_dir, concurrency=2)
+    assert len(calls) == 5
@@ -0,0 +1,57 @@
+import io
+import json
+
+import pytest
+
+from extraction_app import ExtractionApp
+
+
+@pytest.fixture
+def extraction_app(monkeypatch):
+    extraction_app = ExtractionApp(__name__, 'vlm', 'gpt-4o', 'key')
+    extracted = []
+
+    def process_pdf(item):
+        filename, source = item
+        extracted.append(filename)
+        if filename == 'bad.pdf':
+            return {filename: {'error': 'Could not extract data using VLM'}}
+        return {filename: {'invoice_number': filename.upper()}}
+
+    monkeypatch.setattr(extraction_app.pipeline, 'process_pdf', process_pdf)
+    extraction_app.extracted = extracted
+    return extraction_app
+
+
+def upload(*names):
+    return {'files': [(io.BytesIO(b'%PDF-1.4'), name) for name in names]}
+
+
+def test_results_stream_as_ndjson_lines(extraction_app):
+    response = extraction_app.app.test_client().post('/extract_invoice_json?stream=1', data=upload('a.pdf', 'bad.pdf'),
+                                                     content_type='multipart/form-data')
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert sorted(line['index'] for line in lines) == [0, 1]
+    by_index = {line['index']: line['result'] for line in lines}
+    assert by_index[0] == {'a.pdf': {'invoice_number': 'A.PDF'}}
+    assert 'error' in by_index[1]['bad.pdf']
+
+
+def test_without_stream_the_response_is_one_list(extraction_app):
+    response = extraction_app.app.test_client().post('/extract_invoice_json', data=upload('a.pdf', 'b.pdf'),
+                                                     content_type='multipart/form-data')
+    assert response.get_json() == [{'a.pdf': {'invoice_number': 'A.PDF'}}, {'b.pdf': {'invoice_number': 'B.PDF'}}]
+
+
+def test_missing_files_are_rejected(extraction_app):
+    response = extraction_app.app.test_client().post('/extract_invoice_json?stream=1')
+    assert response.status_code == 400
+    assert extraction_app.extracted == []
+
+
+def test_stats_endpoints(extraction_app):
+    client = extraction_app.app.test_client()
+    for rule in ('/cache_stats', '/pre_extract_stats', '/template_stats', '/response_cache_stats',
+                 '/page_dedup_stats'):
+        assert client.get(rule).status_code == 200
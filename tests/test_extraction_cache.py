@@ -0,0 +1,54 @@
+from extraction_cache import ExtractionCache, cache_key, content_hash
+
+
+def test_content_hash_of_bytes_and_path_agree(tmp_path):
+    path = tmp_path / 'invoice.pdf'
+    path.write_bytes(b'%PDF-1.4 invoice')
+    assert content_hash(b'%PDF-1.4 invoice') == content_hash(str(path))
+
+
+def test_cache_key_depends_on_every_part():
+    key = cache_key('hash', 'vlm', 'gpt-4o', 'v1')
+    assert key == cache_key('hash', 'vlm', 'gpt-4o', 'v1')
+    assert key != cache_key('hash', 'multi', 'gpt-4o', 'v1')
+    assert key != cache_key('hash', 'vlm', 'gpt-4o-mini', 'v1')
+    assert key != cache_key('hash', 'vlm', 'gpt-4o', 'v2')
+
+
+def test_miss_then_memory_hit(db):
+    cache = ExtractionCache(db['extraction_cache'])
+    assert cache.get('key') is None
+    cache.put('key', {'invoice_number': '1'})
+    assert cache.get('key') == {'invoice_number': '1'}
+
+    stats = cache.stats()
+    assert stats['misses'] == 1
+    assert stats['memory_hits'] == 1
+    assert stats['stores'] == 1
+    assert stats['hit_rate'] == 0.5
+
+
+def test_mongo_hit_after_restart(db):
+    ExtractionCache(db['extraction_cache']).put('key', {'invoice_number': '1'})
+    cache = ExtractionCache(db['extraction_cache'])
+    assert cache.get('key') == {'invoice_number': '1'}
+    assert cache.get('key') == {'invoice_number': '1'}
+    assert cache.stats()['mongo_hits'] == 1
+    assert cache.stats()['memory_hits'] == 1
+
+
+def test_lru_is_bounded(db):
+    cache = ExtractionCache(db['extraction_cache'], max_entries=2)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, key)
+    assert cache.stats()['memory_entries'] == 2
+    # The evicted entry is still served from MongoDB
+    assert cache.get('a') == 'a'
+    assert cache.stats()['mongo_hits'] == 1
+
+
+def test_expired_entries_are_misses(db):
+    cache = ExtractionCache(db['extraction_cache'], ttl_seconds=0)
+    cache.put('key', 'value')
+    assert cache.get('key') is None
+    assert cache.stats()['misses'] == 1
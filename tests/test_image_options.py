@@ -0,0 +1,70 @@
+import base64
+
+import pytest
+
+from bench_images import field_accuracy
+from pdf_pages import estimate_image_tokens, image_content, image_options, image_options_tag, pdf_pages_to_images
+
+
+def test_defaults_are_lossless_png():
+    options = image_options()
+    assert options['format'] == 'png'
+    assert not options['grayscale'] and not options['crop'] and options['long_edge'] == 0
+
+
+def test_unknown_format_is_rejected():
+    with pytest.raises(ValueError):
+        image_options(format='gif')
+
+
+def test_tag_changes_with_the_options():
+    assert image_options_tag(image_options()) == image_options_tag()
+    assert image_options_tag(image_options(format='jpeg')) != image_options_tag()
+
+
+def test_estimate_image_tokens():
+    assert estimate_image_tokens({'detail': 'low', 'width': 4000, 'height': 4000}) == 85
+    # Fitted to 768x768: four 512px tiles
+    assert estimate_image_tokens({'detail': 'high', 'width': 1024, 'height': 1024}) == 85 + 170 * 4
+    # An A4 page at 300 dpi scales to 768x1087: two by three tiles
+    assert estimate_image_tokens({'detail': 'auto', 'width': 2480, 'height': 3508}) == 85 + 170 * 6
+
+
+def test_image_content_only_sets_explicit_detail():
+    image = {'mime': 'image/jpeg', 'data': 'abc', 'detail': 'auto'}
+    assert image_content(image) == {'type': 'image_url', 'image_url': {'url': 'data:image/jpeg;base64,abc'}}
+    assert image_content({**image, 'detail': 'low'})['image_url']['detail'] == 'low'
+
+
+def render_one(pdf, **overrides):
+    return next(pdf_pages_to_images(pdf, dpi=150, options=image_options(**overrides)))[1]
+
+
+def test_smaller_encodings(tmp_path, make_pdf):
+    path = str(tmp_path / 'invoice.pdf')
+    make_pdf(path, ['Invoice INV-1001\nTotal Amount: 1,180.00'])
+
+    png = render_one(path)
+    jpeg = render_one(path, format='jpeg', grayscale=True, quality=60)
+    assert jpeg['mime'] == 'image/jpeg'
+    assert base64.b64decode(jpeg['data'])[:2] == b'\xff\xd8'
+    assert len(jpeg['data']) < len(png['data'])
+
+    # Cropped to the text block and scaled to the long edge, never past the request dpi
+    cropped = render_one(path, crop=True, long_edge=400)
+    assert max(cropped['width'], cropped['height']) <= 400
+    assert cropped['width'] < png['width'] and cropped['height'] < png['height']
+    assert render_one(path, long_edge=10000)['width'] == png['width']
+
+
+def test_adaptive_detail(tmp_path, make_pdf):
+    path = str(tmp_path / 'invoice.pdf')
+    make_pdf(path, ['', 'Invoice INV-1001 ' * 200])
+    pages = [image for _, image in pdf_pages_to_images(path, dpi=72, options=image_options(detail='adaptive'))]
+    assert [image['detail'] for image in pages] == ['low', 'high']
+
+
+def test_field_accuracy():
+    expected = {'invoice_number': 'INV-1', 'items': [{'qty': 2}, {'qty': 3}]}
+    assert field_accuracy(expected, expected) == 1.0
+    assert field_accuracy({'invoice_number': 'inv-1 ', 'items': [{'qty': 2}]}, expected) == 2 / 3
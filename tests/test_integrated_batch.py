@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+import integrated
+
+
+@pytest.fixture
+def folders(tmp_path, make_pdf):
+    pdf_folder, json_folder = tmp_path / 'pdf', tmp_path / 'json'
+    pdf_folder.mkdir()
+    json_folder.mkdir()
+    for name in ('a', 'b', 'c'):
+        make_pdf(str(pdf_folder / f'{name}.pdf'), [f'Invoice {name}'])
+    return str(pdf_folder), str(json_folder)
+
+
+def manifest_lines(json_folder):
+    with open(f'{json_folder}/{integrated.MANIFEST_FILENAME}') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_batch_converts_and_resumes(folders, monkeypatch):
+    pdf_folder, json_folder = folders
+    converted, attempts = [], []
+
+    def convert(api_key, filename, pdf_text, json_folder_path):
+        converted.append(filename)
+        attempts.append(filename)
+        if attempts.count('b.pdf') == 1 and filename == 'b.pdf':
+            return 'failed', 'Could not get response from AI', None
+        return 'done', None, {'total_tokens': 10}
+
+    monkeypatch.setattr(integrated, 'convert_pdf_text', convert)
+
+    assert integrated.run_batch('key', pdf_folder, json_folder, 1, 2) == {'done': 2, 'failed': 1}
+    # The rerun only retries the file that failed
+    converted.clear()
+    assert integrated.run_batch('key', pdf_folder, json_folder, 1, 2) == {'done': 1, 'failed': 0}
+    assert converted == ['b.pdf']
+
+    entries = manifest_lines(json_folder)
+    assert len(entries) == 4
+    assert entries[-1] == {'filename': 'b.pdf', 'status': 'done', 'token_usage': {'total_tokens': 10}}
+
+
+def test_conversion_errors_are_recorded_as_failed(folders, monkeypatch):
+    pdf_folder, json_folder = folders
+
+    def convert(api_key, filename, pdf_text, json_folder_path):
+        raise RuntimeError('model unavailable')
+
+    monkeypatch.setattr(integrated, 'convert_pdf_text', convert)
+
+    assert integrated.run_batch('key', pdf_folder, json_folder, 1, 2) == {'done': 0, 'failed': 3}
+    assert {entry['error'] for entry in manifest_lines(json_folder)} == {'model unavailable'}
+
+
+def test_files_the_manifest_could_not_record_count_as_failed(folders, monkeypatch):
+    pdf_folder, json_folder = folders
+    monkeypatch.setattr(integrated, 'convert_pdf_text', lambda *args: ('done', None, None))
+
+    def record(self, filename, status, error=None, usage=None):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(integrated.BatchManifest, 'record', record)
+
+    assert integrated.run_batch('key', pdf_folder, json_folder, 1, 2) == {'done': 0, 'failed': 3}
+
+
+def test_manifest_ignores_a_truncated_last_line(tmp_path):
+    path = tmp_path / 'manifest.jsonl'
+    path.write_text('{"filename": "a.pdf", "status": "failed"}\n'
+                    '{"filename": "a.pdf", "status": "done"}\n'
+                    '{"filename": "b.pdf", "sta')
+    manifest = integrated.BatchManifest(str(path))
+    assert manifest.is_done('a.pdf')
+    assert not manifest.is_done('b.pdf')
+    manifest.close()
@@ -0,0 +1,87 @@
+import json
+
+import pytest
+from flask import Flask
+
+from invoice_routes import create_invoice_routes
+from mongo_writer import InvoiceWriter
+
+
+def make_client(collection, **kwargs):
+    app = Flask(__name__)
+    app.register_blueprint(create_invoice_routes(collection, **kwargs))
+    return app.test_client()
+
+
+@pytest.fixture
+def collection(db):
+    collection = db['invoices']
+    for index in range(150):
+        collection.insert_one({'filename': f'{index:03}.pdf', 'invoice_number': f'INV-{index}'})
+    return collection
+
+
+def test_list_is_unbounded_without_paging(collection):
+    body = make_client(collection).get('/list_invoices').get_json()
+    assert len(body['invoices']) == 150
+    assert body['invoices'][0] == '000.pdf'
+    assert body['next'] is None
+
+
+def test_list_pages_by_id(collection):
+    client = make_client(collection)
+    first = client.get('/list_invoices?limit=100').get_json()
+    assert len(first['invoices']) == 100 and first['next']
+    second = client.get(f"/list_invoices?limit=100&after={first['next']}").get_json()
+    assert second['invoices'] == [f'{index:03}.pdf' for index in range(100, 150)]
+    assert second['next'] is None
+
+
+def test_list_projects_fields(collection):
+    body = make_client(collection).get('/list_invoices?limit=1&fields=invoice_number').get_json()
+    assert set(body['invoices'][0]) == {'_id', 'invoice_number'}
+
+
+def test_invalid_paging_is_rejected(collection):
+    client = make_client(collection)
+    assert client.get('/list_invoices?limit=ten').status_code == 400
+    assert client.get('/list_invoices?after=nope').status_code == 400
+
+
+def test_list_streams_ndjson(collection):
+    response = make_client(collection).get('/list_invoices?format=ndjson&fields=filename')
+    assert response.mimetype == 'application/x-ndjson'
+    records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert len(records) == 150
+    assert records[-1]['filename'] == '149.pdf'
+
+
+def test_stream_failure_ends_with_an_error_record(collection, monkeypatch):
+    def find(*args, **kwargs):
+        raise RuntimeError('connection lost')
+
+    monkeypatch.setattr(collection, 'find', find)
+    response = make_client(collection).get('/list_invoices?format=ndjson')
+    assert response.status_code == 200
+    assert json.loads(response.get_data(as_text=True)) == {'error': 'Failed to fetch invoices'}
+
+
+def test_update_finds_an_invoice_still_in_the_write_buffer(db):
+    collection = db['invoices']
+    writer = InvoiceWriter(collection, flush_seconds=3600)
+    updated = []
+    client = make_client(collection, on_update=updated.append, invoice_writer=writer)
+    writer.save({'filename': 'new.pdf', 'invoice_number': 'INV-1'}, 'hash')
+
+    response = client.put('/update_invoice', json={'filename': 'new.pdf', 'invoice_number': 'INV-2'})
+    assert response.status_code == 200
+    assert collection.find_one({'filename': 'new.pdf'})['invoice_number'] == 'INV-2'
+    assert updated == ['new.pdf']
+
+
+def test_bulk_update_reports_missing_invoices(collection):
+    response = make_client(collection).put('/update_invoices', json=[
+        {'filename': '000.pdf', 'invoice_number': 'changed'}, {'filename': 'missing.pdf', 'invoice_number': 'x'}])
+    body = response.get_json()
+    assert body['matched'] == 1 and body['not_found'] == ['missing.pdf']
+    assert collection.find_one({'filename': '000.pdf'})['invoice_number'] == 'changed'
@@ -0,0 +1,115 @@
+import fitz
+
+from invoice_split import (find_invoice_number, has_closing_total, part_filename, part_info, part_pdf, split_pdf,
+                           split_text)
+
+VENDOR_GSTIN = '27AAPFU0939F1ZV'
+OTHER_GSTIN = '29AABCT3518Q1ZS'
+
+
+def page(number=None, gstin=VENDOR_GSTIN, total=False, marker=None, items=('Steel rods 2 500.00 1,000.00',)):
+    lines = ['ACME TRADERS PVT LTD', f'GSTIN: {gstin}' if gstin else '']
+    if number:
+        lines.append(f'Invoice No: {number}')
+    lines += ['Description Qty Rate Total Amount', *items]
+    if total:
+        lines.append('Grand Total 1,180.00')
+    if marker:
+        lines.append(marker)
+    return '\n'.join(lines)
+
+
+def pages_of(invoices):
+    return [invoice['pages'] for invoice in invoices]
+
+
+def test_invoice_number():
+    assert find_invoice_number(['Invoice No: inv-1001']) == 'INV-1001'
+    assert find_invoice_number(['Bill Number', '#A/24/17']) == 'A/24/17'
+    assert find_invoice_number(['Invoice No: 1', 'Inv No: 2']) is None
+
+
+def test_total_amount_column_header_is_not_a_closing_total():
+    assert not has_closing_total(['Description Qty Total Amount', 'Steel rods 2 1,000.00', 'Bolts 1 50.00'])
+    assert has_closing_total(['Steel rods 2 1,000.00', 'Grand Total', '1,180.00'])
+
+
+def test_new_invoice_number_starts_an_invoice():
+    invoices = split_text([page('INV-1', total=True), page('INV-2'), page(total=True), page('INV-3', total=True)])
+    assert pages_of(invoices) == [(0, 1), (1, 3), (3, 4)]
+    assert [invoice['boundary'] for invoice in invoices] == ['start', 'invoice_number', 'invoice_number']
+
+
+def test_page_markers_decide():
+    invoices = split_text([page('INV-1', marker='Page 1 of 2'), page('INV-1', marker='Page 2 of 2', total=True),
+                           page(marker='Page 1 of 1', total=True)])
+    assert pages_of(invoices) == [(0, 2), (2, 3)]
+    assert invoices[1]['boundary'] == 'page_marker'
+
+
+def test_seller_gstin_change_starts_an_invoice():
+    invoices = split_text([page(total=True), page(gstin=OTHER_GSTIN, total=True)])
+    assert pages_of(invoices) == [(0, 1), (1, 2)]
+    assert invoices[1]['boundary'] == 'vendor_gstin'
+
+
+def test_pages_without_signals_continue_the_invoice():
+    # A long item table whose later pages repeat the column header, with "Total Amount" in it
+    assert pages_of(split_text([page('INV-1'), page(gstin=None), page(gstin=None, total=True)])) == [(0, 3)]
+
+
+def test_number_first_printed_on_a_later_page_belongs_to_the_invoice():
+    assert pages_of(split_text([page(), page('INV-1', total=True)])) == [(0, 2)]
+
+
+def pdf_of(texts):
+    doc = fitz.open()
+    for text in texts:
+        doc.new_page().insert_textbox(fitz.Rect(50, 50, 550, 800), text, fontsize=10)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def letterhead_pdf(numbers):
+    # One page per invoice: the vendor's letterhead on top, the invoice below the header band
+    doc = fitz.open()
+    for number in numbers:
+        pdf_page = doc.new_page()
+        pdf_page.insert_text((50, 50), 'ACME TRADERS PVT LTD')
+        pdf_page.insert_text((50, 70), 'Plot 12, MIDC Industrial Area, Pune')
+        if number:
+            pdf_page.insert_text((350, 50), f'Invoice No: {number}')
+        pdf_page.insert_textbox(fitz.Rect(50, 400, 550, 800), page(gstin=None, total=True), fontsize=10)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def test_layout_reset_after_a_closing_total():
+    # The first invoice prints no number; the second repeats its letterhead and prints one
+    invoices = split_pdf(letterhead_pdf([None, 'INV-2']))
+    assert pages_of(invoices) == [(0, 1), (1, 2)]
+    assert invoices[1]['boundary'] == 'layout_reset'
+    # Without a new number a repeated letterhead is just the next page
+    assert pages_of(split_pdf(letterhead_pdf([None, None]))) == [(0, 2)]
+
+
+def test_single_page_pdf_is_one_invoice():
+    assert split_pdf(pdf_of([page('INV-1')])) == [{'pages': (0, 1), 'boundary': 'start'}]
+
+
+def test_parts():
+    pdf = pdf_of([page('INV-1'), page('INV-2'), page(total=True)])
+    part = part_pdf(pdf, (1, 3))
+    # Same bytes every time, so a part's content hash and cache key are stable
+    assert part == part_pdf(pdf, (1, 3))
+    with fitz.open(stream=part, filetype='pdf') as doc:
+        assert len(doc) == 2 and 'INV-2' in doc[0].get_text()
+
+    invoices = [{'pages': (0, 1), 'boundary': 'start'}, {'pages': (1, 3), 'boundary': 'invoice_number'}]
+    assert part_filename('batch.pdf', 1) == 'batch_invoice2.pdf'
+    assert part_info('batch.pdf', 1, invoices) == {
+        'parent_filename': 'batch.pdf',
+        'invoice_part': {'index': 2, 'count': 2, 'pages': [2, 3], 'boundary': 'invoice_number'},
+    }
@@ -0,0 +1,88 @@
+import io
+import os
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+import job_queue
+from job_queue import JobQueue
+
+
+def extract(item):
+    filename, path = item
+    with open(path, 'rb') as f:
+        return {'filename': filename, 'size': len(f.read())}
+
+
+@pytest.fixture
+def queue(db, tmp_path):
+    return JobQueue(db['jobs'], extract, 'vlm', upload_dir=str(tmp_path))
+
+
+def submit(queue, *names):
+    return queue.submit([FileStorage(io.BytesIO(b'%PDF ' + name.encode()), filename=name) for name in names])
+
+
+def test_submitted_job_runs_to_done(queue, tmp_path):
+    job_id = submit(queue, 'a.pdf', 'bc.pdf')
+    assert queue.status(job_id)['status'] == 'queued'
+
+    job = queue._claim('worker-1')
+    assert job['_id'] == job_id and job['worker_id'] == 'worker-1'
+    queue._run(job, 'worker-1')
+
+    status = queue.status(job_id)
+    assert status['status'] == 'done'
+    assert status['completed'] == 2
+    assert [result['filename'] for result in status['results']] == ['a.pdf', 'bc.pdf']
+    # The stored uploads are removed once the job is done
+    assert not os.path.exists(tmp_path / job_id)
+
+
+def test_status_is_scoped_to_the_variant(db, queue):
+    job_id = submit(queue, 'a.pdf')
+    other = JobQueue(db['jobs'], extract, 'multi', upload_dir=queue.upload_dir)
+    assert other.status(job_id) is None
+    assert other._claim('worker-1') is None
+
+
+def test_only_expired_leases_are_requeued(queue):
+    live_id = submit(queue, 'a.pdf')
+    expired_id = submit(queue, 'b.pdf')
+    queue._claim('worker-1')
+    queue._claim('worker-2')
+    stale = datetime.now(timezone.utc) - timedelta(seconds=job_queue.JOB_LEASE_SECONDS + 1)
+    queue.collection.update_one({'_id': expired_id}, {'$set': {'updated_at': stale}})
+
+    queue._requeue_expired()
+
+    assert queue.status(live_id)['status'] == 'running'
+    assert queue.status(expired_id)['status'] == 'queued'
+    assert queue.collection.find_one({'_id': expired_id})['worker_id'] is None
+
+
+def test_worker_that_lost_its_lease_stops_writing(queue):
+    job_id = submit(queue, 'a.pdf', 'b.pdf')
+    job = queue._claim('worker-1')
+    # The lease expired and another worker claimed the job
+    queue.collection.update_one({'_id': job_id}, {'$set': {'status': 'queued', 'worker_id': None}})
+    queue._claim('worker-2')
+
+    queue._run(job, 'worker-1')
+
+    stored = queue.collection.find_one({'_id': job_id})
+    assert stored['status'] == 'running'
+    assert stored['worker_id'] == 'worker-2'
+    assert stored['completed'] == 0
+
+
+def test_resumed_job_keeps_finished_results(queue):
+    job_id = submit(queue, 'a.pdf', 'b.pdf')
+    queue.collection.update_one({'_id': job_id}, {'$set': {'results.0': {'filename': 'kept'}, 'completed': 1}})
+
+    queue._run(queue._claim('worker-1'), 'worker-1')
+
+    status = queue.status(job_id)
+    assert status['completed'] == 2
+    assert [result['filename'] for result in status['results']] == ['kept', 'b.pdf']
@@ -0,0 +1,106 @@
+import json
+import logging
+
+import pytest
+from flask import Flask
+
+import metrics
+import worker_pools
+from metrics import Counter, Histogram, init_metrics, record_model_call, stage
+
+
+class Records(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(json.loads(record.getMessage()))
+
+
+@pytest.fixture
+def timing_records():
+    handler = Records()
+    metrics.timing_log.addHandler(handler)
+    yield handler.records
+    metrics.timing_log.removeHandler(handler)
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram('test_seconds', 'help', ('stage',), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, stage='parse')
+    samples = {(name, labels): value for name, labels, value in histogram.samples()}
+    assert samples[('test_seconds_bucket', '{stage="parse",le="0.1"}')] == 1
+    assert samples[('test_seconds_bucket', '{stage="parse",le="1.0"}')] == 2
+    assert samples[('test_seconds_bucket', '{stage="parse",le="+Inf"}')] == 3
+    assert samples[('test_seconds_count', '{stage="parse"}')] == 3
+    assert samples[('test_seconds_sum', '{stage="parse"}')] == pytest.approx(5.55)
+
+
+def test_counter_labels():
+    counter = Counter('test_total', 'help', ('model', 'outcome'))
+    counter.inc(model='gpt-4o', outcome='ok')
+    counter.inc(2, model='gpt-4o', outcome='ok')
+    assert counter.samples() == [('test_total', '{model="gpt-4o",outcome="ok"}', 3)]
+
+
+def test_stage_summary_counts_every_stage():
+    before = metrics.stage_summary().get('test_stage', {'count': 0})['count']
+    with stage('test_stage'):
+        pass
+    assert metrics.stage_summary()['test_stage']['count'] == before + 1
+
+
+def test_request_timing_includes_stages_run_in_pool_threads(timing_records, monkeypatch):
+    monkeypatch.setattr(worker_pools, 'EXTRACT_THREAD_WORKERS', 2)
+    monkeypatch.setattr(worker_pools, '_thread_pool', None)
+    app = Flask(__name__)
+    init_metrics(app)
+
+    def extract(item):
+        with stage('test_extract'):
+            record_model_call('test-model', {'input_tokens': 100, 'cached_tokens': 0, 'output_tokens': 20})
+
+    @app.route('/extract')
+    def extract_all():
+        worker_pools.map_in_order(extract, [1, 2])
+        return 'done'
+
+    client = app.test_client()
+    response = client.get('/extract')
+    assert response.status_code == 200
+    # The timing line is written once the response is closed
+    response.close()
+    worker_pools._thread_pool.shutdown()
+
+    record = timing_records[-1]
+    assert record['endpoint'] == 'extract_all' and record['status'] == 200
+    assert record['stages']['test_extract']['count'] == 2
+    assert record['model']['calls'] == 2 and record['model']['input_tokens'] == 200
+
+    response = client.get('/metrics')
+    body = response.get_data(as_text=True)
+    response.close()
+    assert 'invoice_http_requests_total{endpoint="extract_all",status="200"} 1' in body
+    assert 'invoice_model_tokens_total{model="test-model",kind="input_tokens"} 200' in body
+    assert 'process_threads ' in body
+    # /metrics itself is not traced
+    assert len(timing_records) == 1
+
+
+def test_streamed_responses_are_timed_when_finished(timing_records):
+    app = Flask(__name__)
+    init_metrics(app)
+
+    @app.route('/stream')
+    def stream():
+        def generate():
+            with stage('test_stream_chunk'):
+                yield 'chunk\n'
+        return app.response_class(generate(), mimetype='text/plain')
+
+    response = app.test_client().get('/stream')
+    assert response.get_data(as_text=True) == 'chunk\n'
+    response.close()
+    assert timing_records[-1]['stages']['test_stream_chunk']['count'] == 1
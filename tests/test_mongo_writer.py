@@ -0,0 +1,98 @@
+import pytest
+from pymongo.errors import BulkWriteError
+
+from mongo_writer import DUPLICATE_KEY_ERROR, InvoiceWriter
+
+
+@pytest.fixture
+def collection(db):
+    return db['invoices']
+
+
+@pytest.fixture
+def writer(collection):
+    written = []
+    writer = InvoiceWriter(collection, flush_seconds=3600, on_write=written.append)
+    writer.written = written
+    return writer
+
+
+def test_saves_are_buffered_until_flush(writer, collection):
+    doc_id = writer.save({'filename': 'a.pdf', 'invoice_number': '1'}, 'hash-a', variant='vlm')
+    assert collection.find_one({'filename': 'a.pdf'}) is None
+    writer.flush()
+    stored = collection.find_one({'filename': 'a.pdf'})
+    assert str(stored['_id']) == doc_id
+    assert stored['content_hash'] == 'hash-a' and stored['variant'] == 'vlm'
+    assert writer.written == [{'a.pdf'}]
+
+
+def test_saving_the_same_invoice_again_updates_it(writer, collection):
+    first = writer.save({'filename': 'a.pdf', 'invoice_number': '1'}, 'hash-a')
+    # Still buffered: the second save reuses the first one's _id
+    assert writer.save({'filename': 'a.pdf', 'invoice_number': '2'}, 'hash-a') == first
+    writer.flush()
+    assert writer.save({'filename': 'a.pdf', 'invoice_number': '3'}, 'hash-a') == first
+    writer.flush()
+    docs = list(collection.find({'filename': 'a.pdf'}))
+    assert len(docs) == 1 and docs[0]['invoice_number'] == '3'
+
+
+def test_ids_of_existing_invoices_are_learned_on_flush(writer, collection):
+    stored_id = collection.insert_one({'content_hash': 'hash-a', 'filename': 'a.pdf'}).inserted_id
+    assert writer.save({'filename': 'a.pdf'}, 'hash-a') != str(stored_id)
+    writer.flush()
+    assert writer.save({'filename': 'a.pdf'}, 'hash-a') == str(stored_id)
+
+
+def fail_first_write(collection, monkeypatch, error):
+    bulk_write = collection.bulk_write
+    calls = []
+
+    def failing(ops, ordered=True):
+        calls.append(len(ops))
+        if len(calls) == 1:
+            error(collection)
+        return bulk_write(ops, ordered=ordered)
+
+    monkeypatch.setattr(collection, 'bulk_write', failing)
+    return calls
+
+
+def test_lost_insert_race_is_retried_as_an_update(writer, collection, monkeypatch):
+    def race(collection):
+        # Another process inserted a.pdf first; b.pdf has an invalid document
+        collection.insert_one({'content_hash': 'hash-a', 'filename': 'a.pdf', 'invoice_number': 'theirs'})
+        raise BulkWriteError({'writeErrors': [{'index': 0, 'code': DUPLICATE_KEY_ERROR, 'errmsg': 'duplicate key'},
+                                              {'index': 1, 'code': 2, 'errmsg': 'bad value'}],
+                              'upserted': []})
+
+    calls = fail_first_write(collection, monkeypatch, race)
+    writer.save({'filename': 'a.pdf', 'invoice_number': 'ours'}, 'hash-a')
+    writer.save({'filename': 'b.pdf'}, 'hash-b')
+    writer.flush()
+    assert writer.stats()['retried'] == 1
+    assert writer.stats()['dropped'] == 1
+    assert writer.stats()['buffered'] == 1
+
+    writer.flush()
+    assert calls == [2, 1]
+    docs = list(collection.find({'filename': 'a.pdf'}))
+    assert len(docs) == 1 and docs[0]['invoice_number'] == 'ours'
+    assert collection.find_one({'filename': 'b.pdf'}) is None
+    # Later saves go to the winner's document
+    assert writer.save({'filename': 'a.pdf'}, 'hash-a') == str(docs[0]['_id'])
+
+
+def test_writes_are_kept_while_mongodb_is_down(writer, collection, monkeypatch):
+    def down(collection):
+        raise ConnectionError('server selection timeout')
+
+    fail_first_write(collection, monkeypatch, down)
+    writer.save({'filename': 'a.pdf'}, 'hash-a')
+    writer.flush()
+    assert writer.stats()['buffered'] == 1
+    assert writer.written == []
+    writer.flush()
+    assert collection.find_one({'filename': 'a.pdf'})
+    assert writer.stats()['written'] == 1
@@ -0,0 +1,83 @@
+import uuid
+
+import pytest
+from openai import RateLimitError
+
+import openai_pool
+from bench_offline import MockOpenAIServer
+from openai_pool import TokenBucket, backoff_seconds, chat_completion, estimate_tokens
+
+
+def test_bucket_lends_into_debt_and_refills():
+    bucket = TokenBucket(60)  # one per second
+    start = bucket.updated
+    assert bucket.reserve(60, now=start) == 0.0
+    # The next caller waits until its reservation is paid back
+    assert bucket.reserve(2, now=start) == pytest.approx(2.0)
+    assert bucket.reserve(1, now=start + 1) == pytest.approx(2.0)
+    bucket.refund(3, now=start + 1)
+    assert bucket.level == pytest.approx(1.0)
+    # Never more than a minute's worth
+    assert bucket.reserve(0, now=start + 1000) == 0.0 and bucket.level == 60
+
+
+def test_large_requests_are_capped_at_the_capacity():
+    bucket = TokenBucket(60)
+    bucket.reserve(10_000, now=bucket.updated)
+    assert bucket.reserve(1, now=bucket.updated) == pytest.approx(1.0)
+
+
+def test_settle_returns_what_the_estimate_over_reserved():
+    limiter = openai_pool.RateLimiter(rpm=60, tpm=6000)
+    limiter.acquire(5000)
+    limiter.settle(5000, 1000)
+    assert limiter.tokens.level == pytest.approx(5000, abs=10)
+
+
+def test_estimate_tokens():
+    messages = [{'role': 'system', 'content': 'x' * 400},
+                {'role': 'user', 'content': [{'type': 'text', 'text': 'y' * 40},
+                                             {'type': 'image_url', 'image_url': {'url': 'data:', 'detail': 'low'}}]}]
+    assert estimate_tokens(messages) == openai_pool.DEFAULT_OUTPUT_TOKENS + 100 + 10 + 85
+    assert estimate_tokens(messages, max_tokens=50) == 50 + 100 + 10 + 85
+
+
+def test_backoff_never_earlier_than_retry_after():
+    assert all(backoff_seconds(attempt) <= openai_pool.BACKOFF_MAX_SECONDS for attempt in range(20))
+    assert all(backoff_seconds(0, retry_after=3.0) >= 3.0 for _ in range(20))
+
+
+@pytest.fixture
+def mock_server(monkeypatch):
+    monkeypatch.delenv('OPENAI_BASE_URL', raising=False)
+    monkeypatch.setattr(openai_pool, 'BACKOFF_BASE_SECONDS', 0.01)
+    servers = []
+
+    def start(**kwargs):
+        servers.append(MockOpenAIServer(latency=0, jitter=0, retry_after=0.01, **kwargs).start())
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def complete():
+    # A key of its own, so the client is created against the running mock server
+    return chat_completion(uuid.uuid4().hex, model='mock-model', messages=[{'role': 'user', 'content': 'invoice'}])
+
+
+def test_rate_limited_calls_are_retried(mock_server):
+    server = mock_server(rate_429=0.5, seed=3)
+    for _ in range(4):
+        assert complete().choices[0].message.content
+    assert server.stats['rate_limited'] > 0
+    assert server.stats['requests'] == 4 + server.stats['rate_limited']
+
+
+def test_retries_are_bounded(mock_server, monkeypatch):
+    monkeypatch.setattr(openai_pool, 'OPENAI_MAX_RETRIES', 2)
+    server = mock_server(rate_429=1.0)
+    with pytest.raises(RateLimitError):
+        complete()
+    assert server.stats['requests'] == 3
@@ -0,0 +1,69 @@
+import fitz
+import pytest
+
+import page_dedup
+from extraction_cache import content_hash
+from page_dedup import PageIndex, dedup_report, difference_hash, hash_distance
+
+VENDOR_GSTIN = '27AAPFU0939F1ZV'
+OTHER_GSTIN = '29AABCT3518Q1ZS'
+TERMS = 'Terms and conditions\n' + 'Goods once sold will not be taken back. Interest at 18% on late payment.\n' * 5
+
+
+@pytest.fixture
+def invoice_pdf(make_pdf):
+    def make(number, gstin=VENDOR_GSTIN, page_count=3):
+        # The invoice, the vendor's terms page with its own page marker, and a blank page
+        return make_pdf(None, [f'ACME TRADERS\nGSTIN: {gstin}\nInvoice No: {number}\nTotal 1,180.00',
+                               f'{TERMS}\nPage 2 of {page_count}', ''])
+    return make
+
+
+def learn(index, pdf):
+    match = index.match(pdf)
+    index.learn(match, {page['page']: 1000 for page in match['pages'] if page['page'] not in match['skip']},
+                content_hash(pdf))
+    return match
+
+
+def test_blank_pages_are_always_skipped(db, invoice_pdf):
+    match = PageIndex(db['page_fingerprints']).match(invoice_pdf('INV-1'))
+    assert match['vendor_gstin'] == VENDOR_GSTIN
+    assert match['skip'] == {2: ('blank', 0)}
+
+
+def test_pages_seen_in_enough_documents_are_boilerplate(db, invoice_pdf):
+    index = PageIndex(db['page_fingerprints'])
+    for number in range(page_dedup.BOILERPLATE_MIN_DOCUMENTS):
+        assert 1 not in learn(index, invoice_pdf(f'INV-{number}'))['skip']
+
+    # The page marker differs, the terms are the same
+    match = index.match(invoice_pdf('INV-99', page_count=4))
+    assert match['skip'] == {1: ('boilerplate', 1000), 2: ('blank', 0)}
+    assert dedup_report(match) == {'pages_skipped': 2, 'bytes_skipped': 1000,
+                                   'pages': [{'page': 2, 'reason': 'boilerplate'}, {'page': 3, 'reason': 'blank'}]}
+    # Another vendor's identical page is not theirs to skip
+    assert 1 not in index.match(invoice_pdf('INV-99', gstin=OTHER_GSTIN))['skip']
+    assert index.stats()['boilerplate_skipped'] == 1
+
+
+def test_the_same_document_counts_once(db, invoice_pdf):
+    index = PageIndex(db['page_fingerprints'])
+    pdf = invoice_pdf('INV-1')
+    for _ in range(page_dedup.BOILERPLATE_MIN_DOCUMENTS):
+        learn(index, pdf)
+    assert 1 not in index.match(invoice_pdf('INV-2'))['skip']
+
+
+def test_first_page_is_never_skipped(db, make_pdf):
+    index = PageIndex(db['page_fingerprints'])
+    assert index.match(make_pdf(None, ['', 'GSTIN: ' + VENDOR_GSTIN]))['skip'] == {}
+
+
+def test_difference_hash_distance(make_pdf):
+    def dhash(text):
+        with fitz.open(stream=make_pdf(None, [text]), filetype='pdf') as doc:
+            return difference_hash(doc[0].get_pixmap(matrix=fitz.Matrix(0.16, 0.16), colorspace=fitz.csGRAY))
+
+    assert hash_distance(dhash(TERMS), dhash(TERMS)) == 0
+    assert hash_distance(dhash(TERMS), dhash('Completely different\n' * 40)) > page_dedup.MAX_HASH_DISTANCE
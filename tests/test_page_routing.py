@@ -0,0 +1,43 @@
+import fitz
+
+from pdf_pages import MIN_TEXT_CHARS, SCAN_IMAGE_COVERAGE, has_usable_text, route_pages
+
+INVOICE_TEXT = 'Invoice No: INV-1001\nDate: 12/03/2024\nVendor: Acme Traders\nTotal Amount: 1,180.00\n' * 2
+
+
+def score(char_count=200, glyph_coverage=0.1, image_coverage=0.0, garbage_ratio=0.0):
+    return {'char_count': char_count, 'glyph_coverage': glyph_coverage, 'image_coverage': image_coverage,
+            'garbage_ratio': garbage_ratio}
+
+
+def test_usable_text_checks():
+    assert has_usable_text(score())
+    assert not has_usable_text(score(char_count=MIN_TEXT_CHARS - 1))
+    assert not has_usable_text(score(garbage_ratio=0.5))
+    # A scan with a sparse OCR layer is rasterized, a page with a logo is not
+    assert not has_usable_text(score(image_coverage=0.9, glyph_coverage=0.01))
+    assert has_usable_text(score(image_coverage=0.2, glyph_coverage=0.01))
+
+
+def scanned_page_pdf(make_pdf):
+    doc = fitz.open(stream=make_pdf(None, [INVOICE_TEXT, '']), filetype='pdf')
+    pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 200, 280), False)
+    pix.set_rect(pix.irect, (230, 230, 230))
+    doc[1].insert_image(doc[1].rect, pixmap=pix)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def test_route_pages_sends_text_pages_as_text(make_pdf):
+    routes = route_pages(scanned_page_pdf(make_pdf))
+    assert [route['page'] for route in routes] == [0, 1]
+    assert 'INV-1001' in routes[0]['text']
+    assert routes[1]['text'] is None
+    assert routes[1]['score']['image_coverage'] >= SCAN_IMAGE_COVERAGE
+
+
+def test_route_pages_opens_paths(tmp_path, make_pdf):
+    path = str(tmp_path / 'invoice.pdf')
+    make_pdf(path, [INVOICE_TEXT, ''])
+    assert [route['text'] is None for route in route_pages(path)] == [False, True]
@@ -0,0 +1,75 @@
+import contextvars
+
+import fitz
+
+import chunking
+import worker_pools
+from pdf_pages import MIN_RENDER_DPI, ImageBudget, pdf_pages_to_images, start_image_budget, stream_pdf_pages
+
+
+def rendered_width(dpi):
+    # Width in pixels of a default fitz page rendered at dpi
+    return (fitz.paper_rect('a4') * fitz.Matrix(dpi / 72, dpi / 72)).irect.width
+
+
+def test_image_budget_counts_only_what_fits():
+    budget = ImageBudget(100)
+    assert budget.take(60)
+    assert not budget.take(60)
+    assert budget.take(40)
+    assert budget.remaining == 0
+
+
+def render(pdf, limit, **kwargs):
+    # In a context of its own, like a request, so the budget does not leak into other tests
+    def run():
+        start_image_budget(limit)
+        return list(pdf_pages_to_images(pdf, **kwargs))
+    return contextvars.copy_context().run(run)
+
+
+def test_pages_past_the_budget_are_rendered_at_a_lower_dpi(tmp_path, make_pdf):
+    path = str(tmp_path / 'scan.pdf')
+    make_pdf(path, ['Invoice INV-1001', 'Page two'])
+
+    full = render(path, 64 * 1024 * 1024, dpi=150)
+    assert [number for number, _ in full] == [0, 1]
+    assert all(image['width'] == rendered_width(150) for _, image in full)
+
+    # Nothing fits, so every page ends up at the minimum dpi instead of failing
+    reduced = render(path, 1, dpi=150)
+    assert [number for number, _ in reduced] == [0, 1]
+    assert all(image['width'] == rendered_width(MIN_RENDER_DPI) for _, image in reduced)
+
+
+def test_stream_pdf_pages_renders_only_image_pages_in_order(make_pdf):
+    pdf = make_pdf(None, ['one', 'two', 'three'])
+    pages = [{'page': 0, 'text': 'one'}, {'page': 1}, {'page': 2, 'text': 'three'}]
+    streamed = list(stream_pdf_pages(pdf, pages, dpi=72))
+    assert [page['page'] for page in streamed] == [0, 1, 2]
+    assert streamed[0] == pages[0] and streamed[2] == pages[2]
+    assert streamed[1]['image']['mime'] == 'image/png'
+
+
+def test_run_windows_sends_windows_while_pages_are_still_arriving(monkeypatch):
+    monkeypatch.setattr(worker_pools, 'WINDOW_WORKERS', 1)
+    arrived = []
+
+    def pages():
+        for number in range(10):
+            arrived.append(number)
+            yield number
+
+    def call(window_pages, hints):
+        return list(window_pages), len(arrived)
+
+    results = chunking.run_windows(pages(), call, page_count=10)
+    assert [window for window, _ in results] == [(0, 4), (3, 7), (6, 10)]
+    assert [output for _, (output, _) in results] == [[0, 1, 2, 3], [3, 4, 5, 6], [6, 7, 8, 9]]
+    # Each window went out as soon as its last page arrived
+    assert [arrived_then for _, (_, arrived_then) in results] == [4, 7, 10]
+
+
+def test_run_windows_makes_one_call_for_short_documents():
+    results = chunking.run_windows(iter(range(3)), lambda pages, hints: (pages, hints), hints='hint', page_count=3)
+    assert results == [((0, 3), ([0, 1, 2], 'hint'))]
@@ -0,0 +1,88 @@
+import pre_extract
+from pre_extract import (PreExtractStats, all_required_resolved, apply_fields, gstin_checksum_valid, hint_text,
+                         parse_date, pre_extract as extract)
+
+VENDOR_GSTIN = '27AAPFU0939F1ZV'
+BUYER_GSTIN = '29AABCT3518Q1ZS'
+IRN = 'a' * 64
+
+INVOICE = f"""Acme Traders
+GSTIN: {VENDOR_GSTIN}
+Invoice No: INV-1001
+Invoice Date: 12/03/2024
+IRN: {IRN}
+Bill To:
+Bharat Stores
+GSTIN: {BUYER_GSTIN}
+Steel rods 2 500.00 1,000.00
+Sub Total 1,000.00
+CGST 9% 90.00
+SGST 9% 90.00
+Grand Total
+1,180.00
+"""
+
+
+def test_gstin_checksum():
+    assert gstin_checksum_valid(VENDOR_GSTIN)
+    assert gstin_checksum_valid(BUYER_GSTIN)
+    assert not gstin_checksum_valid(VENDOR_GSTIN[:-1] + 'W')
+    # One misread digit is caught
+    assert not gstin_checksum_valid('27AAPFU0989F1ZV')
+
+
+def test_parse_date():
+    assert parse_date('12/03/2024') == '2024-03-12'
+    assert parse_date('12-Mar-2024') == '2024-03-12'
+    assert parse_date('2024-03-12.') == '2024-03-12'
+    assert parse_date('sometime') is None
+
+
+def test_pre_extract_finds_every_field():
+    assert extract(INVOICE) == {
+        'vendor_gstin': VENDOR_GSTIN,
+        'vendor_pan': 'AAPFU0939F',
+        'billing_gstin': BUYER_GSTIN,
+        'billing_pan': 'AABCT3518Q',
+        'irn': IRN,
+        'invoice_date': '2024-03-12',
+        'total_amount': 1180.0,
+    }
+
+
+def test_ambiguous_values_are_left_to_the_model():
+    text = INVOICE.replace('Bill To:', 'Warehouse GSTIN: 07AAACR5055K1Z0\nBill To:')
+    fields = extract(text.replace('Invoice Date: 12/03/2024', 'Invoice Date: 12/03/2024\nDated: 14/03/2024'))
+    assert 'invoice_date' not in fields
+    # A GSTIN that fails its checksum is ignored, so the vendor's is still trusted
+    assert fields['vendor_gstin'] == VENDOR_GSTIN
+    # A labelled total smaller than another amount on the invoice is not trusted
+    assert 'total_amount' not in extract(INVOICE.replace('Sub Total 1,000.00', 'Sub Total 11,000.00'))
+
+
+def test_apply_fields_per_schema():
+    fields = {'vendor_gstin': VENDOR_GSTIN, 'total_amount': 1180.0, 'irn': IRN}
+    assert apply_fields({}, 'multi', fields) == {'Details': {'tax_details': {'gst_number': VENDOR_GSTIN}},
+                                                 'purchase_details': {'total_amount_with_gst': 1180.0}}
+    assert apply_fields({}, 'vlm', fields)['total_invoice_amount'] == '1180.00'
+    assert apply_fields({}, 'perf_score', fields)['IRN'] == {'value': IRN, 'conf': 1.0}
+    assert VENDOR_GSTIN in hint_text('vlm', fields)
+    assert hint_text('vlm', {}) is None
+
+
+def test_all_required_resolved(monkeypatch):
+    fields = {'vendor_gstin': VENDOR_GSTIN, 'invoice_date': '2024-03-12', 'total_amount': 1180.0}
+    assert all_required_resolved('vlm', fields)
+    assert not all_required_resolved('vlm', {'vendor_gstin': VENDOR_GSTIN})
+    monkeypatch.setattr(pre_extract, 'REQUIRED_FIELDS', [])
+    assert not all_required_resolved('vlm', fields)
+    assert pre_extract.pre_extract_tag().endswith('-model')
+
+
+def test_stats():
+    stats = PreExtractStats()
+    stats.record({'vendor_gstin': VENDOR_GSTIN}, skipped=False)
+    stats.record({}, skipped=True)
+    result = stats.stats()
+    assert result['documents'] == 2 and result['model_calls_skipped'] == 1
+    assert result['hit_rates']['vendor_gstin'] == 0.5
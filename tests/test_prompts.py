@@ -0,0 +1,42 @@
+from types import SimpleNamespace
+
+from prompts import PROMPTS, build_messages, page_contents, prompt_version, text_and_images, token_usage
+
+IMAGE = {'mime': 'image/png', 'data': 'abc', 'detail': 'auto'}
+
+
+def test_every_prompt_is_versioned():
+    assert all(prompt['version'] and prompt['system'] for prompt in PROMPTS.values())
+    assert prompt_version('vlm') == PROMPTS['vlm']['version']
+
+
+def test_system_prompt_is_the_same_prefix_for_every_invoice():
+    first = build_messages('vlm', 'invoice one')
+    second = build_messages('vlm', [{'type': 'text', 'text': 'invoice two'}], hints='vendor hints')
+    assert first[0] == second[0] == {'role': 'system', 'content': PROMPTS['vlm']['system']}
+    # Hints follow the invoice
+    assert build_messages('multi', 'invoice', hints='hints')[1]['content'] == 'invoice\n\nhints'
+    assert second[1]['content'][-1] == {'type': 'text', 'text': 'vendor hints'}
+
+
+def test_page_contents_keeps_page_order():
+    contents = page_contents([{'page': 0, 'text': 'first'}, {'page': 1, 'image': IMAGE}])
+    assert contents[0] == {'type': 'text', 'text': 'Page 1:\nfirst'}
+    assert contents[1]['type'] == 'image_url'
+
+
+def test_text_and_images():
+    assert text_and_images([{'page': 0, 'text': 'a'}, {'page': 1, 'text': 'b'}]) == 'ab'
+    content = text_and_images([{'page': 0, 'text': 'a'}, {'page': 1, 'image': IMAGE}])
+    assert content[0] == {'type': 'text', 'text': 'a'}
+    assert content[1]['image_url']['url'] == 'data:image/png;base64,abc'
+
+
+def test_token_usage():
+    usage = SimpleNamespace(prompt_tokens=1200, completion_tokens=300,
+                            prompt_tokens_details=SimpleNamespace(cached_tokens=1024))
+    assert token_usage(SimpleNamespace(usage=usage)) == {'input_tokens': 1200, 'cached_tokens': 1024,
+                                                         'output_tokens': 300}
+    usage.prompt_tokens_details = None
+    assert token_usage(SimpleNamespace(usage=usage))['cached_tokens'] == 0
+    assert token_usage(SimpleNamespace()) == {'input_tokens': 0, 'cached_tokens': 0, 'output_tokens': 0}
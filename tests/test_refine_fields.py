@@ -0,0 +1,104 @@
+import json
+from types import SimpleNamespace
+
+import fitz
+import pytest
+
+import refine_fields
+from refine_fields import locate_field, low_confidence_fields, merge_regions, refine_low_confidence
+
+
+def field(value, conf):
+    return {'value': value, 'conf': conf}
+
+
+def perf_score_doc():
+    return {
+        'invoice_number': field('INV-1001', 0.4),
+        'invoice_date': field('2024-03-12', 0.95),
+        'po_number': field('', 0.1),
+        'total_invoice_amount': field('1180.00', 0.6),
+        'line_items': [{'item_description': field('Steel rods', 0.9), 'total_amount': field('1000.00', 0.5)}],
+        'taxes': [{'category': field('IGST', 0.0), 'rate': field('18', 0.9), 'amount': field('180.00', 0.9)}],
+    }
+
+
+def test_low_confidence_fields_least_confident_first():
+    paths = [path for path, _ in low_confidence_fields(perf_score_doc(), threshold=0.7)]
+    # Tax categories are fixed, so they are never re-read
+    assert paths == ['po_number', 'invoice_number', 'line_items.0.total_amount', 'total_invoice_amount']
+
+
+@pytest.fixture
+def invoice_pdf(tmp_path):
+    path = str(tmp_path / 'invoice.pdf')
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((350, 50), 'Invoice No: INV-1001')
+    page.insert_text((350, 65), 'PO No:')
+    page.insert_text((50, 200), 'Steel rods')
+    page.insert_text((400, 200), '1000.00')
+    page.insert_text((300, 300), 'Grand Total 1180.00')
+    doc.save(path)
+    doc.close()
+    return path
+
+
+def pages(path):
+    doc = fitz.open(path)
+    return doc, [(page, refine_fields._page_words(page)) for page in doc]
+
+
+def test_fields_are_located_by_value_label_or_item_row(invoice_pdf):
+    doc, located_pages = pages(invoice_pdf)
+    invoice = perf_score_doc()
+    number, rect = locate_field(located_pages, invoice, 'invoice_number')
+    assert number == 0 and rect.contains(fitz.Point(420, 45))
+    # An empty value is found from its label
+    assert locate_field(located_pages, invoice, 'po_number')[1].contains(fitz.Point(352, 62))
+    # A line item is cropped across the whole page width
+    row = locate_field(located_pages, invoice, 'line_items.0.total_amount')[1]
+    assert row.x0 == 0 and row.x1 == doc[0].rect.width
+    invoice['bill_to_name'] = field('Bharat Stores', 0.1)
+    assert locate_field(located_pages, invoice, 'bill_to_name') is None
+    doc.close()
+
+
+def test_overlapping_regions_are_merged():
+    regions = merge_regions({'a': (0, fitz.Rect(0, 0, 100, 20)), 'b': (0, fitz.Rect(50, 10, 150, 30)),
+                             'c': (1, fitz.Rect(0, 0, 100, 20))})
+    assert [(number, paths) for number, _, paths in regions] == [(0, ['a', 'b']), (1, ['c'])]
+    assert regions[0][1] == fitz.Rect(0, 0, 150, 30)
+
+
+def test_refined_values_replace_less_confident_ones(invoice_pdf, monkeypatch):
+    requests = []
+
+    def chat_completion(api_key, model, messages, **kwargs):
+        requests.append(messages)
+        fields = {'invoice_number': field('INV-1001', 0.95), 'po_number': field('PO-77', 0.8),
+                  'total_invoice_amount': field('1100.00', 0.3)}
+        usage = SimpleNamespace(prompt_tokens=500, completion_tokens=50, prompt_tokens_details=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=json.dumps({'fields': fields})))],
+                               usage=usage)
+
+    monkeypatch.setattr(refine_fields, 'chat_completion', chat_completion)
+    doc = refine_low_confidence('key', 'gpt-4o', invoice_pdf, perf_score_doc(), threshold=0.7)
+
+    assert len(requests) == 1
+    assert doc['invoice_number'] == {'value': 'INV-1001', 'conf': 0.95, 'conf_original': 0.4, 'conf_refined': 0.95}
+    assert doc['po_number']['value'] == 'PO-77'
+    # A less confident second read keeps the first value
+    assert doc['total_invoice_amount']['value'] == '1180.00'
+    assert doc['total_invoice_amount']['conf_refined'] == 0.3
+    assert doc['line_items'][0]['total_amount']['conf_refined'] is None
+    assert doc['refinement']['token_usage']['input_tokens'] == 500
+    assert set(doc['refinement']['fields']) == {'invoice_number', 'po_number', 'total_invoice_amount',
+                                                'line_items.0.total_amount'}
+
+
+def test_confident_documents_make_no_call(invoice_pdf, monkeypatch):
+    monkeypatch.setattr(refine_fields, 'chat_completion', None)
+    doc = {'invoice_number': field('INV-1001', 0.9)}
+    refine_low_confidence('key', 'gpt-4o', invoice_pdf, doc, threshold=0.7)
+    assert doc == {'invoice_number': field('INV-1001', 0.9)}
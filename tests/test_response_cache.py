@@ -0,0 +1,95 @@
+import gzip
+import json
+
+import pytest
+from flask import Flask
+
+from invoice_routes import create_invoice_routes
+from response_cache import ResponseCache
+
+
+@pytest.fixture
+def collection(db):
+    collection = db['invoices']
+    collection.insert_one({'filename': 'a.pdf', 'invoice_number': 'INV-1', 'notes': 'x' * 4000})
+    collection.insert_one({'filename': 'b.pdf', 'invoice_number': 'INV-2'})
+    return collection
+
+
+@pytest.fixture
+def cache():
+    return ResponseCache()
+
+
+@pytest.fixture
+def client(collection, cache):
+    app = Flask(__name__)
+    app.register_blueprint(create_invoice_routes(collection, response_cache=cache))
+    return app.test_client()
+
+
+def test_reads_are_cached_and_revalidated(client, cache, collection):
+    first = client.get('/get_invoice_json?filename=b.pdf')
+    assert first.get_json() == {'filename': 'b.pdf', 'invoice_number': 'INV-2'}
+    assert first.headers['Cache-Control'] == 'no-cache'
+    etag = first.headers['ETag']
+
+    # Served from the cache: a change made behind its back is not seen until invalidated
+    collection.update_one({'filename': 'b.pdf'}, {'$set': {'invoice_number': 'changed'}})
+    again = client.get('/get_invoice_json?filename=b.pdf', headers={'If-None-Match': etag})
+    assert again.status_code == 304 and again.data == b''
+    assert cache.stats()['hits'] == 1 and cache.stats()['not_modified'] == 1
+
+    cache.invalidate(['b.pdf'])
+    fresh = client.get('/get_invoice_json?filename=b.pdf', headers={'If-None-Match': etag})
+    assert fresh.status_code == 200 and fresh.get_json()['invoice_number'] == 'changed'
+
+
+def test_updates_invalidate_the_invoice_and_every_list(client, cache):
+    client.get('/get_invoice_json?filename=a.pdf')
+    client.get('/get_invoice_json?filename=b.pdf')
+    client.get('/list_invoices')
+    assert cache.stats()['entries'] == 3
+
+    assert client.put('/update_invoice', json={'filename': 'b.pdf', 'invoice_number': 'INV-3'}).status_code == 200
+    assert cache.stats()['entries'] == 1
+    assert client.get('/get_invoice_json?filename=b.pdf').get_json()['invoice_number'] == 'INV-3'
+
+
+def test_large_bodies_are_compressed_once(client, cache):
+    plain = client.get('/get_invoice_json?filename=a.pdf')
+    assert 'Content-Encoding' not in plain.headers
+
+    compressed = client.get('/get_invoice_json?filename=a.pdf', headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert compressed.headers['Vary'] == 'Accept-Encoding'
+    assert json.loads(gzip.decompress(compressed.data)) == plain.get_json()
+    # Each encoding has its own ETag
+    assert compressed.headers['ETag'] != plain.headers['ETag']
+    bytes_cached = cache.stats()['bytes']
+    client.get('/get_invoice_json?filename=a.pdf', headers={'Accept-Encoding': 'gzip'})
+    assert cache.stats()['bytes'] == bytes_cached
+
+    small = client.get('/get_invoice_json?filename=b.pdf', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in small.headers
+
+
+def test_missing_invoices_are_not_cached(client, cache):
+    assert client.get('/get_invoice_json?filename=missing.pdf').status_code == 404
+    assert cache.stats()['entries'] == 0
+
+
+def test_body_read_before_a_write_is_not_kept():
+    cache = ResponseCache()
+    generation = cache.generation()
+    cache.invalidate(['a.pdf'])
+    cache.put('key', b'stale', 'a.pdf', generation)
+    assert cache.get('key') is None
+
+
+def test_cache_is_bounded_by_bytes():
+    cache = ResponseCache(max_bytes=10)
+    cache.put('a', b'123456')
+    cache.put('b', b'123456')
+    assert cache.get('a') is None and cache.get('b')['body'] == b'123456'
+    assert cache.stats()['bytes'] == 6
@@ -0,0 +1,67 @@
+import hashlib
+import io
+import os
+
+import pytest
+from flask import Flask, jsonify, request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from extraction_cache import content_hash
+from uploads import HashingFile, init_uploads, save_upload, upload_source
+
+PDF = b'%PDF-1.4\n' + b'x' * 100_000 + b'\n%%EOF\n'
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    init_uploads(app)
+    app.seen = []
+
+    @app.route('/upload', methods=['POST'])
+    def upload():
+        sources = [upload_source(uploaded_file) for uploaded_file in request.files.getlist('files')]
+        app.seen.extend(sources)
+        return jsonify([{'path': source, 'exists': os.path.exists(source), 'hash': content_hash(source),
+                         'sha256': source.sha256} for source in sources])
+
+    @app.route('/keep', methods=['POST'])
+    def keep():
+        save_upload(request.files['files'], str(tmp_path / 'kept.pdf'))
+        return 'kept'
+
+    return app
+
+
+def test_uploads_are_spooled_hashed_and_removed(app):
+    response = app.test_client().post('/upload', data={'files': [(io.BytesIO(PDF), 'a.pdf'),
+                                                                 (io.BytesIO(b'%PDF small'), 'b.pdf')]})
+    spooled = response.get_json()
+    response.close()
+    assert [entry['exists'] for entry in spooled] == [True, True]
+    assert spooled[0]['sha256'] == hashlib.sha256(PDF).hexdigest()
+    # The hash computed while spooling is the content hash, nothing is read again
+    assert spooled[0]['hash'] == spooled[0]['sha256']
+    assert not any(os.path.exists(path) for path in app.seen)
+
+
+def test_saved_uploads_are_moved_not_removed(app, tmp_path):
+    response = app.test_client().post('/keep', data={'files': (io.BytesIO(PDF), 'a.pdf')})
+    response.close()
+    with open(tmp_path / 'kept.pdf', 'rb') as f:
+        assert f.read() == PDF
+
+
+def test_oversized_requests_are_rejected(app):
+    app.config['MAX_CONTENT_LENGTH'] = 10_000
+    response = app.test_client().post('/upload', data={'files': (io.BytesIO(PDF), 'a.pdf')})
+    assert response.status_code == 413
+
+
+def test_file_size_limit():
+    spool = HashingFile(max_bytes=10)
+    spool.write(b'x' * 10)
+    with pytest.raises(RequestEntityTooLarge):
+        spool.write(b'x')
+    spool.file.close()
+    os.remove(spool.path)
@@ -0,0 +1,106 @@
+import fitz
+import pytest
+
+import vendor_templates
+from pre_extract import pre_extract
+from vendor_templates import VendorTemplates, page_layout
+
+VENDOR_GSTIN = '27AAPFU0939F1ZV'
+BUYER_GSTIN = '29AABCT3518Q1ZS'
+INVOICES = [
+    ('INV-001', '05/03/2024', [('Steel rods', 100.0), ('Bolts pack', 50.0)]),
+    ('INV-002', '12/03/2024', [('Copper wire', 300.0)]),
+    ('INV-003', '20/03/2024', [('Nuts', 20.0), ('Washers', 30.5), ('Screws', 10.0)]),
+    ('INV-004', '27/03/2024', [('Hex bolts', 75.0), ('Gaskets', 25.0)]),
+]
+
+
+def invoice_pdf(number, date, items):
+    # The vendor's fixed layout, with the item table growing downwards; returns (bytes, expected vlm output)
+    doc = fitz.open()
+    page = doc.new_page()
+    page.insert_text((50, 50), 'ACME TRADERS PVT LTD')
+    page.insert_text((50, 70), f'GSTIN: {VENDOR_GSTIN}')
+    page.insert_text((350, 50), 'Invoice No:')
+    page.insert_text((430, 50), number)
+    page.insert_text((350, 70), 'Invoice Date:')
+    page.insert_text((430, 70), date)
+    page.insert_text((50, 110), 'Bill To:')
+    page.insert_text((50, 125), f'GSTIN: {BUYER_GSTIN}')
+    page.insert_text((50, 170), 'Description')
+    page.insert_text((400, 170), 'Amount')
+    y = 190
+    for description, amount in items:
+        page.insert_text((50, y), description)
+        page.insert_text((400, y), f'{amount:.2f}')
+        y += 15
+    total = sum(amount for _, amount in items)
+    page.insert_text((300, y + 20), 'Grand Total')
+    page.insert_text((400, y + 20), f'{total:.2f}')
+    pdf = doc.tobytes()
+    text = doc[0].get_text()
+    doc.close()
+    day, month, year = date.split('/')
+    expected = {'invoice_number': number, 'invoice_date': f'{year}-{month}-{day}', 'vendor_gst_number': VENDOR_GSTIN,
+                'billing_gst_number': BUYER_GSTIN, 'total_invoice_amount': f'{total:.2f}',
+                'line_items': [{'description': description, 'amount': f'{amount:.2f}'}
+                               for description, amount in items]}
+    return pdf, text, expected
+
+
+@pytest.fixture
+def templates(db, monkeypatch):
+    monkeypatch.setattr(vendor_templates, 'MIN_TEMPLATE_SAMPLES', 3)
+    return VendorTemplates(db['vendor_templates'], db['layouts'])
+
+
+def test_repeat_vendor_is_read_from_its_template(templates):
+    for invoice in INVOICES[:2]:
+        pdf, _, expected = invoice_pdf(*invoice)
+        templates.learn('vlm', page_layout(pdf), expected)
+    pdf, text, expected = invoice_pdf(*INVOICES[2])
+    # Two samples are not enough yet
+    assert templates.extract('vlm', page_layout(pdf), pre_extract(text)) is None
+    templates.learn('vlm', page_layout(pdf), expected)
+
+    pdf, text, expected = invoice_pdf(*INVOICES[3])
+    assert templates.extract('vlm', page_layout(pdf), pre_extract(text)) == expected
+    # Other output schemas learn templates of their own
+    assert templates.extract('multi', page_layout(pdf), pre_extract(text)) is None
+    assert templates.stats()['template_hits'] == 1
+    assert templates.stats()['learned'] == 3
+
+
+def test_template_values_must_agree_with_the_text_rules(templates):
+    for invoice in INVOICES[:3]:
+        pdf, _, expected = invoice_pdf(*invoice)
+        templates.learn('vlm', page_layout(pdf), expected)
+    pdf, text, _ = invoice_pdf(*INVOICES[3])
+    fields = pre_extract(text)
+    assert templates.extract('vlm', page_layout(pdf), dict(fields, total_amount=999.0)) is None
+    # Without the seller GSTIN and total found locally nothing is trusted
+    assert templates.extract('vlm', page_layout(pdf), {'vendor_gstin': VENDOR_GSTIN}) is None
+    assert templates.stats()['validation_failures'] == 2
+
+
+def test_corrections_are_learned_only_for_the_schema_that_extracted_them(db, templates):
+    invoices = db['invoices']
+    pdf, _, expected = invoice_pdf(*INVOICES[0])
+    templates.remember_layout('hash-1', page_layout(pdf))
+    invoices.insert_one(dict(expected, filename='a.pdf', content_hash='hash-1', variant='multi'))
+
+    templates.learn_from_invoice(invoices, 'vlm', 'a.pdf')
+    assert templates.stats()['learned'] == 0
+    templates.learn_from_invoice(invoices, 'multi', 'a.pdf')
+    assert templates.stats()['learned'] == 1
+    assert db['vendor_templates'].find_one({'schema': 'multi', 'vendor_gstin': VENDOR_GSTIN})
+
+
+def test_rebuild_relearns_from_stored_invoices(db, templates):
+    invoices = db['invoices']
+    for index, invoice in enumerate(INVOICES[:3]):
+        pdf, _, expected = invoice_pdf(*invoice)
+        templates.remember_layout(f'hash-{index}', page_layout(pdf))
+        invoices.insert_one(dict(expected, filename=f'{index}.pdf', content_hash=f'hash-{index}', variant='vlm'))
+    assert templates.rebuild(invoices, 'vlm') == 3
+    assert db['vendor_templates'].find_one({'schema': 'vlm'})['samples'] == 3
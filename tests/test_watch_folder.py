@@ -0,0 +1,115 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from watch_folder import FolderWatcher, WatchState, looks_complete
+
+PDF = b'%PDF-1.4\ninvoice\n%%EOF\n'
+
+
+@pytest.fixture
+def folder(tmp_path):
+    folder = tmp_path / 'incoming'
+    folder.mkdir()
+    return folder
+
+
+@pytest.fixture
+def watcher(folder, tmp_path):
+    processed = []
+
+    def process(path):
+        processed.append(os.path.basename(path))
+        return ('failed', 'broken', None) if 'bad' in path else ('done', None, {'input_tokens': 10})
+
+    state = WatchState(str(tmp_path / 'state.jsonl'))
+    watcher = FolderWatcher(str(folder), process, state, workers=2, debounce_seconds=0)
+    watcher.processed = processed
+    yield watcher
+    state.close()
+
+
+def settle(watcher):
+    # Files are dispatched once their size and mtime were seen unchanged twice
+    for _ in range(2):
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            watcher._dispatch(pool)
+
+
+def test_looks_complete(folder):
+    (folder / 'done.pdf').write_bytes(PDF)
+    (folder / 'copying.pdf').write_bytes(PDF[:10])
+    assert looks_complete(str(folder / 'done.pdf'))
+    assert not looks_complete(str(folder / 'copying.pdf'))
+
+
+def test_new_files_are_processed_once(watcher, folder):
+    (folder / 'a.pdf').write_bytes(PDF)
+    (folder / 'notes.txt').write_bytes(b'not a pdf')
+    watcher.scan()
+    settle(watcher)
+    assert watcher.processed == ['a.pdf']
+
+    watcher.scan()
+    settle(watcher)
+    assert watcher.processed == ['a.pdf']
+    assert watcher.stats == {'processed': 1, 'failed': 0, 'unchanged': 0}
+
+
+def test_incomplete_files_wait(watcher, folder):
+    (folder / 'a.pdf').write_bytes(PDF[:10])
+    watcher.scan()
+    settle(watcher)
+    assert watcher.processed == []
+    (folder / 'a.pdf').write_bytes(PDF)
+    settle(watcher)
+    assert watcher.processed == ['a.pdf']
+
+
+def test_touched_files_are_not_processed_again(watcher, folder):
+    path = folder / 'a.pdf'
+    path.write_bytes(PDF)
+    watcher.scan()
+    settle(watcher)
+    os.utime(path, (1, 1))
+    watcher.scan()
+    settle(watcher)
+    assert watcher.processed == ['a.pdf']
+    assert watcher.stats['unchanged'] == 1
+
+    path.write_bytes(PDF + b'% revised\n%%EOF\n')
+    watcher.scan()
+    settle(watcher)
+    assert watcher.processed == ['a.pdf', 'a.pdf']
+
+
+def test_failed_files_are_retried_only_on_request(watcher, folder):
+    (folder / 'bad.pdf').write_bytes(PDF)
+    watcher.scan()
+    settle(watcher)
+    watcher.scan()
+    settle(watcher)
+    assert watcher.processed == ['bad.pdf']
+    watcher.scan(retry_failed=True)
+    settle(watcher)
+    assert watcher.processed == ['bad.pdf', 'bad.pdf']
+    assert watcher.stats['failed'] == 2
+
+
+def test_state_survives_a_restart_and_is_compacted(tmp_path):
+    path = str(tmp_path / 'state.jsonl')
+    state = WatchState(path)
+    state.record('/in/a.pdf', 10, 1.0, 'hash-1', 'failed', error='broken')
+    state.record('/in/a.pdf', 10, 2.0, 'hash-2', 'done')
+    state.close()
+    with open(path, 'a') as f:
+        f.write('{"path": "/in/b.pdf", "si')
+
+    state = WatchState(path)
+    assert state.get('/in/a.pdf')['sha256'] == 'hash-2'
+    assert state.get('/in/b.pdf') is None
+    state.close()
+    with open(path) as f:
+        assert [json.loads(line)['path'] for line in f] == ['/in/a.pdf']
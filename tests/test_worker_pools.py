@@ -0,0 +1,54 @@
+import contextvars
+import threading
+import time
+
+import pytest
+
+import worker_pools
+
+request_id = contextvars.ContextVar('request_id', default=None)
+
+
+@pytest.fixture
+def thread_workers(monkeypatch):
+    monkeypatch.setattr(worker_pools, 'EXTRACT_THREAD_WORKERS', 4)
+    monkeypatch.setattr(worker_pools, '_thread_pool', None)
+    yield
+    worker_pools._thread_pool.shutdown()
+
+
+def slow_echo(item):
+    # Later items finish first
+    time.sleep(0.05 * (4 - item))
+    return item, threading.current_thread().name
+
+
+def test_map_in_order_runs_inline_by_default():
+    results = worker_pools.map_in_order(slow_echo, [0, 1])
+    assert [item for item, _ in results] == [0, 1]
+    assert {name for _, name in results} == {threading.current_thread().name}
+
+
+def test_map_in_order_keeps_submission_order(thread_workers):
+    results = worker_pools.map_in_order(slow_echo, [0, 1, 2, 3])
+    assert [item for item, _ in results] == [0, 1, 2, 3]
+    assert all(name.startswith('extract') for _, name in results)
+
+
+def test_map_as_completed_yields_indexes_as_they_finish(thread_workers):
+    results = list(worker_pools.map_as_completed(slow_echo, [0, 1, 2, 3]))
+    assert [index for index, _ in results] == [3, 2, 1, 0]
+    assert all(index == item for index, (item, _) in results)
+
+
+def test_pool_threads_see_the_callers_context(thread_workers):
+    request_id.set('request-1')
+    assert worker_pools.map_in_order(lambda item: request_id.get(), [0, 1]) == ['request-1', 'request-1']
+
+
+def test_errors_reach_the_caller(thread_workers):
+    def fail(item):
+        raise ValueError(item)
+
+    with pytest.raises(ValueError):
+        worker_pools.map_in_order(fail, [0, 1])
@@ -0,0 +1,110 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+from flask import Request, request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# Uploaded files are streamed straight to temporary files and hashed on the way, so a
+# request holds a few buffers of each upload in memory however large the PDFs are. The
+# pipeline then opens them by path, and the files are removed once the response is sent.
+UPLOAD_DIR = os.environ.get('UPLOAD_DIR') or None  # None uses the system temporary folder
+UPLOAD_MAX_FILE_BYTES = int(os.environ.get('UPLOAD_MAX_FILE_BYTES', str(50 * 1024 * 1024)))
+UPLOAD_MAX_REQUEST_BYTES = int(os.environ.get('UPLOAD_MAX_REQUEST_BYTES', str(200 * 1024 * 1024)))
+MAX_FORM_MEMORY_BYTES = 1024 * 1024  # non-file form fields are still kept in memory
+
+
+class SpooledPath(str):
+    # Path of a spooled upload, carrying the sha256 computed while it was written
+    sha256 = None
+
+
+class HashingFile:
+    # Writable temporary file that hashes and counts what is written to it
+    def __init__(self, max_bytes=UPLOAD_MAX_FILE_BYTES):
+        if UPLOAD_DIR:
+            os.makedirs(UPLOAD_DIR, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile(dir=UPLOAD_DIR, prefix='upload-', suffix='.pdf', delete=False)
+        self.path = self.file.name
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise RequestEntityTooLarge(f"Each file may be at most {self.max_bytes} bytes")
+        self._sha256.update(data)
+        return self.file.write(data)
+
+    def move_to(self, path):
+        # Hands the upload over to a file that outlives the request
+        self.file.close()
+        shutil.move(self.path, path)
+        self.path = None
+
+    def spooled_path(self):
+        self.file.flush()
+        path = SpooledPath(self.path)
+        path.sha256 = self._sha256.hexdigest()
+        return path
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class SpooledRequest(Request):
+    max_form_memory_size = MAX_FORM_MEMORY_BYTES
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        spool = HashingFile()
+        self.__dict__.setdefault('spooled_files', []).append(spool)
+        return spool
+
+
+def upload_source(uploaded_file):
+    # What process_pdf opens: the spooled file's path, or the bytes of an upload that
+    # did not come through SpooledRequest
+    if isinstance(uploaded_file.stream, HashingFile):
+        return uploaded_file.stream.spooled_path()
+    return uploaded_file.read()
+
+
+def save_upload(uploaded_file, path):
+    # Moves a spooled upload into place instead of copying it
+    if isinstance(uploaded_file.stream, HashingFile):
+        uploaded_file.stream.move_to(path)
+    else:
+        uploaded_file.save(path)
+
+
+def remove_spooled(files):
+    for spool in files:
+        if spool.path is None:
+            continue
+        try:
+            spool.file.close()
+            os.remove(spool.path)
+        except OSError as e:
+            print(f"Error removing spooled upload {spool.path}: {e}")
+
+
+def init_uploads(app):
+    # Spools the uploads of a Flask app to disk and caps their size
+    app.request_class = SpooledRequest
+    app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_REQUEST_BYTES
+
+    @app.after_request
+    def remove_uploads_after_response(response):
+        files = request.__dict__.pop('spooled_files', None)
+        if files:
+            # A streamed response still reads them after the view returns
+            response.call_on_close(lambda: remove_spooled(files))
+        return response
+
+    @app.teardown_request
+    def remove_uploads_on_error(exception):
+        files = request.__dict__.pop('spooled_files', None)
+        if files:
+            remove_spooled(files)
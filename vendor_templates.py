@@ -0,0 +1,490 @@
+import argparse
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+
+from pdf_pages import open_pdf
+from pre_extract import GSTIN_RE, TOTAL_LABELS, gstin_checksum_valid, parse_date
+
+# Layout templates for repeat vendors. The first page's words are stored for every
+# extracted PDF; once a vendor (identified by its GSTIN) has been seen with the same
+# layout MIN_TEMPLATE_SAMPLES times, the position of every field in the extracted or
+# corrected JSON is known and later invoices are read straight from those boxes. A
+# template read is only used when the text rules found the seller GSTIN and the total
+# on the page and the template agrees with them.
+MIN_TEMPLATE_SAMPLES = int(os.environ.get('MIN_TEMPLATE_SAMPLES', '5'))
+VALIDATION_FIELDS = ('vendor_gstin', 'total_amount')  # have to be found locally
+# Layouts are kept for learning from later corrections; unused ones expire
+LAYOUT_TTL_SECONDS = 30 * 24 * 60 * 60
+LEARN_ATTEMPTS = 3  # a template changed by another process meanwhile is read again
+LEARN_LOCKS = 64
+MIN_ANCHOR_SIMILARITY = 0.6
+ANCHOR_GRID = 20  # anchors are quantized to a 20x20 grid of the page
+BOX_PADDING = 0.01  # page fractions added around learned boxes when reading
+LINE_TOLERANCE = 0.006
+MAX_VALUE_TOKENS = 30
+TEMPLATE_CONF = 0.9  # confidence reported for template values in the perf_score schema
+ITEM_LIST_PATHS = ('line_items', 'items', 'purchase_details.items')
+EMPTY_VALUES = ('', 'n/a', 'na', 'none', '0', '0.0', '0.00')
+
+
+def page_layout(pdf):
+    # First page words as [x0, y0, x1, y1, text] in page fractions, in reading order
+    doc = open_pdf(pdf)
+    try:
+        page = doc.load_page(0)
+        width, height = page.rect.width, page.rect.height
+        words = [[round(x0 / width, 4), round(y0 / height, 4), round(x1 / width, 4), round(y1 / height, 4), text]
+                 for x0, y0, x1, y1, text, *_ in page.get_text('words')]
+        blocks = [[round(x0 / width, 4), round(y0 / height, 4), round(x1 / width, 4), round(y1 / height, 4)]
+                  for x0, y0, x1, y1, *_ in page.get_text('blocks')]
+        return {'page_count': len(doc), 'words': words, 'blocks': blocks}
+    finally:
+        doc.close()
+
+
+def layout_vendor_gstin(layout):
+    # The first valid GSTIN on the page is the seller's on virtually every invoice
+    for word in layout['words']:
+        for gstin in GSTIN_RE.findall(word[4].upper()):
+            if gstin_checksum_valid(gstin):
+                return gstin
+    return None
+
+
+def layout_anchors(layout):
+    # Text block corners plus label-like words (letters only, optionally followed by a
+    # colon), each at its grid cell
+    anchors = {f"block@{int(x0 * ANCHOR_GRID)},{int(y0 * ANCHOR_GRID)}" for x0, y0, *_ in layout.get('blocks', [])}
+    for x0, y0, x1, y1, text in layout['words']:
+        label = text.rstrip(':').lower()
+        if len(label) >= 3 and label.isalpha():
+            anchors.add(f"{label}@{int(x0 * ANCHOR_GRID)},{int(y0 * ANCHOR_GRID)}")
+    return anchors
+
+
+def _leaf(value):
+    # perf_score wraps every value as {'value': ..., 'conf': ...}
+    if isinstance(value, dict) and 'value' in value:
+        return value['value'], True
+    return value, False
+
+
+def value_kind(value):
+    if isinstance(value, (int, float)):
+        return 'amount'
+    if re.fullmatch(r'\d{4}-\d{2}-\d{2}', value):
+        return 'date'
+    if GSTIN_RE.fullmatch(value.upper()):
+        return 'gstin'
+    if _amount(value) is not None:
+        return 'amount'
+    return 'text'
+
+
+def _amount(text):
+    text = text.replace(',', '').replace('Rs.', '').replace('₹', '').strip()
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def _normalize(token):
+    return token.strip(' ,:;').lower()
+
+
+def _union(boxes):
+    return [min(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), max(box[3] for box in boxes)]
+
+
+def _overlaps(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def locate_value(words, value, kind):
+    # Bounding box of the words holding the value, or None when it is not on the page
+    if kind == 'amount':
+        target = value if isinstance(value, (int, float)) else _amount(value)
+        matches = [word for word in words if _amount(word[4]) == target]
+        return word_box(matches[-1:]) if matches else None  # totals repeat; the last one is the final figure
+    if kind == 'date':
+        for size in (1, 3):
+            for index in range(len(words) - size + 1):
+                group = words[index:index + size]
+                if parse_date(' '.join(word[4] for word in group)) == value:
+                    return word_box(group)
+        return None
+
+    tokens = [_normalize(token) for token in str(value).split()]
+    tokens = [token for token in tokens if token]
+    if not tokens or len(tokens) > MAX_VALUE_TOKENS:
+        return None
+    texts = [_normalize(word[4]) for word in words]
+    for index in range(len(words) - len(tokens) + 1):
+        if texts[index:index + len(tokens)] == tokens:
+            return word_box(words[index:index + len(tokens)])
+    return None
+
+
+def word_box(words):
+    return _union([word[:4] for word in words]) if words else None
+
+
+def words_in_box(words, box, padding=BOX_PADDING):
+    x0, y0, x1, y1 = box[0] - padding, box[1] - padding, box[2] + padding, box[3] + padding
+    return [word for word in words
+            if x0 <= (word[0] + word[2]) / 2 <= x1 and y0 <= (word[1] + word[3]) / 2 <= y1]
+
+
+def left_label(words, box):
+    # The label word printed just left of a value on the same line, e.g. "Date:" in "Date: 05/03/2024"
+    centre = (box[1] + box[3]) / 2
+    left = [word for word in words if word[2] <= box[0] + 0.001 and abs((word[1] + word[3]) / 2 - centre) <= LINE_TOLERANCE]
+    if not left:
+        return None
+    label = _normalize(max(left, key=lambda word: word[2])[4])
+    return label if len(label) >= 2 and label.isalpha() else None
+
+
+def field_words(words, field):
+    # Labelled values are read from the label's line, so a total that moves down with a
+    # longer item table is still found; everything else is read from the learned box
+    label = field.get('label')
+    candidates = [word for word in words if label and _normalize(word[4]) == label]
+    if not candidates:
+        return words_in_box(words, field['box'])
+    anchor = min(candidates, key=lambda word: abs(word[1] - field['box'][1]))
+    centre = (anchor[1] + anchor[3]) / 2
+    x0, x1 = field['box'][0] - BOX_PADDING, field['box'][2] + BOX_PADDING
+    return [word for word in words if word[0] >= anchor[2] and abs((word[1] + word[3]) / 2 - centre) <= LINE_TOLERANCE
+            and x0 <= (word[0] + word[2]) / 2 <= x1]
+
+
+def _get_path(doc, path):
+    for key in path.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key)
+    return doc
+
+
+def _set_path(doc, path, value):
+    keys = path.split('.')
+    for key in keys[:-1]:
+        doc = doc.setdefault(key, {})
+    doc[keys[-1]] = value
+
+
+def scalar_fields(doc, prefix=''):
+    # (path, value, wrapped) for every non-empty scalar in an extracted invoice
+    for key, value in doc.items():
+        if key in ('_id', 'filename', 'token_usage', 'content_hash', 'chunking', 'invoice_part', 'refinement',
+                   'page_dedup'):
+            continue
+        path = f"{prefix}{key}"
+        leaf, wrapped = _leaf(value)
+        if isinstance(leaf, dict):
+            yield from scalar_fields(leaf, f"{path}.")
+        elif isinstance(leaf, (str, int, float)) and not isinstance(leaf, bool):
+            if str(leaf).strip().lower() not in EMPTY_VALUES:
+                yield path, leaf, wrapped
+
+
+def _format_value(text, field):
+    kind = field['kind']
+    if kind == 'date':
+        value = parse_date(text)
+    elif kind == 'amount':
+        value = _amount(text)
+        if value is not None and field['type'] == 'string':
+            value = f"{value:.2f}"
+    elif kind == 'gstin':
+        value = text.upper() if GSTIN_RE.fullmatch(text.upper()) and gstin_checksum_valid(text.upper()) else None
+    else:
+        value = text or None
+    if value is None:
+        return None
+    return {'value': value, 'conf': TEMPLATE_CONF} if field['wrapped'] else value
+
+
+def _lines(words):
+    # Groups words into visual lines by their vertical centre
+    lines = []
+    for word in sorted(words, key=lambda word: ((word[1] + word[3]) / 2, word[0])):
+        centre = (word[1] + word[3]) / 2
+        if lines and abs(lines[-1][0] - centre) <= LINE_TOLERANCE:
+            lines[-1][1].append(word)
+        else:
+            lines.append([centre, [word]])
+    return [sorted(line_words, key=lambda word: word[0]) for _, line_words in lines]
+
+
+class VendorTemplates:
+    def __init__(self, templates_collection, layouts_collection):
+        self.templates = templates_collection
+        self.layouts = layouts_collection
+        self._lock = threading.Lock()
+        # Learning for one vendor is serialized in this process, striped over a fixed set of locks
+        self._learn_locks = [threading.Lock() for _ in range(LEARN_LOCKS)]
+        # Corrections are learned from in the background, not in the request that made them
+        self._learner = ThreadPoolExecutor(max_workers=1, thread_name_prefix='template-learn')
+        self._stats = {'template_hits': 0, 'template_misses': 0, 'validation_failures': 0, 'learned': 0}
+        try:
+            self.templates.create_index([('schema', 1), ('vendor_gstin', 1)])
+            self.layouts.create_index('created_at', expireAfterSeconds=LAYOUT_TTL_SECONDS)
+        except Exception as e:
+            print(f"Error creating vendor template indexes: {e}")
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def remember_layout(self, content_hash, layout):
+        # Kept so that later corrections to this invoice can be learned from. Only layouts
+        # learn() can use are stored.
+        if layout['page_count'] != 1 or not layout_vendor_gstin(layout):
+            return
+        try:
+            self.layouts.replace_one({'_id': content_hash}, {**layout, 'created_at': datetime.now(timezone.utc)},
+                                     upsert=True)
+        except Exception as e:
+            print(f"Error storing page layout: {e}")
+
+    def _find_template(self, schema, vendor_gstin, anchors):
+        best, best_score = None, 0.0
+        for template in self.templates.find({'schema': schema, 'vendor_gstin': vendor_gstin}):
+            template_anchors = set(template['anchors'])
+            if not template_anchors:
+                continue
+            score = len(template_anchors & anchors) / len(template_anchors)
+            if score > best_score:
+                best, best_score = template, score
+        return best if best_score >= MIN_ANCHOR_SIMILARITY else None
+
+    def extract(self, schema, layout, local_fields=None):
+        # Returns the invoice read from a matching template, or None to fall back to the model
+        vendor_gstin = layout_vendor_gstin(layout) if layout['page_count'] == 1 else None
+        try:
+            template = self._find_template(schema, vendor_gstin, layout_anchors(layout)) if vendor_gstin else None
+        except Exception as e:
+            print(f"Error reading vendor templates: {e}")
+            template = None
+        if not template or template['samples'] < MIN_TEMPLATE_SAMPLES:
+            self._count('template_misses')
+            return None
+
+        doc = self._read_template(template, layout['words'])
+        if doc is None or not self._validate(doc, template, local_fields or {}):
+            self._count('validation_failures')
+            return None
+        self._count('template_hits')
+        return doc
+
+    def _read_template(self, template, words):
+        doc = {}
+        for path, field in template['fields'].items():
+            if field['hits'] < MIN_TEMPLATE_SAMPLES:
+                continue
+            text = ' '.join(word[4] for word in field_words(words, field))
+            value = _format_value(text.strip(), field)
+            if value is None:
+                return None
+            _set_path(doc, path, value)
+
+        items = template.get('items')
+        if items and items['hits'] >= MIN_TEMPLATE_SAMPLES:
+            rows = self._read_items(items, words)
+            if not rows:
+                return None
+            _set_path(doc, items['path'], rows)
+        return doc
+
+    def _read_items(self, items, words):
+        # Rows run from the top of the learned table down to the next total label
+        bottom = 1.0
+        for line in _lines([word for word in words if word[1] > items['top'] + LINE_TOLERANCE]):
+            if TOTAL_LABELS.search(' '.join(word[4] for word in line)):
+                bottom = line[0][1]
+                break
+        table = [word for word in words if items['top'] - LINE_TOLERANCE <= word[1] < bottom]
+
+        rows = []
+        for line in _lines(table):
+            row = {}
+            for key, column in items['columns'].items():
+                cell = [word[4] for word in line
+                        if column['x0'] - BOX_PADDING <= (word[0] + word[2]) / 2 <= column['x1'] + BOX_PADDING]
+                if cell:
+                    row[key] = _format_value(' '.join(cell), column)
+            amounts = [key for key, column in items['columns'].items() if column['kind'] == 'amount' and row.get(key)]
+            if amounts:
+                rows.append(row)
+            elif rows and row.get(items['label']):
+                # A wrapped description line belongs to the item above it
+                previous, wrapped = _leaf(rows[-1].get(items['label'], ''))
+                text = f"{previous} {_leaf(row[items['label']])[0]}".strip()
+                rows[-1][items['label']] = {'value': text, 'conf': TEMPLATE_CONF} if wrapped else text
+        return rows
+
+    def _validate(self, doc, template, local_fields):
+        for path, field in template['fields'].items():
+            if field['kind'] == 'gstin' and field['hits'] >= MIN_TEMPLATE_SAMPLES:
+                value, _ = _leaf(_get_path(doc, path))
+                if value is None:
+                    return False
+        # Where the text rules found a value, the template has to agree with it
+        if any(name not in local_fields for name in VALIDATION_FIELDS):
+            return False
+        values = {str(_leaf(value)[0]) for _, value, _ in scalar_fields(doc)}
+        for name in ('vendor_gstin', 'billing_gstin', 'invoice_date'):
+            if name in local_fields and str(local_fields[name]) not in values:
+                return False
+        if 'total_amount' in local_fields:
+            amounts = {_amount(str(_leaf(value)[0])) for _, value, _ in scalar_fields(doc)}
+            if local_fields['total_amount'] not in amounts:
+                return False
+        return True
+
+    def learn(self, schema, layout, doc, corrected=False):
+        # Locates every extracted value on the page and folds the boxes into the vendor's template
+        if layout['page_count'] != 1:
+            return
+        vendor_gstin = layout_vendor_gstin(layout)
+        if not vendor_gstin:
+            return
+        anchors = layout_anchors(layout)
+        with self._learn_locks[hash((schema, vendor_gstin)) % LEARN_LOCKS]:
+            for _ in range(LEARN_ATTEMPTS):
+                try:
+                    template = self._find_template(schema, vendor_gstin, anchors)
+                except Exception as e:
+                    print(f"Error reading vendor templates: {e}")
+                    return
+                if not template:
+                    template = {'schema': schema, 'vendor_gstin': vendor_gstin, 'anchors': sorted(anchors),
+                                'fields': {}, 'samples': 0}
+                samples = template['samples']
+                self._fold(template, anchors, layout['words'], doc, corrected)
+                try:
+                    if '_id' not in template:
+                        self.templates.insert_one(template)
+                        saved = True
+                    else:
+                        # Replaced only if no other process saved a sample since it was read
+                        saved = self.templates.replace_one({'_id': template['_id'], 'samples': samples},
+                                                           template).matched_count == 1
+                except Exception as e:
+                    print(f"Error saving vendor template: {e}")
+                    return
+                if saved:
+                    self._count('learned')
+                    return
+        print(f"Vendor template for {vendor_gstin} kept changing, sample not learned")
+
+    def _fold(self, template, anchors, words, doc, corrected):
+        # Only labels present on every sample of the layout stay anchors
+        template['anchors'] = sorted(set(template['anchors']) & anchors)
+
+        for path, value, wrapped in scalar_fields(doc):
+            kind = value_kind(value)
+            box = locate_value(words, value, kind)
+            if not box:
+                continue
+            label = left_label(words, box)
+            field = template['fields'].get(path)
+            if field and corrected:
+                # A corrected value's position is authoritative
+                field.update({'box': box, 'label': label, 'kind': kind,
+                              'hits': max(field['hits'], MIN_TEMPLATE_SAMPLES)})
+            elif field and label and field.get('label') == label:
+                # Same label: only the horizontal extent has to agree, the line may move
+                field['box'] = [min(field['box'][0], box[0]), box[1], max(field['box'][2], box[2]), box[3]]
+                field['hits'] += 1
+            elif field and not label and _overlaps(field['box'], box):
+                field['box'] = _union([field['box'], box])
+                field['hits'] += 1
+            else:
+                template['fields'][path] = {'box': box, 'label': label, 'kind': kind, 'hits': 1, 'wrapped': wrapped,
+                                            'type': 'number' if isinstance(value, (int, float)) else 'string'}
+
+        self._learn_items(template, doc, words)
+        template['samples'] += 1
+        template['updated_at'] = datetime.now(timezone.utc)
+
+    def _learn_items(self, template, doc, words):
+        for path in ITEM_LIST_PATHS:
+            rows = _get_path(doc, path)
+            if isinstance(rows, list) and rows and all(isinstance(row, dict) for row in rows):
+                break
+        else:
+            return
+
+        columns, tops = {}, []
+        for row in rows:
+            for key, value in row.items():
+                leaf, wrapped = _leaf(value)
+                if not isinstance(leaf, (str, int, float)) or str(leaf).strip().lower() in EMPTY_VALUES:
+                    continue
+                kind = value_kind(leaf)
+                box = locate_value(words, leaf, kind)
+                if not box:
+                    continue
+                tops.append(box[1])
+                column = columns.setdefault(key, {'x0': box[0], 'x1': box[2], 'kind': kind, 'wrapped': wrapped,
+                                                  'type': 'number' if isinstance(leaf, (int, float)) else 'string'})
+                column['x0'], column['x1'] = min(column['x0'], box[0]), max(column['x1'], box[2])
+        text_columns = [key for key, column in columns.items() if column['kind'] == 'text']
+        if not tops or not text_columns or not any(column['kind'] == 'amount' for column in columns.values()):
+            return
+
+        previous = template.get('items')
+        hits = previous['hits'] + 1 if previous and previous['path'] == path else 1
+        template['items'] = {'path': path, 'columns': columns, 'top': min(tops), 'label': text_columns[0],
+                             'hits': hits}
+
+    def learn_from_invoice_later(self, collection, schema, filename):
+        self._learner.submit(self.learn_from_invoice, collection, schema, filename)
+
+    def learn_from_invoice(self, collection, schema, filename):
+        # Called after a user correction; needs the layout stored when the PDF was extracted.
+        # The invoice collection is shared by the apps, so only this schema's invoices count.
+        try:
+            doc = collection.find_one({'filename': filename, 'variant': schema})
+            layout = self.layouts.find_one({'_id': doc['content_hash']}) if doc and doc.get('content_hash') else None
+        except Exception as e:
+            print(f"Error loading invoice for template learning: {e}")
+            return
+        if layout:
+            self.learn(schema, layout, doc, corrected=True)
+
+    def rebuild(self, collection, schema):
+        # Relearns every template from the stored invoices of this schema that have a saved layout
+        self.templates.delete_many({'schema': schema})
+        count = 0
+        for doc in collection.find({'variant': schema, 'content_hash': {'$exists': True}}):
+            layout = self.layouts.find_one({'_id': doc['content_hash']})
+            if layout:
+                self.learn(schema, layout, doc)
+                count += 1
+        return count
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+if __name__ == "__main__":
+    from mongo_writer import create_client
+
+    parser = argparse.ArgumentParser(description="Rebuild vendor layout templates from the invoices in invoiceDB")
+    parser.add_argument('schema', choices=['multi', 'vlm', 'perf_score'])
+    args = parser.parse_args()
+
+    db = create_client()['invoiceDB']
+    vendor_templates = VendorTemplates(db['vendor_templates'], db['layouts'])
+    print(f"Learned from {vendor_templates.rebuild(db['invoices'], args.schema)} invoice(s)")
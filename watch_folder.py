@@ -0,0 +1,261 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+# Long running ingestion of a folder. New and changed files are found from filesystem
+# events (watchdog, when installed) or, failing that, by polling the folder's directory
+# entries. A file is only handed to the workers once its size and mtime have stopped
+# changing and it looks complete, and a persistent state file records what was already
+# processed so a restart, or a file that is touched but not changed, costs nothing.
+WATCH_DEBOUNCE_SECONDS = float(os.environ.get('WATCH_DEBOUNCE_SECONDS', '2'))
+WATCH_POLL_SECONDS = float(os.environ.get('WATCH_POLL_SECONDS', '5'))
+# A file that never looks complete is processed anyway after this long, and fails there if it is broken
+WATCH_MAX_WAIT_SECONDS = float(os.environ.get('WATCH_MAX_WAIT_SECONDS', '300'))
+WATCH_TICK_SECONDS = 0.5
+PDF_TRAILER = b'%%EOF'
+TRAILER_SEARCH_BYTES = 2048
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def looks_complete(path):
+    # A PDF being copied in has no end of file marker yet
+    if not path.lower().endswith('.pdf'):
+        return True
+    try:
+        with open(path, 'rb') as f:
+            f.seek(max(0, os.path.getsize(path) - TRAILER_SEARCH_BYTES))
+            return PDF_TRAILER in f.read()
+    except OSError:
+        return False
+
+
+# Append-only JSON lines, one line per processed file version; the last line for a path
+# wins. The file is compacted to one line per path when it is opened.
+class WatchState:
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self.entries = {}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # A line cut short by a crash
+                    self.entries[entry['path']] = entry
+            compacted = f"{state_path}.tmp"
+            with open(compacted, 'w') as f:
+                f.writelines(json.dumps(entry) + '\n' for entry in self.entries.values())
+            os.replace(compacted, state_path)
+        self._file = open(state_path, 'a')
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            return self.entries.get(path)
+
+    def record(self, path, size, mtime, sha256, status, error=None, usage=None):
+        entry = {'path': path, 'size': size, 'mtime': mtime, 'sha256': sha256, 'status': status,
+                 'updated_at': time.time()}
+        if error:
+            entry['error'] = error
+        if usage:
+            entry['token_usage'] = usage
+        with self._lock:
+            self.entries[path] = entry
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.watcher.notify(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.watcher.notify(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.watcher.notify(event.dest_path)
+
+
+class FolderWatcher:
+    # process_fn(path) returns (status, error, token usage) and runs on one of `workers`
+    # threads. At most twice that many files are submitted at a time; the rest wait.
+    def __init__(self, folder, process_fn, state, workers, suffix='.pdf', debounce_seconds=WATCH_DEBOUNCE_SECONDS,
+                 poll_seconds=WATCH_POLL_SECONDS):
+        self.folder = os.path.abspath(folder)
+        self.process_fn = process_fn
+        self.state = state
+        self.workers = workers
+        self.suffix = suffix
+        self.debounce_seconds = debounce_seconds
+        self.poll_seconds = poll_seconds
+        self._pending = {}  # path -> [size, mtime, stable since, first seen]
+        self._running = set()
+        self._slots = threading.BoundedSemaphore(workers * 2)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self.stats = {'processed': 0, 'failed': 0, 'unchanged': 0}
+
+    def notify(self, path):
+        if not path.lower().endswith(self.suffix):
+            return
+        with self._lock:
+            self._pending.setdefault(os.path.abspath(path), [None, None, 0.0, time.monotonic()])
+        self._wakeup.set()
+
+    def _stat(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def _unchanged(self, path, size, mtime):
+        entry = self.state.get(path)
+        return entry is not None and entry['size'] == size and entry['mtime'] == mtime and entry['status'] == 'done'
+
+    def scan(self, retry_failed=False):
+        # Queues every file not recorded as processed in its current version
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.lower().endswith(self.suffix):
+                    continue
+                stat = entry.stat()
+                recorded = self.state.get(entry.path)
+                if recorded and recorded['size'] == stat.st_size and recorded['mtime'] == stat.st_mtime and (
+                        recorded['status'] == 'done' or not retry_failed):
+                    continue
+                self.notify(entry.path)
+
+    def _ready(self):
+        # Pending paths whose size and mtime held still for the debounce interval
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            for path, pending in list(self._pending.items()):
+                if path in self._running:
+                    continue
+                stat = self._stat(path)
+                if stat is None:
+                    del self._pending[path]  # deleted or moved away before it settled
+                    continue
+                if list(stat) != pending[:2]:
+                    pending[:3] = [stat[0], stat[1], now]
+                    continue
+                if now - pending[2] < self.debounce_seconds:
+                    continue
+                if not looks_complete(path) and now - pending[3] < WATCH_MAX_WAIT_SECONDS:
+                    continue
+                ready.append((path, stat))
+        return ready
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _process(self, path, stat):
+        try:
+            size, mtime = stat
+            sha256 = file_hash(path)
+            entry = self.state.get(path)
+            if entry and entry['sha256'] == sha256 and entry['status'] == 'done':
+                # Touched or copied over with the same content
+                self.state.record(path, size, mtime, sha256, 'done', usage=entry.get('token_usage'))
+                self._count('unchanged')
+                return
+            try:
+                status, error, usage = self.process_fn(path)
+            except Exception as e:
+                status, error, usage = 'failed', str(e), None
+            self.state.record(path, size, mtime, sha256, status, error, usage)
+            self._count('processed' if status == 'done' else 'failed')
+            print(f"{os.path.basename(path)}: {status}" + (f" ({error})" if error else ''))
+        except Exception as e:
+            print(f"Error processing {path}: {e}")
+        finally:
+            with self._lock:
+                self._running.discard(path)
+            self._slots.release()
+            self._wakeup.set()
+
+    def _dispatch(self, pool):
+        for path, stat in self._ready():
+            if not self._slots.acquire(blocking=False):
+                return  # The pool is full; the rest stay pending
+            with self._lock:
+                del self._pending[path]
+                if self._unchanged(path, *stat):
+                    self._slots.release()
+                    continue
+                self._running.add(path)
+            pool.submit(self._process, path, stat)
+
+    def run(self):
+        # Blocks until stop() is called or the process is interrupted
+        observer = None
+        if Observer is not None:
+            observer = Observer()
+            observer.schedule(_EventHandler(self), self.folder, recursive=False)
+            observer.start()
+            print(f"Watching {self.folder} for new PDFs")
+        else:
+            print(f"Polling {self.folder} every {self.poll_seconds}s for new PDFs (install watchdog for events)")
+        self.scan(retry_failed=True)
+        next_poll = time.monotonic() + self.poll_seconds
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='watch') as pool:
+                while not self._stopped.is_set():
+                    with self._lock:
+                        busy = bool(self._pending)
+                    # With events and nothing pending the loop sleeps until something arrives
+                    if busy:
+                        timeout = WATCH_TICK_SECONDS
+                    elif observer is None:
+                        timeout = max(0.0, next_poll - time.monotonic())
+                    else:
+                        timeout = None
+                    self._wakeup.wait(timeout)
+                    self._wakeup.clear()
+                    if observer is None and time.monotonic() >= next_poll:
+                        self.scan()
+                        next_poll = time.monotonic() + self.poll_seconds
+                    self._dispatch(pool)
+        except KeyboardInterrupt:
+            print("Stopping watcher, waiting for files in progress")
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+        return self.stats
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
@@ -0,0 +1,142 @@
+import contextvars
+import os
+import threading
+from collections import deque
+from itertools import islice
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+# Per deployment knobs. With the defaults every file is processed one after another in
+# the request thread, exactly as before.
+EXTRACT_THREAD_WORKERS = int(os.environ.get('EXTRACT_THREAD_WORKERS', '1'))
+PARSE_PROCESS_WORKERS = int(os.environ.get('PARSE_PROCESS_WORKERS', '0'))
+# Page windows of one long document; a separate pool, since its callers may already be
+# running in the extract pool
+WINDOW_WORKERS = int(os.environ.get('WINDOW_WORKERS', '8'))
+# Invoices of one multi-invoice PDF; these in turn submit to the window pool
+PART_WORKERS = int(os.environ.get('PART_WORKERS', '4'))
+
+_thread_pool = None
+_process_pool = None
+_window_pool = None
+_part_pool = None
+_lock = threading.Lock()
+
+
+def get_thread_pool():
+    global _thread_pool
+    with _lock:
+        if _thread_pool is None:
+            _thread_pool = ThreadPoolExecutor(max_workers=EXTRACT_THREAD_WORKERS,
+                                              thread_name_prefix='extract')
+        return _thread_pool
+
+
+def get_process_pool():
+    global _process_pool
+    with _lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(max_workers=PARSE_PROCESS_WORKERS)
+        return _process_pool
+
+
+def get_window_pool():
+    global _window_pool
+    with _lock:
+        if _window_pool is None:
+            _window_pool = ThreadPoolExecutor(max_workers=WINDOW_WORKERS, thread_name_prefix='window')
+        return _window_pool
+
+
+def get_part_pool():
+    global _part_pool
+    with _lock:
+        if _part_pool is None:
+            _part_pool = ThreadPoolExecutor(max_workers=PART_WORKERS, thread_name_prefix='part')
+        return _part_pool
+
+
+def run_parse(fn, *args):
+    # fitz work is CPU bound, so it goes to a process pool when one is configured.
+    # fn and its arguments must be picklable (module level function, bytes/BytesIO).
+    if PARSE_PROCESS_WORKERS > 0:
+        return get_process_pool().submit(fn, *args).result()
+    return fn(*args)
+
+
+def _submit(pool, fn, item):
+    # Each call runs in a copy of the submitting thread's context, so per request state
+    # such as the metrics trace follows the work into the pool thread
+    return pool.submit(contextvars.copy_context().run, fn, item)
+
+
+def map_in_order(fn, items):
+    # Model calls are network bound, so they are fanned out across threads.
+    # Results are returned in submission order, not completion order.
+    items = list(items)
+    if EXTRACT_THREAD_WORKERS > 1 and len(items) > 1:
+        pool = get_thread_pool()
+        futures = [_submit(pool, fn, item) for item in items]
+        return [future.result() for future in futures]
+    return [fn(item) for item in items]
+
+
+def imap_parse(fn, args_list, window=None):
+    # Lazily runs fn(*args) for each entry of args_list, yielding results in order.
+    # At most `window` calls are in flight, so a slow consumer bounds memory use.
+    if PARSE_PROCESS_WORKERS <= 0:
+        for args in args_list:
+            yield fn(*args)
+        return
+
+    pool = get_process_pool()
+    window = window or PARSE_PROCESS_WORKERS * 2
+    args_iter = iter(args_list)
+    pending = deque(pool.submit(fn, *args) for args in islice(args_iter, window))
+    try:
+        while pending:
+            result = pending.popleft().result()
+            for args in islice(args_iter, 1):
+                pending.append(pool.submit(fn, *args))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def map_as_completed(fn, items):
+    # Like map_in_order, but yields (index, result) pairs as soon as each call finishes
+    items = list(items)
+    if EXTRACT_THREAD_WORKERS > 1 and len(items) > 1:
+        pool = get_thread_pool()
+        futures = {_submit(pool, fn, item): index for index, item in enumerate(items)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+        return
+    for index, item in enumerate(items):
+        yield index, fn(item)
+
+
+def _map_on(get_pool, workers, fn, items):
+    items = list(items)
+    if workers > 1 and len(items) > 1:
+        pool = get_pool()
+        futures = [_submit(pool, fn, item) for item in items]
+        return [future.result() for future in futures]
+    return [fn(item) for item in items]
+
+
+def submit_window(fn, item):
+    # A future for fn(item) on the window pool, or for the call made right away without one
+    if WINDOW_WORKERS > 1:
+        return _submit(get_window_pool(), fn, item)
+    future = Future()
+    try:
+        future.set_result(fn(item))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def map_parts(fn, items):
+    # map_in_order on the part pool
+    return _map_on(get_part_pool, PART_WORKERS, fn, items)